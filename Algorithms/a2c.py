@@ -68,7 +68,8 @@ class A2C:
             utl.recompute_embeddings(self.actor_critic, policy_storage, encoder, sample=False, update_idx=0,
                                      detach_every=self.args.tbptt_stepsize if hasattr(self.args,
                                                                                       'tbptt_stepsize') else None,
-                                     activated_branch=activated_branch)
+                                     activated_branch=activated_branch,
+                                     chunk_size=self.args.recompute_chunk_size if hasattr(self.args, 'recompute_chunk_size') else None)
 
         # update the normalisation parameters of policy inputs before updating
         self.actor_critic.update_rms(args=self.args, policy_storage=policy_storage)
@@ -118,7 +118,8 @@ class PPO:
             # recompute embeddings (to build computation graph)
             utl.recompute_embeddings(self.actor_critic, policy_storage, encoder, sample=False, update_idx=0,
                                      detach_every=self.args.tbptt_stepsize if hasattr(self.args, 'tbptt_stepsize') else None,
-                                     activated_branch=activated_branch)
+                                     activated_branch=activated_branch,
+                                     chunk_size=self.args.recompute_chunk_size if hasattr(self.args, 'recompute_chunk_size') else None)
 
         # update the normalisation parameters of policy inputs before updating
         self.actor_critic.update_rms(args=self.args, policy_storage=policy_storage)
@@ -226,7 +227,8 @@ class PPO:
                     # recompute embeddings (to build computation graph)
                     utl.recompute_embeddings(self.actor_critic, policy_storage, encoder, sample=False, update_idx=e + 1,
                                              detach_every=self.args.tbptt_stepsize if hasattr(self.args, 'tbptt_stepsize') else None,
-                                             activated_branch=activated_branch,)
+                                             activated_branch=activated_branch,
+                                             chunk_size=self.args.recompute_chunk_size if hasattr(self.args, 'recompute_chunk_size') else None)
 
         if (not rlloss_through_encoder) and (self.optimiser_vae is not None):
             for _ in range(self.args.num_vae_updates):
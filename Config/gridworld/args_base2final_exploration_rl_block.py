@@ -79,8 +79,30 @@ def get_args(rest_args):
                         help='probability of adding a new trajectory to buffer')
     parser.add_argument('--vae_batch_num_trajs', type=int, default=25,
                         help='how many trajectories to use for VAE update')
+    parser.add_argument('--vae_prefetch_batches', type=boolean_argument, default=False,
+                        help='sample VAE mini-batches on a background thread (pinned memory, async copies to the GPU)')
+    parser.add_argument('--vae_buffer_dir', type=str, default=None,
+                        help='keep the VAE buffer in memory-mapped files in this directory (resumed if it exists)')
+    parser.add_argument('--vae_buffer_compact', type=boolean_argument, default=False,
+                        help='store observations as uint8 and actions as int8 in the VAE buffer (MiniGrid)')
+    parser.add_argument('--compact_obs', type=boolean_argument, default=False,
+                        help='keep MiniGrid observations as uint8 in the vec envs and all buffers (cast to float by the networks)')
+    parser.add_argument('--vec_env_shared_memory', type=boolean_argument, default=False,
+                        help='workers write observations/rewards/dones into shared memory instead of pickling them')
+    parser.add_argument('--num_env_workers', type=int, default=None,
+                        help='number of worker processes the envs are distributed over (default: one per env)')
+    parser.add_argument('--pipelined_rollouts', type=boolean_argument, default=False,
+                        help='step the exploration and exploitation envs asynchronously, overlapping simulation with inference')
+    parser.add_argument('--vectorized_env', type=boolean_argument, default=False,
+                        help='use the batched (single process) implementation of the env if there is one (GridNavi)')
+    parser.add_argument('--cache_running_encoding', type=boolean_argument, default=False,
+                        help='reuse the encoding of the running trajectories from the end of the last rollout '
+                             'instead of re-encoding them, as long as the encoder and policy have not changed')
     parser.add_argument('--tbptt_stepsize', type=int, default=None,
                         help='stepsize for truncated backpropagation through time; None uses max (horizon of BAMDP)')
+    parser.add_argument('--recompute_chunk_size', type=int, default=None,
+                        help='when recomputing the embeddings for the RL loss, run the encoder over chunks of up to '
+                             'this many steps (cut at hidden state resets) instead of one step at a time')
     parser.add_argument('--vae_subsample_elbos', type=int, default=100,
                         help='for how many timesteps to compute the ELBO; None uses all')
     parser.add_argument('--vae_subsample_decodes', type=int, default=100,
@@ -314,6 +336,19 @@ def get_args(rest_args):
                         help='whatever or not use hebbian memory in memory module')
     parser.add_argument('--use_gen', type=boolean_argument, default=False,
                         help='whatever or not use generative memory in memory module')
+    parser.add_argument('--gen_memory_batch_size', type=int, default=256,
+                        help='mini-batch size of the cVAE updates when the generative memory is written')
+    parser.add_argument('--gen_memory_online_ewc', type=boolean_argument, default=False,
+                        help='consolidate the cVAEs with online EWC (one running Fisher per cVAE, needs torch.func) '
+                             'instead of a new EWC estimated on old samples at every write')
+    parser.add_argument('--gen_memory_ewc_gamma', type=float, default=0.9,
+                        help='decay of the running Fisher of online EWC')
+    parser.add_argument('--kmeans_batch_size', type=int, default=256,
+                        help='mini-batch size of the k-means refinement of the generative memory clusters')
+    parser.add_argument('--kmeans_max_iters', type=int, default=20,
+                        help='maximum number of k-means mini-batches each time task ids are added')
+    parser.add_argument('--kmeans_tol', type=float, default=1e-4,
+                        help='stop the k-means refinement once no center moves more than this')
 
     parser.add_argument('--read_num_head', type=int, default=4)
     parser.add_argument('--combination_num_head', type=int, default=2)
@@ -336,9 +371,18 @@ def get_args(rest_args):
     parser.add_argument('--read_memory_to_key_layer', type=int, nargs='+', default=[])
     parser.add_argument('--use_rpe', type=boolean_argument, default=False)
     parser.add_argument('--hebb_learning_rate', type=float, default=0.0001)
+    parser.add_argument('--hebb_consolidation_iterations', type=int, default=4,
+                        help='number of Hebbian updates each time an episode is written to the Hebbian memory')
+    parser.add_argument('--hebb_consolidation_tol', type=float, default=None,
+                        help='stop the Hebbian updates early once the largest weight change is below this')
     parser.add_argument('--reconstruction_memory_loss', type=boolean_argument, default=False)
     parser.add_argument('--reconstruction_memory_loss_coef', type=float, default=0.5,
                         help='RL vs Recons loss for memory training')
+    parser.add_argument('--memory_loss_mode', type=str, default='sequential',
+                        choices=['sequential', 'batched', 'causal'],
+                        help='sequential: write and read the memory step by step; batched: all reads in one masked '
+                             'attention call (same result); causal: batched, each step only reads what was written '
+                             'so far in its episode')
 
     # vision core
     parser.add_argument('--use_stateful_vision_core', type=boolean_argument, default=False,
@@ -360,4 +404,6 @@ def get_args(rest_args):
 
     parser.add_argument('--episodic_reward', type=boolean_argument, default=False)
     parser.add_argument('--episodic_reward_coef', type=float, default=1.0)
+    parser.add_argument('--episodic_reward_num_neighbours', type=int, default=1,
+                        help='number of nearest episodic memory keys averaged for the episodic reward (1 is nearest neighbour)')
     return parser.parse_args(rest_args)
@@ -0,0 +1,241 @@
+import gym
+import numpy as np
+from gym import spaces
+from gym.utils import seeding
+from gym_minigrid.envs import KeyCorridor
+from gym_minigrid.minigrid import DIR_TO_VEC, OBJECT_TO_IDX, Grid, MiniGridEnv, Wall
+
+from environments.env_utils.vec_env import VecEnv
+
+
+class MiniGridVecEnv(VecEnv):
+    """
+    Batched version of the KeyCorridor and MultiRoom MiniGrid envs (wrapped in a MiniGridWrapper and a VariBadWrapper),
+    stepping all environments in one vectorised call.
+    The worlds of all [num_envs] environments are kept as stacked arrays of cell encodings (object type, color, state),
+    with the agent poses and the encodings of the carried objects, and their observations are cut out of these arrays.
+    The layout of a task is generated once by a reference env (seeded like the MiniGridWrapper of that env would be),
+    and restored with an array copy at every reset of the MDP.
+    Exposes the same interface as a SubprocVecEnv around the wrapped envs.
+    """
+
+    supported_envs = ('MiniGrid-KeyCorridor', 'MiniGrid-MultiRoom')
+
+    def __init__(self, env_name, num_envs, episodes_per_task, seed=None, rank_offset=0):
+        assert env_name.startswith(self.supported_envs), env_name
+        # a single env, which generates the layouts of the tasks
+        self.env = gym.make(env_name)
+        unwrapped = self.env.unwrapped
+        self.width, self.height = unwrapped.width, unwrapped.height
+        self.view_size = unwrapped.agent_view_size
+        self.max_steps = unwrapped.max_steps
+        self._max_episode_steps = unwrapped.max_steps
+        self.num_states = self.width * self.height
+        self.task_dim = 0
+        self.belief_dim = 0
+        # KeyCorridor ends when its target object is picked up, MultiRoom when the goal is reached
+        self.pickup_target = isinstance(unwrapped, KeyCorridor)
+
+        self.episodes_per_task = episodes_per_task
+        self.add_done_info = episodes_per_task > 1
+        observation_space = spaces.Box(low=0, high=255, shape=(self.view_size * self.view_size * 3,), dtype='uint8')
+        if self.add_done_info:
+            observation_space = spaces.Box(low=np.array([*observation_space.low, 0]),
+                                           high=np.array([*observation_space.high, 1]),
+                                           dtype=observation_space.dtype)
+        VecEnv.__init__(self, num_envs, observation_space, self.env.action_space)
+
+        # seed of the current task of each env, the MiniGridWrapper moves on by 64 at every new task
+        self.seeds = [seeding.np_random(None)[1] if seed is None else seed + rank_offset + i for i in range(num_envs)]
+
+        self.start_cells = np.zeros((num_envs, self.width, self.height, 3), dtype=np.uint8)
+        self.start_pos = np.zeros((num_envs, 2), dtype=np.int64)
+        self.start_dir = np.zeros(num_envs, dtype=np.int64)
+        self.targets = np.zeros((num_envs, 3), dtype=np.uint8)
+
+        self.cells = np.zeros((num_envs, self.width, self.height, 3), dtype=np.uint8)
+        self.agent_pos = np.zeros((num_envs, 2), dtype=np.int64)
+        self.agent_dir = np.zeros(num_envs, dtype=np.int64)
+        # encoding of the carried object (all zeros if the agent carries nothing)
+        self.carrying = np.zeros((num_envs, 3), dtype=np.uint8)
+        self.step_counts = np.zeros(num_envs, dtype=np.int64)
+        self.episode_counts = np.zeros(num_envs, dtype=np.int64)
+        self.actions = None
+
+        self.dir_vec = np.array(DIR_TO_VEC)
+        self.wall = np.array(Wall().encode(), dtype=np.uint8)
+        self.empty = np.array((OBJECT_TO_IDX['empty'], 0, 0), dtype=np.uint8)
+        self.view_offsets = self.compute_view_offsets(self.view_size)
+
+    @staticmethod
+    def compute_view_offsets(view_size):
+        """
+        Offsets from the agent to the cells of its (rotated) view, for each direction:
+        the view of MiniGridEnv.gen_obs_image is world[agent_pos + view_offsets[agent_dir]]
+        """
+        i, j = np.meshgrid(np.arange(view_size), np.arange(view_size), indexing='ij')
+        # top left corner of the view relative to the agent, as in MiniGridEnv.get_view_exts
+        tops = [(0, -(view_size // 2)), (-(view_size // 2), 0),
+                (-view_size + 1, -(view_size // 2)), (-(view_size // 2), -view_size + 1)]
+        offsets = np.zeros((4, view_size, view_size, 2), dtype=np.int64)
+        for agent_dir, (top_x, top_y) in enumerate(tops):
+            offsets[agent_dir, ..., 0] = np.rot90(top_x + i, k=-(agent_dir + 1))
+            offsets[agent_dir, ..., 1] = np.rot90(top_y + j, k=-(agent_dir + 1))
+        return offsets
+
+    def obs(self, index, done_mdp):
+        n = len(index)
+        coords = self.agent_pos[index, None, None, :] + self.view_offsets[self.agent_dir[index]]
+        inside = (coords[..., 0] >= 0) & (coords[..., 0] < self.width) & \
+                 (coords[..., 1] >= 0) & (coords[..., 1] < self.height)
+        x = np.clip(coords[..., 0], 0, self.width - 1)
+        y = np.clip(coords[..., 1], 0, self.height - 1)
+        # cells outside of the grid are seen as walls
+        view = np.where(inside[..., None], self.cells[index[:, None, None], x, y], self.wall)
+
+        agent_pos = self.view_size // 2, self.view_size - 1
+        see_behind = (view[..., 0] != OBJECT_TO_IDX['wall']) & \
+                     ((view[..., 0] != OBJECT_TO_IDX['door']) | (view[..., 2] == 0))
+        vis_mask = Grid.process_vis_array(see_behind, agent_pos)
+
+        image = np.where(vis_mask[..., None], view, 0).astype(np.uint8)
+        # the agent sees what it's carrying at its own position
+        carrying = self.carrying[index]
+        image[:, agent_pos[0], agent_pos[1]] = np.where(carrying[:, :1] > 0, carrying, self.empty)
+
+        state = image.reshape(n, -1)
+        if self.add_done_info:
+            state = np.concatenate((state, done_mdp.astype(np.uint8).reshape(-1, 1)), axis=-1)
+        return state
+
+    def reset_tasks(self, index):
+        unwrapped = self.env.unwrapped
+        for i in index:
+            self.seeds[i] += 64
+            self.env.seed(self.seeds[i])
+            self.env.reset()
+            self.start_cells[i] = unwrapped.grid.encoding
+            self.start_pos[i] = unwrapped.agent_pos
+            self.start_dir[i] = unwrapped.agent_dir
+            if self.pickup_target:
+                self.targets[i] = unwrapped.obj.encode()
+
+    def reset_mdps(self, index):
+        self.cells[index] = self.start_cells[index]
+        self.agent_pos[index] = self.start_pos[index]
+        self.agent_dir[index] = self.start_dir[index]
+        self.carrying[index] = 0
+        self.step_counts[index] = 0
+
+    def reset(self, task=None):
+        assert task is None, "MiniGrid tasks are given by the seeds of the envs"
+        index = np.arange(self.num_envs)
+        self.reset_tasks(index)
+        self.reset_mdps(index)
+        self.episode_counts[index] = 0
+        return self.obs(index, np.zeros(self.num_envs, dtype=bool))
+
+    def reset_at(self, index, task=None):
+        """ Resets (the BAMDP of) a single env """
+        assert task is None, "MiniGrid tasks are given by the seeds of the envs"
+        index = np.array([index])
+        self.reset_tasks(index)
+        self.reset_mdps(index)
+        self.episode_counts[index] = 0
+        return self.obs(index, np.zeros(1, dtype=bool))[0]
+
+    def reset_mdp(self):
+        index = np.arange(self.num_envs)
+        self.reset_mdps(index)
+        return self.obs(index, np.zeros(self.num_envs, dtype=bool))
+
+    def reset_mdp_at(self, index):
+        """ Resets the underlying MDP (*not* the task) of a single env """
+        index = np.array([index])
+        self.reset_mdps(index)
+        return self.obs(index, np.zeros(1, dtype=bool))[0]
+
+    def step_async(self, actions):
+        self.actions = np.asarray(actions).reshape(self.num_envs).astype(np.int64)
+
+    def step_wait(self):
+        index = np.arange(self.num_envs)
+        actions = self.actions
+        Actions = MiniGridEnv.Actions
+        self.step_counts += 1
+
+        # contents of the cell in front of the agent
+        fwd_pos = self.agent_pos + self.dir_vec[self.agent_dir]
+        fwd_cell = self.cells[index, fwd_pos[:, 0], fwd_pos[:, 1]]
+        fwd_type, fwd_color, fwd_state = fwd_cell[:, 0], fwd_cell[:, 1], fwd_cell[:, 2]
+        carries = self.carrying[:, 0] > 0
+
+        rewards = np.zeros(self.num_envs)
+        done_mdp = np.zeros(self.num_envs, dtype=bool)
+
+        # rotate left / right
+        self.agent_dir = np.where(actions == Actions.left, (self.agent_dir - 1) % 4, self.agent_dir)
+        self.agent_dir = np.where(actions == Actions.right, (self.agent_dir + 1) % 4, self.agent_dir)
+
+        # move forward onto empty cells, open doors, goals, floors and lava
+        forward = actions == Actions.forward
+        can_overlap = np.isin(fwd_type, [OBJECT_TO_IDX['empty'], OBJECT_TO_IDX['goal'], OBJECT_TO_IDX['floor'],
+                                         OBJECT_TO_IDX['lava']]) | ((fwd_type == OBJECT_TO_IDX['door']) & (fwd_state == 0))
+        move = forward & can_overlap
+        self.agent_pos[move] = fwd_pos[move]
+        reached_goal = forward & (fwd_type == OBJECT_TO_IDX['goal'])
+        rewards[reached_goal] = 1 - 0.9 * (self.step_counts[reached_goal] / self.max_steps)
+        done_mdp |= reached_goal | (forward & (fwd_type == OBJECT_TO_IDX['lava']))
+
+        # pick up keys, balls and boxes
+        pickup = (actions == Actions.pickup) & ~carries & \
+                 np.isin(fwd_type, [OBJECT_TO_IDX['key'], OBJECT_TO_IDX['ball'], OBJECT_TO_IDX['box']])
+        self.carrying[pickup] = fwd_cell[pickup]
+        self.cells[pickup, fwd_pos[pickup, 0], fwd_pos[pickup, 1]] = self.empty
+
+        # drop the carried object on an empty cell
+        drop = (actions == Actions.drop) & carries & (fwd_type == OBJECT_TO_IDX['empty'])
+        self.cells[drop, fwd_pos[drop, 0], fwd_pos[drop, 1]] = self.carrying[drop]
+        self.carrying[drop] = 0
+
+        # toggle doors: a locked door (2) is opened (0) with the key of its color, others go from open to closed (1)
+        toggle = (actions == Actions.toggle) & (fwd_type == OBJECT_TO_IDX['door'])
+        has_key = carries & (self.carrying[:, 0] == OBJECT_TO_IDX['key']) & (self.carrying[:, 1] == fwd_color)
+        new_state = np.where(fwd_state == 2, np.where(has_key, 0, 2), 1 - np.minimum(fwd_state, 1))
+        self.cells[toggle, fwd_pos[toggle, 0], fwd_pos[toggle, 1], 2] = new_state[toggle]
+
+        if self.pickup_target:
+            # the target is the only object of its type and color
+            on_target = (actions == Actions.pickup) & (self.carrying[:, 0] == self.targets[:, 0]) & \
+                        (self.carrying[:, 1] == self.targets[:, 1])
+            rewards[on_target] = 1 - 0.9 * (self.step_counts[on_target] / self.max_steps)
+            done_mdp |= on_target
+
+        done_mdp |= self.step_counts >= self.max_steps
+
+        obs = self.obs(index, done_mdp)
+
+        # multi-episode (BAMDP) logic of the VariBadWrapper
+        self.episode_counts += done_mdp
+        done_bamdp = done_mdp & (self.episode_counts == self.episodes_per_task)
+        reset_mdp = (done_mdp & ~done_bamdp).nonzero()[0]
+        infos = [{'done_mdp': bool(done_mdp[i])} for i in index]
+        if len(reset_mdp) > 0:
+            self.reset_mdps(reset_mdp)
+            start_states = self.obs(reset_mdp, np.zeros(len(reset_mdp), dtype=bool))
+            for i, start_state in zip(reset_mdp, start_states):
+                infos[i]['start_state'] = start_state
+
+        return obs, rewards, done_bamdp, infos
+
+    def get_task(self):
+        return np.zeros((self.num_envs, self.task_dim))
+
+    def get_belief(self):
+        return np.zeros((self.num_envs, self.belief_dim))
+
+    def get_env_attr(self, attr):
+        return getattr(self, attr)
+
+    def get_images(self):
+        raise NotImplementedError
@@ -7,9 +7,13 @@ import torch
 from environments.env_utils.vec_env import VecEnvWrapper
 from environments.env_utils.vec_env.dummy_vec_env import DummyVecEnv
 from environments.env_utils.vec_env.subproc_vec_env import SubprocVecEnv
+from environments.env_utils.vec_env.shmem_vec_env import ShmemVecEnv
+from environments.env_utils.vec_env.batched_subproc_vec_env import BatchedSubprocVecEnv
 from environments.env_utils.vec_env.vec_normalize import VecNormalize
 from environments.wrappers import TimeLimitMask, VariBadWrapper
 from environments.wrappers import MiniGridWrapper
+from environments.navigation.gridworld import GridNaviVecEnv
+from environments.minigrid_vec_env import MiniGridVecEnv
 
 
 def make_env(env_id, seed, rank, episodes_per_task, **kwargs):
@@ -31,17 +35,31 @@ def make_env(env_id, seed, rank, episodes_per_task, **kwargs):
 
 def make_vec_envs(env_name, seed, num_processes, gamma,
                   device, episodes_per_task,
-                  normalise_rew, ret_rms, rank_offset=0,
-                  **kwargs):
+                  normalise_rew, ret_rms, rank_offset=0, compact_obs=False, shared_memory=False, num_workers=None,
+                  vectorized_env=False, **kwargs):
     """
     :param ret_rms: running return and std for rewards
+    :param compact_obs: keep observations in the dtype of the env (uint8 for MiniGrid) instead of casting to float
+    :param shared_memory: let the worker processes write observations/rewards/dones into shared memory
+    :param num_workers: number of worker processes the envs are distributed over (None: one per env)
+    :param vectorized_env: use the batched implementation of the env if there is one (GridNavi, MiniGrid KeyCorridor/MultiRoom)
     """
     envs = []
     for i in range(num_processes):
         envs.append(make_env(env_id=env_name, seed=seed, rank=rank_offset + i,
                      episodes_per_task=episodes_per_task, **kwargs))
 
-    if len(envs) > 1:
+    if vectorized_env and env_name.startswith('GridNavi'):
+        envs = GridNaviVecEnv(num_envs=num_processes, episodes_per_task=episodes_per_task,
+                              seed=None if seed is None else seed + rank_offset, **kwargs)
+    elif vectorized_env and env_name.startswith(MiniGridVecEnv.supported_envs):
+        envs = MiniGridVecEnv(env_name, num_envs=num_processes, episodes_per_task=episodes_per_task, seed=seed,
+                              rank_offset=rank_offset)
+    elif len(envs) > 1 and num_workers is not None and num_workers < len(envs):
+        envs = BatchedSubprocVecEnv(envs, num_workers=num_workers)
+    elif len(envs) > 1 and shared_memory:
+        envs = ShmemVecEnv(envs)
+    elif len(envs) > 1:
         envs = SubprocVecEnv(envs)
     else:
         envs = DummyVecEnv(envs)
@@ -52,24 +70,35 @@ def make_vec_envs(env_name, seed, num_processes, gamma,
         else:
             envs = VecNormalize(envs, normalise_rew=normalise_rew, ret_rms=ret_rms, gamma=gamma)
 
-    envs = VecPyTorch(envs, device)
+    envs = VecPyTorch(envs, device, compact_obs=compact_obs)
 
     return envs
 
 
 class VecPyTorch(VecEnvWrapper):
-    def __init__(self, venv, device):
+    def __init__(self, venv, device, compact_obs=False):
         """Return only every `skip`-th frame"""
         super(VecPyTorch, self).__init__(venv)
         self.device = device
-        # TODO: Fix data types
+        # if True, uint8 observations (MiniGrid) stay uint8 and are only cast to float by the networks
+        self.compact_obs = compact_obs
+
+    def obs_to_tensor(self, obs):
+        tensor = torch.from_numpy(obs)
+        if not (self.compact_obs and tensor.dtype == torch.uint8):
+            tensor = tensor.float()
+        tensor = tensor.to(self.device)
+        # obs can be a view on the shared-memory buffer of the vec env, which is overwritten by the next step
+        if not obs.flags.owndata and tensor.data_ptr() == obs.ctypes.data:
+            tensor = tensor.clone()
+        return tensor
 
     def reset_mdp(self, index=None):
         obs = self.venv.reset_mdp(index=index)
         if isinstance(obs, list):
-            obs = [torch.from_numpy(o).float().to(self.device) for o in obs]
+            obs = [self.obs_to_tensor(o) for o in obs]
         else:
-            obs = torch.from_numpy(obs).float().to(self.device)
+            obs = self.obs_to_tensor(obs)
         return obs
 
     def reset(self, index=None, task=None):
@@ -77,9 +106,9 @@ class VecPyTorch(VecEnvWrapper):
             assert isinstance(task, list)
         state = self.venv.reset(index=index, task=task)
         if isinstance(state, list):
-            state = [torch.from_numpy(s).float().to(self.device) for s in state]
+            state = [self.obs_to_tensor(s) for s in state]
         else:
-            state = torch.from_numpy(state).float().to(self.device)
+            state = self.obs_to_tensor(state)
         return state
 
     def step_async(self, actions):
@@ -90,9 +119,9 @@ class VecPyTorch(VecEnvWrapper):
     def step_wait(self):
         state, reward, done, info = self.venv.step_wait()
         if isinstance(state, list):  # raw + normalised
-            state = [torch.from_numpy(s).float().to(self.device) for s in state]
+            state = [self.obs_to_tensor(s) for s in state]
         else:
-            state = torch.from_numpy(state).float().to(self.device)
+            state = self.obs_to_tensor(state)
         if isinstance(reward, list):  # raw + normalised
             reward = [torch.from_numpy(r).unsqueeze(dim=1).float().to(self.device) for r in reward]
         else:
@@ -27,7 +27,7 @@ class MiniGridWrapper(gym.core.ObservationWrapper):
     # add reset task and rset function to env
     # add _max_episode_steps attribute
     def __init__(self,
-                 env, seed):
+                 env, seed, layout_cache_size=4):
         super().__init__(env)
 
         imgSpace = env.observation_space.spaces['image']
@@ -48,6 +48,11 @@ class MiniGridWrapper(gym.core.ObservationWrapper):
 
         self.seed_num = seed
 
+        # reset re-seeds the env with the seed of the task, so the layout of a task only has to be generated once
+        if layout_cache_size:
+            from gym_minigrid.minigrid import LayoutCache
+            self.env.unwrapped.layout_cache = LayoutCache(max_size=layout_cache_size)
+
     def reset(self):
         self.env.seed(self.seed_num)
         obs = self.env.reset()
@@ -121,7 +126,8 @@ class VariBadWrapper(gym.Wrapper):
                     raise ValueError  # can't add additional info for obs of more than 1D
                 self.observation_space = spaces.Box(low=np.array([*self.observation_space.low, 0]),
                                                     # shape will be deduced from this
-                                                    high=np.array([*self.observation_space.high, 1])
+                                                    high=np.array([*self.observation_space.high, 1]),
+                                                    dtype=self.observation_space.dtype
                                                     )
             else:
                 # TODO: add something simliar for the other possible spaces,
@@ -164,15 +170,21 @@ class VariBadWrapper(gym.Wrapper):
         self.step_count_bamdp = 0
         self.done_mdp = False
         if self.add_done_info:
-            state = np.concatenate((state, [0.0]))
+            state = self.add_done_flag(state, 0.0)
 
         return state
 
+    def add_done_flag(self, state, done):
+        # keep the dtype of the observation (so that uint8 MiniGrid observations stay uint8)
+        if np.issubdtype(state.dtype, np.integer):
+            return np.concatenate((state, np.array([done], dtype=state.dtype)))
+        return np.concatenate((state, [done]))
+
     def reset_mdp(self):
         """ Resets the underlying MDP only (*not* the task). """
         state = self.env.reset()
         if self.add_done_info:
-            state = np.concatenate((state, [0.0]))
+            state = self.add_done_flag(state, 0.0)
         self.done_mdp = False
         return state
 
@@ -183,7 +195,7 @@ class VariBadWrapper(gym.Wrapper):
         info['done_mdp'] = self.done_mdp
 
         if self.add_done_info:
-            state = np.concatenate((state, [float(self.done_mdp)]))
+            state = self.add_done_flag(state, float(self.done_mdp))
 
         self.step_count_bamdp += 1
         # if we want to maximise performance over multiple episodes,
@@ -9,6 +9,20 @@ from utils.helpers import RunningMeanStd
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
+def linear_scan(coefs, offsets):
+    """
+    Solves x[t] = coefs[t] * x[t - 1] + offsets[t] forwards in time for all t at once, in log2(T) vectorised steps.
+    Returns (x given x[-1] = 0, product of the coefs up to t): the solution for a given x[-1] is x[0] + x[1] * x[-1].
+    """
+    coefs, offsets = coefs.clone(), offsets.clone()
+    shift = 1
+    while shift < offsets.shape[0]:
+        offsets[shift:] = offsets[shift:] + coefs[shift:] * offsets[:-shift]
+        coefs[shift:] = coefs[shift:] * coefs[:-shift]
+        shift *= 2
+    return offsets, coefs
+
+
 class ExplorationBonus(object):
     def __init__(self,
                  args,
@@ -94,13 +108,35 @@ class ExplorationBonus(object):
             # discounted return for each environment
             self.ret_v = torch.zeros(size=(self.args.num_processes, 1)).to(device)
 
+    def update_return_normalisation(self, ret, ret_rms, intrinsic_rew, done):
+        """
+        Runs the discounted returns of every env (num_processes * 1) through a block of rewards (T * num_processes * 1),
+        updating the normaliser with the returns after every step and resetting them where done.
+        The returns of all steps come from one scan and their per-step moments are merged into a single update.
+        Returns the discounted returns after the block.
+        """
+        not_done = (done != 1).float().view(intrinsic_rew.shape)
+        coefs = self.gamma * torch.cat((torch.ones_like(not_done[:1]), not_done[:-1]))
+        returns, carry = linear_scan(coefs, intrinsic_rew)
+        returns = returns + carry * ret
+        # per step: mean / (unbiased) variance over the envs, as RunningMeanStd.update computes them
+        num_steps, batch_count = returns.shape[0], returns.shape[1]
+        step_mean = returns.mean(dim=1)
+        step_var = returns.var(dim=1)
+        # merging the steps one after the other (parallel algorithm) is the same as merging their union once
+        batch_mean = step_mean.mean(dim=0)
+        batch_var = (step_var + torch.pow(step_mean - batch_mean, 2)).mean(dim=0)
+        ret_rms.update_from_moments(batch_mean, batch_var, num_steps * batch_count)
+        return returns[-1] * not_done[-1]
+
     def initialise_storage(self):
 
         # initialise rollout storage for all experience
         return RolloutStorage(max_buffer_size=self.args.rnd_buffer_size,
                               env_state_shape=[self.dim_state],
                               action_shape=[self.dim_action],
-                              belief_shape=[self.dim_belief])
+                              belief_shape=[self.dim_belief],
+                              env_state_dtype=torch.uint8 if hasattr(self.args, 'compact_obs') and self.args.compact_obs else torch.float32)
 
     def add(self, states, beliefs, actions):
         # if we're using our own rolout storage (instead of a shared one with the VAE), add data
@@ -150,10 +186,7 @@ class ExplorationBonus(object):
                 intrinsic_rew_hyperstate = self.intrinsic_rew_hyperstate.reward(
                     inputs, update_normalisation=update_normalisation)
                 if update_normalisation and intrinsic_rew_hyperstate.shape[1] > 1:
-                    for i in range(intrinsic_rew_hyperstate.shape[0]):
-                        self.ret_hs = self.ret_hs * self.gamma + intrinsic_rew_hyperstate[i]
-                        self.ret_hs_rms.update(self.ret_hs)
-                        self.ret_hs[done[i] == 1] = 0.
+                    self.ret_hs = self.update_return_normalisation(self.ret_hs, self.ret_hs_rms, intrinsic_rew_hyperstate, done)
                 if normalise:
                     intrinsic_rew_hyperstate = intrinsic_rew_hyperstate / torch.sqrt(self.ret_hs_rms.var + self.epsilon)
                     if self.cliprew is not None:
@@ -167,10 +200,7 @@ class ExplorationBonus(object):
                 intrinsic_rew_state = self.intrinsic_rew_state.reward(inputs, update_normalisation=update_normalisation)
                 if normalise:
                     if update_normalisation and intrinsic_rew_state.shape[1] > 1:
-                        for i in range(intrinsic_rew_state.shape[0]):
-                            self.ret_s = self.ret_s * self.gamma + intrinsic_rew_state[i]
-                            self.ret_s_rms.update(self.ret_s)
-                            self.ret_s[done[i] == 1] = 0.
+                        self.ret_s = self.update_return_normalisation(self.ret_s, self.ret_s_rms, intrinsic_rew_state, done)
                     intrinsic_rew_state = intrinsic_rew_state / torch.sqrt(self.ret_s_rms.var + self.epsilon)
                     if self.cliprew is not None:
                         intrinsic_rew_state = torch.clamp(intrinsic_rew_state, -self.cliprew, self.cliprew)
@@ -185,10 +215,7 @@ class ExplorationBonus(object):
                     inputs, update_normalisation=update_normalisation)
                 if normalise:
                     if update_normalisation and intrinsic_rew_belief.shape[1] > 1:
-                        for i in range(intrinsic_rew_belief.shape[0]):
-                            self.ret_b = self.ret_b * self.gamma + intrinsic_rew_belief[i]
-                            self.ret_b_rms.update(self.ret_b)
-                            self.ret_b[done[i] == 1] = 0.
+                        self.ret_b = self.update_return_normalisation(self.ret_b, self.ret_b_rms, intrinsic_rew_belief, done)
                     intrinsic_rew_belief = intrinsic_rew_belief / torch.sqrt(self.ret_b_rms.var + self.epsilon)
                     if self.cliprew is not None:
                         intrinsic_rew_belief = torch.clamp(intrinsic_rew_belief, -self.cliprew, self.cliprew)
@@ -240,10 +267,7 @@ class ExplorationBonus(object):
                     intrinsic_vae_bonus = intrinsic_vae_bonus.squeeze(0)
                 if normalise:
                     if update_normalisation and intrinsic_vae_bonus.shape[1] > 1:
-                        for i in range(intrinsic_vae_bonus.shape[0]):
-                            self.ret_v = self.ret_v * self.gamma + intrinsic_vae_bonus[i]
-                            self.ret_v_rms.update(self.ret_v)
-                            self.ret_v[done[i] == 1] = 0.
+                        self.ret_v = self.update_return_normalisation(self.ret_v, self.ret_v_rms, intrinsic_vae_bonus, done)
                     intrinsic_vae_bonus = intrinsic_vae_bonus / torch.sqrt(self.ret_v_rms.var + self.epsilon)
                     if self.cliprew is not None:
                         intrinsic_vae_bonus = torch.clamp(intrinsic_vae_bonus, -self.cliprew, self.cliprew)
@@ -313,7 +337,7 @@ class ExplorationBonus(object):
         else:
             state = state.clone()
 
-        state = state.to(device)
+        state = state.to(device).float()
         if belief is not None:
             belief = belief.to(device)
 
@@ -5,13 +5,13 @@ device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
 class RolloutStorage(object):
-    def __init__(self, max_buffer_size, env_state_shape, belief_shape, action_shape):
+    def __init__(self, max_buffer_size, env_state_shape, belief_shape, action_shape, env_state_dtype=torch.float32):
 
         # count the number of datapoints seen so far (so we can do reservoir sampling)
         self.max_buffer_size = max_buffer_size
 
         # buffers for the data
-        self.env_states = torch.zeros((self.max_buffer_size, *env_state_shape))
+        self.env_states = torch.zeros((self.max_buffer_size, *env_state_shape), dtype=env_state_dtype)
         self.beliefs = torch.zeros((self.max_buffer_size, *belief_shape))
         self.actions = torch.zeros((self.max_buffer_size, *action_shape))
 
@@ -162,7 +162,7 @@ class DND(nn.Module):
         if self.use_hebb:
             self.saved_keys[self.exploration_step, torch.arange(self.exploration_batch_size), :] = torch.cat((state, task_inference_latent), dim=-1)
             self.saved_values[self.exploration_step, torch.arange(self.exploration_batch_size), :] = value
-        state = self.state_encoder(state)
+        state = self.state_encoder(state.float())
         key = self.concat_key_encoder(torch.cat((state, task_inference_latent), dim=-1)) # from memory.py
         key = self.key_encoder(key)
         value = self.concat_value_encoder(value) # from memory.py
@@ -177,7 +177,7 @@ class DND(nn.Module):
             raise NotImplementedError
 
     def read(self, state, task_inference_latent, activated_branch):
-        state = self.state_encoder(state)
+        state = self.state_encoder(state.float())
         query = self.concat_query_encoder(torch.cat((state, task_inference_latent), dim=-1)) # from memory.py
         if activated_branch == 'exploration':
             assert query.shape[0] == self.exploration_batch_size
@@ -194,28 +194,56 @@ class DND(nn.Module):
             raise NotImplementedError
 
         query = self.query_encoder(query).reshape(-1, self.num_head, self.key_size)
-        results = []
-        for i in range(batch_size):
-            key_ = keys[:step[i], i, :].clone() * RPE_read_modulation[:step[i], i, :]
-            query_ = query[i]
-            # 1 = b, n = 7 , m = 48 . b = 1, m = 48, p = 4 - > b * n * p
-            query_ = query_.permute(1, 0).unsqueeze(0)
-            key_ = key_.unsqueeze(0)
-            score = torch.bmm(key_, query_) / math.sqrt(self.key_size)
-            prob = F.softmax(score, dim=1)
-            tmp = prob.mean(-1).squeeze(0).unsqueeze(-1)
-            referenced_times[:step[i], i, :] += tmp
-            # b=1, n=4, m=7 . b=1 m=7 p=48 -> b*n*p
-            prob = prob.permute(0, 2, 1)
-            vals_ = vals[:step[i], i, :].clone().unsqueeze(0)
-            result = torch.bmm(prob, vals_)
-            result = self.value_aggregator(result.reshape(-1, self.num_head * self.value_size))
-            results.append(result)
+        # attend over all processes at once; slots at or after each process' step are masked out
+        # keys: b * n * m, query: b * m * p -> score: b * n * p
+        keys_ = (keys * RPE_read_modulation).permute(1, 0, 2)
+        vals_ = vals.permute(1, 0, 2)
+        valid = torch.arange(self.episode_len, device=step.device).unsqueeze(0) < step
+        score = torch.bmm(keys_, query.permute(0, 2, 1)) / math.sqrt(self.key_size)
+        score = score.masked_fill(~valid.unsqueeze(-1), float('-inf'))
+        prob = F.softmax(score, dim=1)
+        referenced_times += prob.mean(-1).permute(1, 0).unsqueeze(-1)
+        # b * p * n . b * n * v -> b * p * v
+        results = torch.bmm(prob.permute(0, 2, 1), vals_)
+        results = self.value_aggregator(results.reshape(batch_size, self.num_head * self.value_size))
         if activated_branch == 'exploration':
             self.exploration_referenced_times = referenced_times
         if activated_branch == 'exploitation':
             self.exploitation_referenced_times = referenced_times
-        results = torch.cat(results, dim=0).unsqueeze(1)
+        results = results.unsqueeze(1)
+        k = self.read_memory_to_key(results)
+        v = self.read_memory_to_value(results)
+        return k, v
+
+    def encode(self, state, task_inference_latent, value):
+        """ The keys and values `write` would store, for inputs of any leading shape """
+        state = self.state_encoder(state.float())
+        key = self.key_encoder(self.concat_key_encoder(torch.cat((state, task_inference_latent), dim=-1)))
+        value = self.value_encoder(self.concat_value_encoder(value))
+        return key, value
+
+    def read_batch(self, state, task_inference_latent, keys, vals, visible):
+        """
+        Runs `read` for a whole sequence of queries in one call, with the memory contents given explicitly
+        (teacher forcing) instead of taken from the slots.
+        state, task_inference_latent: T_q * b * ., keys, vals: T_k * b * . (see `encode`),
+        visible: T_q * T_k * b, the keys each query attends to.
+        As in `read`, if some process has no visible key for a query, that query reads zeros for all processes.
+        """
+        state = self.state_encoder(state.float())
+        query = self.concat_query_encoder(torch.cat((state, task_inference_latent), dim=-1))
+        query = self.query_encoder(query).reshape(query.shape[0], query.shape[1], self.num_head, self.key_size)
+        # T_q * b * p * T_k
+        score = torch.einsum('qbpm,kbm->qbpk', query, keys) / math.sqrt(self.key_size)
+        visible = visible.permute(0, 2, 1).unsqueeze(2)
+        empty = ~visible.any(-1, keepdim=True)
+        # queries without any visible key attend uniformly (instead of producing NaNs) and are zeroed below
+        score = score.masked_fill(~(visible | empty), float('-inf'))
+        prob = F.softmax(score, dim=-1)
+        results = torch.einsum('qbpk,kbv->qbpv', prob, vals)
+        results = self.value_aggregator(results.reshape(results.shape[0], results.shape[1], self.num_head * self.value_size))
+        results = results.masked_fill(empty.view(empty.shape[0], -1).any(-1).view(-1, 1, 1), 0)
+        results = results.unsqueeze(2)
         k = self.read_memory_to_key(results)
         v = self.read_memory_to_value(results)
         return k, v
@@ -228,44 +256,43 @@ class DND(nn.Module):
             RPE_read_modulation = self.exploration_RPE_read_modulation
         else:
             raise NotImplementedError
-        times = torch.range(1, self.episode_len).flip(dims=[-1]).unsqueeze(-1).unsqueeze(-1).expand(size=referenced_times.size()).to(device)
-        referenced_times = referenced_times / times
-        done_process_mdp = done_process_mdp.view(done_process_mdp.shape[0])
-        idx = []
-        idx_base = 0
-        done_process_mdp_ = done_process_mdp.nonzero(as_tuple=True)[0]
-
-        for i in range(len(done_process_mdp_)):
-            _, idx_tmp = torch.topk(referenced_times[:, done_process_mdp_[i].item(), :].view(-1), dim=-1, k=(self.episode_len // 2))
-            idx.append(idx_tmp + idx_base)
-            idx_base += self.episode_len
-
-        idx = torch.cat(idx, dim=-1)
-        tmp_keys = keys[:, done_process_mdp.nonzero(as_tuple=True)[0], :]
-        ret_keys = tmp_keys.view(-1, self.key_size - self.memory_state_embedding + self.state_dim)[idx].view(len(done_process_mdp_), self.episode_len//2, -1)
-        tmp_values = vals[:, done_process_mdp.nonzero(as_tuple=True)[0], :]
-        ret_values = tmp_values.view(-1, self.value_size)[idx].view(len(done_process_mdp_), self.episode_len//2, -1)
-        tmp_RPE = RPE_read_modulation[:, done_process_mdp.nonzero(as_tuple=True)[0], :]
-        ret_RPE = tmp_RPE.view(-1, 1)[idx].view(len(done_process_mdp_), self.episode_len//2, -1)
+        times = torch.arange(self.episode_len, 0, -1, device=referenced_times.device, dtype=referenced_times.dtype)
+        referenced_times = referenced_times.squeeze(-1) / times.unsqueeze(-1)
+        done_process_mdp_ = done_process_mdp.view(-1).nonzero(as_tuple=True)[0]
+        # the episode_len // 2 most referenced slots of every finished process: (episode_len // 2) * n_done
+        _, idx = torch.topk(referenced_times[:, done_process_mdp_], dim=0, k=(self.episode_len // 2))
+        # one gather per tensor -> n_done * (episode_len // 2) * .
+        ret_keys = keys[idx, done_process_mdp_].transpose(0, 1)
+        ret_values = vals[idx, done_process_mdp_].transpose(0, 1)
+        ret_RPE = RPE_read_modulation[idx, done_process_mdp_].transpose(0, 1)
 
         ret_state = ret_keys[:, :, :self.state_dim].detach()
         ret_task_inf_latent = ret_keys[:, :, self.state_dim:].detach()
 
         return ret_state, ret_task_inf_latent, ret_values.detach(), ret_RPE.detach()
 
-    def compute_intrinsic_reward(self, state, task_inf_latent):
-        state = self.state_encoder(state)
+    def compute_intrinsic_reward(self, state, task_inf_latent, num_neighbours=1):
+        """
+        Episodic novelty of the query w.r.t. the keys written so far in the current episode of every process:
+        distance to the nearest key (num_neighbours=1) or mean distance to the k nearest keys (as in NGU).
+        """
+        state = self.state_encoder(state.float())
         memory_key = self.concat_key_encoder(torch.cat((state, task_inf_latent), dim=-1))
         if len(self.exploration_step.nonzero(as_tuple=True)[0]) < self.exploration_batch_size:
             return torch.zeros((self.exploration_batch_size, 1), device=device)
         query = self.key_encoder(memory_key)
         keys = self.exploration_keys
         step = self.exploration_step
-        batch_size = self.exploration_batch_size
-        results = []
-        for i in range(batch_size):
-            key_ = keys[:step[i], i, :].clone()
-            intrinsic_reward = torch.min(torch.sqrt(torch.sum((query[i] - key_)**2, dim=-1)))
-            results.append(intrinsic_reward)
-        results = torch.stack(results).unsqueeze(-1)
-        return results
\ No newline at end of file
+        # distance of every process' query to all of its slots: episode_len * batch
+        distance = torch.sqrt(torch.sum((keys - query.unsqueeze(0)) ** 2, dim=-1))
+        valid = torch.arange(self.episode_len, device=step.device).unsqueeze(-1) < step.view(1, -1)
+        distance = distance.masked_fill(~valid, float('inf'))
+        if num_neighbours == 1:
+            results = torch.min(distance, dim=0)[0]
+        else:
+            num_neighbours = min(num_neighbours, self.episode_len)
+            nearest = torch.topk(distance, k=num_neighbours, dim=0, largest=False)[0]
+            # processes with fewer than k written slots average over the ones they have
+            found = torch.arange(num_neighbours, device=step.device).unsqueeze(-1) < step.view(1, -1)
+            results = torch.where(found, nearest, torch.zeros_like(nearest)).sum(dim=0) / found.sum(dim=0)
+        return results.unsqueeze(-1)
@@ -1,5 +1,3 @@
-from copy import deepcopy
-
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -20,17 +18,11 @@ class EWC(object):
         self.dataloader = dataloader
 
         self.params = {n: p for n, p in self.model.named_parameters() if p.requires_grad}
-        self._means = {}
         self._precision_matrices = self._diag_fisher()
-
-        for n, p in deepcopy(self.params).items():
-            self._means[n] = variable(p.data)
+        self._means = {n: p.detach().clone() for n, p in self.params.items()}
 
     def _diag_fisher(self):
-        precision_matrices = {}
-        for n, p in deepcopy(self.params).items():
-            p.data.zero_()
-            precision_matrices[n] = variable(p.data)
+        precision_matrices = {n: torch.zeros_like(p) for n, p in self.params.items()}
 
         self.model.eval()
         for brim_hidden, state in self.dataloader:
@@ -94,6 +86,54 @@ class EWC(object):
         return epoch_loss / len(data_loader)
 
 
+class OnlineEWC(object):
+    """
+    Online EWC (Schwarz et al., 2018): keeps one running diagonal Fisher and one set of anchor parameters per model.
+    After every write, update() decays the Fisher, adds the Fisher of the new data and moves the anchor to the current
+    parameters, so the consolidation cost depends on the size of one write, not on the number of past writes.
+    """
+
+    def __init__(self, model: nn.Module, gamma: float = 0.9):
+        try:
+            import torch.func
+        except ImportError:
+            # fail when the memory is built, not at the first write
+            raise ImportError('online EWC needs torch.func (torch >= 2.0), but torch {} is installed: '
+                              'set --gen_memory_online_ewc False'.format(torch.__version__))
+        self.model = model
+        self.gamma = gamma
+        self.params = {n: p for n, p in self.model.named_parameters() if p.requires_grad}
+        self._means = {n: p.detach().clone() for n, p in self.params.items()}
+        self._precision_matrices = {n: torch.zeros_like(p) for n, p in self.params.items()}
+
+    def _diag_fisher(self, brim_hidden, state):
+        """ Mean squared per-sample gradient of the loss, with all per-sample gradients from one vmap(grad) call """
+        from torch.func import functional_call, grad, vmap
+
+        params = {n: p.detach() for n, p in self.params.items()}
+
+        def sample_loss(params, brim_hidden, state):
+            brim_hidden, state = brim_hidden.unsqueeze(0), state.unsqueeze(0)
+            output = functional_call(self.model, params, (brim_hidden, state))
+            return self.model.loss(brim_hidden, output[0], output[1], output[2])
+
+        grads = vmap(grad(sample_loss), in_dims=(None, 0, 0), randomness='different')(params, brim_hidden, state)
+        return {n: g.pow(2).mean(0) for n, g in grads.items()}
+
+    def update(self, brim_hidden, state):
+        fisher = self._diag_fisher(variable(brim_hidden), variable(state))
+        for n, p in self.params.items():
+            self._precision_matrices[n].mul_(self.gamma).add_(fisher[n])
+            self._means[n].copy_(p.detach())
+
+    def penalty(self, model: nn.Module):
+        loss = 0
+        for n, p in model.named_parameters():
+            _loss = self._precision_matrices[n] * (p - self._means[n]) ** 2
+            loss += _loss.sum()
+        return loss
+
+
 def test(model: nn.Module, data_loader: torch.utils.data.DataLoader):
     model.eval()
     correct = 0
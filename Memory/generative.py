@@ -2,128 +2,138 @@ import torch.nn as nn
 import torch
 from torch import optim
 from memory.cvae import cVAE
-from memory.ewc import EWC
+from memory.ewc import EWC, OnlineEWC
 from memory.sequentional_kmeans import Kmeans
-from torch.utils.data import Dataset
-from torch.utils.data import DataLoader
-import random
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
-class GenerativeDataset(Dataset):
-    def __init__(self, dataset_key, dataset_value):
-        super(GenerativeDataset, self).__init__()
-        self.state_embedding = dataset_key
-        self.brim_hidden_state = dataset_value
+class ReplayBuffer(object):
+    """ Ring buffer with the last `capacity` (state embedding, brim hidden state) pairs written to a cVAE """
 
-    def __getitem__(self, item):
-        x1 = self.brim_hidden_state[item]
-        x2 = self.state_embedding[item]
-        return (x1, x2)
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.states = self.brim_hidden = None
+        self.insert_idx = 0
+        self.size = 0
 
     def __len__(self):
-        return len(self.brim_hidden_state)
+        return self.size
 
+    def add(self, states, brim_hidden):
+        states, brim_hidden = states.detach()[-self.capacity:], brim_hidden.detach()[-self.capacity:]
+        if self.states is None:
+            self.states = torch.zeros((self.capacity,) + states.shape[1:], device=device)
+            self.brim_hidden = torch.zeros((self.capacity,) + brim_hidden.shape[1:], device=device)
+        idx = (self.insert_idx + torch.arange(states.shape[0], device=device)) % self.capacity
+        self.states[idx] = states.to(device)
+        self.brim_hidden[idx] = brim_hidden.to(device)
+        self.insert_idx = (self.insert_idx + states.shape[0]) % self.capacity
+        self.size = min(self.size + states.shape[0], self.capacity)
 
-def create_train_loader(train_dataset_key, train_dataset_value):
-    dataset = GenerativeDataset(dataset_key=train_dataset_key, dataset_value=train_dataset_value)
-    dataloader = DataLoader(dataset, batch_size=4,
-                            shuffle=True, num_workers=0)
-    return dataloader
+    def sample(self, batch_size):
+        idx = torch.randint(0, self.size, size=(batch_size,), device=device)
+        return self.states[idx], self.brim_hidden[idx]
+
+
+def minibatches(num_samples, batch_size):
+    """ Shuffled index batches covering 0..num_samples-1 once """
+    return torch.randperm(num_samples, device=device).split(batch_size)
 
 
 class Generative(object):
-    def __init__(self, args, num_head):
+    def __init__(self, args, num_head, batch_size=None, online_ewc=None, ewc_gamma=None):
         super(Generative, self).__init__()
         self.args = args
         self.old_task_size_thr = 1000
         self.num_head = num_head
         self.gene_models = nn.ModuleList([])
-        self.optimizers = []
         self.importance = 0.5
         self.old_task_sample_size = 128
+        # the Fisher information of the old tasks is estimated on batches of this size
+        self.fisher_batch_size = 4
+        if batch_size is None:
+            batch_size = self.args.gen_memory_batch_size if hasattr(self.args, 'gen_memory_batch_size') else 256
+        self.batch_size = batch_size
+        if online_ewc is None:
+            online_ewc = self.args.gen_memory_online_ewc if hasattr(self.args, 'gen_memory_online_ewc') else False
+        if ewc_gamma is None:
+            ewc_gamma = self.args.gen_memory_ewc_gamma if hasattr(self.args, 'gen_memory_ewc_gamma') else 0.9
         self.lr = 0.00001
         self.kmeans = Kmeans(self.args)
 
         for i in range(3):
             gen_model = cVAE(obs_dim=self.args.state_embedding_size, brim_hidden_dim=2*self.args.brim_hidden_size[0]).to(device)
             self.gene_models.append(gen_model)
-            self.optimizers.append(optim.Adam(params=gen_model.parameters(), lr=self.lr))
+        # one optimizer per cVAE: only the cVAEs that get a batch are stepped, so the Adam momentum of the others
+        # does not keep moving them
+        self.optimizers = [optim.Adam(params=model.parameters(), lr=self.lr) for model in self.gene_models]
 
-        self.old_task_sample = [[[], []], [[], []], [[], []]]
+        self.old_task_sample = [ReplayBuffer(self.old_task_size_thr) for _ in range(len(self.gene_models))]
+        # online EWC: one running Fisher per cVAE, instead of a new EWC estimated on old samples at every write
+        self.online_ewc = [OnlineEWC(model, gamma=ewc_gamma) for model in self.gene_models] if online_ewc else None
 
     def write(self, train_data, task_inference_id):
         self.kmeans.add_point(task_inference_id)
         clusters = self.kmeans.get_cluster(task_inference_id)
-        cvae0_idx = ((clusters == 0).nonzero(as_tuple=True)[0])
-        cvae1_idx = ((clusters == 1).nonzero(as_tuple=True)[0])
-        cvae2_idx = ((clusters == 2).nonzero(as_tuple=True)[0])
-        cva_dataset = []
-
-        if not (cvae0_idx.shape[0] == 0):
-            tmp1 = torch.cat([train_data[0][i] for i in cvae0_idx])
-            tmp2 = torch.cat([train_data[1][i] for i in cvae0_idx])
-            cva_dataset.append(create_train_loader(tmp1, tmp2))
-        else:
-            cva_dataset.append(None)
+        states = train_data[0] if torch.is_tensor(train_data[0]) else torch.stack(train_data[0])
+        brim_hidden = train_data[1] if torch.is_tensor(train_data[1]) else torch.stack(train_data[1])
 
-        if not (cvae1_idx.shape[0] == 0):
-            tmp3 = torch.cat([train_data[0][i] for i in cvae1_idx])
-            tmp4 = torch.cat([train_data[1][i] for i in cvae1_idx])
-            cva_dataset.append(create_train_loader(tmp3, tmp4))
-        else:
-            cva_dataset.append(None)
-
-        if not (cvae2_idx.shape[0] == 0):
-            tmp5 = torch.cat([train_data[0][i] for i in cvae2_idx])
-            tmp6 = torch.cat([train_data[1][i] for i in cvae2_idx])
-            cva_dataset.append(create_train_loader(tmp5, tmp6))
+        new_data = []
+        for j in range(len(self.gene_models)):
+            cvae_idx = (clusters == j).nonzero(as_tuple=True)[0]
+            if cvae_idx.shape[0] == 0:
+                new_data.append(None)
+                continue
+            new_data.append((states[cvae_idx].reshape(-1, states.shape[-1]).to(device),
+                             brim_hidden[cvae_idx].reshape(-1, brim_hidden.shape[-1]).to(device)))
+
+        models = [j for j in range(len(self.gene_models)) if new_data[j] is not None and self.gene_models[j].training]
+        if self.online_ewc is not None:
+            ewcs = {j: self.online_ewc[j] for j in models}
         else:
-            cva_dataset.append(None)
+            ewcs = {j: EWC(self.gene_models[j], self.get_sample_data_from_old_task(self.old_task_sample[j]))
+                    for j in models if len(self.old_task_sample[j]) > 0}
+        for _ in range(self.args.num_epoch_for_gen_memory):
+            self.train_epoch([new_data[j] for j in models], [self.gene_models[j] for j in models],
+                             [self.optimizers[j] for j in models], [ewcs.get(j) for j in models])
+        if self.online_ewc is not None:
+            # consolidate what was just learned, on at most old_task_sample_size samples of the write
+            for j in models:
+                states, brim_hidden = new_data[j]
+                idx = torch.randperm(states.shape[0], device=device)[:self.old_task_sample_size]
+                self.online_ewc[j].update(brim_hidden[idx], states[idx])
 
         for j in range(len(self.gene_models)):
-            if (cva_dataset[j] is not None) and self.gene_models[j].training:
-                if len(self.old_task_sample[j][0]) == 0:
-                    for _ in range(self.args.num_epoch_for_gen_memory):
-                        EWC.normal_train(self.gene_models[j], self.optimizers[j], cva_dataset[j])
-                else:
-                    old_tasks_dataset = self.get_sample_data_from_old_task(self.old_task_sample[j])
-                    for _ in range(self.args.num_epoch_for_gen_memory):
-                            EWC.ewc_train(self.gene_models[j], self.optimizers[j], cva_dataset[j], EWC(self.gene_models[j], old_tasks_dataset), self.importance)
-
-        if len(self.old_task_sample[0][0]) > self.old_task_size_thr:
-            self.old_task_sample[0][0] = []
-            self.old_task_sample[0][1] = []
-
-        if len(self.old_task_sample[1][0]) > self.old_task_size_thr:
-            self.old_task_sample[1][0] = []
-            self.old_task_sample[1][1] = []
-
-        if len(self.old_task_sample[2][0]) > self.old_task_size_thr:
-            self.old_task_sample[2][0] = []
-            self.old_task_sample[2][1] = []
-
-        if self.kmeans.dataset.shape[0] > self.old_task_size_thr:
-            self.kmeans = Kmeans(self.args)
-
-        if not (cvae0_idx.shape[0] == 0):
-            self.old_task_sample[0][0].extend(list(tmp1))
-            self.old_task_sample[0][1].extend(list(tmp2))
-
-        if not (cvae1_idx.shape[0] == 0):
-            self.old_task_sample[1][0].extend(list(tmp3))
-            self.old_task_sample[1][1].extend(list(tmp4))
-
-        if not (cvae2_idx.shape[0] == 0):
-            self.old_task_sample[2][0].extend(list(tmp5))
-            self.old_task_sample[2][1].extend(list(tmp6))
+            if new_data[j] is not None:
+                self.old_task_sample[j].add(*new_data[j])
+
+    def train_epoch(self, data, models, optimizers, ewcs):
+        """
+        One epoch over the new data of each model, with all models trained in lockstep: in every step the losses of
+        the models that still have batches left are summed and backpropagated once, and only their optimizers step.
+        """
+        for model in models:
+            model.train()
+        batches = [minibatches(states.shape[0], self.batch_size) for states, _ in data]
+        for step in range(max([len(b) for b in batches], default=0)):
+            loss, stepped = 0, []
+            for model, (states, brim_hidden), model_batches, optimizer, ewc in zip(models, data, batches, optimizers, ewcs):
+                if step >= len(model_batches):
+                    continue
+                optimizer.zero_grad()
+                idx = model_batches[step]
+                output = model(brim_hidden[idx], states[idx])
+                loss = loss + model.loss(brim_hidden[idx], output[0], output[1], output[2])
+                if ewc is not None:
+                    loss = loss + self.importance * ewc.penalty(model)
+                stepped.append(optimizer)
+            loss.backward()
+            for optimizer in stepped:
+                optimizer.step()
 
     def get_sample_data_from_old_task(self, dataset):
-        idx = torch.randint(0, len(dataset[0]), size=(self.old_task_sample_size,)).long()
-        brim_old_task = torch.stack(dataset[0])[idx]
-        state_old_task = torch.stack(dataset[1])[idx]
-        dataloader = create_train_loader(brim_old_task, state_old_task)
-        return dataloader
+        states, brim_hidden = dataset.sample(self.old_task_sample_size)
+        return list(zip(brim_hidden.split(self.fisher_batch_size), states.split(self.fisher_batch_size)))
 
     def read(self, task_id, obs_embdd):
         cluster_idx = self.kmeans.get_cluster(task_id)
@@ -13,6 +13,8 @@ class Hebbian(nn.Module):
                  memory_state_embedding,
                  read_memory_to_key_layer,
                  read_memory_to_value_layer,
+                 consolidation_iterations=4,
+                 consolidation_tol=None,
                  ):
         super(Hebbian, self).__init__()
         num_head = 1
@@ -22,6 +24,9 @@ class Hebbian(nn.Module):
         self.value_size = value_size
         self.w_max = w_max
         self.rim_query_size = rim_query_size
+        # number of Hebbian updates per write, and (optionally) stop early once the largest weight change is below tol
+        self.consolidation_iterations = consolidation_iterations
+        self.consolidation_tol = consolidation_tol
 
         self.normalize_key = utl.RunningMeanStd(shape=(self.key_size))
         self.normalize_value = utl.RunningMeanStd(shape=(self.value_size))
@@ -126,7 +131,7 @@ class Hebbian(nn.Module):
             raise NotImplementedError
 
     def write(self, state, task_inference_latent, value, modulation, done_process_mdp, activated_branch, A, B): 
-        state = self.state_encoder(state)
+        state = self.state_encoder(state.float())
         key = self.key_encoder(torch.cat((state, task_inference_latent), dim=-1))
         value = self.value_encoder(value)
         done_process_mdp = done_process_mdp.view(-1).nonzero(as_tuple=True)[0]
@@ -144,18 +149,36 @@ class Hebbian(nn.Module):
         if activated_branch == 'exploration':
             A = A.expand(batch_size, -1, -1)
             B = B.expand(batch_size, -1, -1)
-            for i in range(4):
-                a1 = torch.bmm(A, (self.w_max - self.exploration_w_assoc[done_process_mdp].clone()).permute(0, 2, 1))
-                a2 = torch.bmm(a1, correlation)
-                a3 = torch.bmm(B, self.exploration_w_assoc[done_process_mdp].clone().permute(0, 2, 1))
-                a4 = torch.bmm(a3, regularization).permute(0, 2, 1)
-                delta_w = a2 - a4
-                self.exploration_w_assoc[done_process_mdp] = self.exploration_w_assoc[done_process_mdp].clone() + self.learning_rate * delta_w
+            # gather the weights of the finished processes once, update them as one block and scatter them back once
+            w_assoc = self.consolidate(self.exploration_w_assoc[done_process_mdp], correlation, regularization, A, B)
+            self.exploration_w_assoc[done_process_mdp] = w_assoc
         else:
             raise NotImplementedError
 
+    def consolidate(self, w_assoc, correlation, regularization, A, B):
+        """
+        Runs the Hebbian updates on a (gathered) block of association matrices.
+        The block is updated in place, unless gradients have to flow back through it (to the meta-parameters A and B
+        or to the encoders that produced correlation / regularization).
+        """
+        in_place = not (torch.is_grad_enabled() and any(
+            x.requires_grad for x in (w_assoc, correlation, regularization, A, B)))
+        for i in range(self.consolidation_iterations):
+            a1 = torch.bmm(A, (self.w_max - w_assoc).permute(0, 2, 1))
+            a2 = torch.bmm(a1, correlation)
+            a3 = torch.bmm(B, w_assoc.permute(0, 2, 1))
+            a4 = torch.bmm(a3, regularization).permute(0, 2, 1)
+            delta_w = self.learning_rate * (a2 - a4)
+            if in_place:
+                w_assoc.add_(delta_w)
+            else:
+                w_assoc = w_assoc + delta_w
+            if self.consolidation_tol is not None and delta_w.abs().max() < self.consolidation_tol:
+                break
+        return w_assoc
+
     def read(self, state, task_inference_latent, activated_branch):
-        state = self.state_encoder(state)
+        state = self.state_encoder(state.float())
         query = self.concat_query_encoder(torch.cat((state, task_inference_latent), dim=-1))  # from memory.py
         query = F.relu(self.query_encoder(query).reshape(-1, self.num_head, self.key_size))
         if activated_branch == 'exploration':
@@ -184,6 +184,28 @@ class Hippocampus(nn.Module):
         ans = self.read_mha(query=q.unsqueeze(1), key=k, value=v)[0].squeeze(1)
         return ans
 
+    def encode(self, key, value):
+        """ Episodic keys and values of a whole sequence (T * b * .) of writes """
+        state, task_inf_latent = key
+        return self.episodic.encode(state, task_inf_latent, value.detach())
+
+    def read_batch(self, query, rim_hidden_state, memory, visible):
+        """
+        `read` for a whole sequence of queries (T * b * .) against the episodic keys and values in `memory`
+        (see `encode`); visible (T * T_k * b) masks the keys each query attends to.
+        Only the episodic memory is read, the Hebbian consolidation at episode ends cannot be batched this way.
+        """
+        state, task_inference_latent = query
+        task_inference_latent = task_inference_latent.detach()
+        epi_k, epi_v = self.episodic.read_batch(state, task_inference_latent, memory[0], memory[1], visible)
+
+        q = self.rim_hidden_to_query(rim_hidden_state)
+        seq_len, batch_size = q.shape[:2]
+        ans = self.read_mha(query=q.reshape(seq_len * batch_size, 1, -1),
+                            key=epi_k.reshape(seq_len * batch_size, 1, -1),
+                            value=epi_v.reshape(seq_len * batch_size, 1, -1))[0]
+        return ans.reshape(seq_len, batch_size, -1)
+
     def write(self, key, value, rpe, activated_branch):
         state, task_inf_latent = key
         value = value.detach().clone()
@@ -210,5 +232,5 @@ class Hippocampus(nn.Module):
                                    B=B)
             self.episodic.reset(done_task=done_task, done_process_mdp=done_episode, activated_branch=activated_branch)
 
-    def compute_intrinsic_reward(self, state, task_inf_latent):
-        return self.episodic.compute_intrinsic_reward(state, task_inf_latent)
+    def compute_intrinsic_reward(self, state, task_inf_latent, num_neighbours=1):
+        return self.episodic.compute_intrinsic_reward(state, task_inf_latent, num_neighbours=num_neighbours)
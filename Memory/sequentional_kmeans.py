@@ -1,40 +1,55 @@
 import torch
-import numpy as np
-import random
-import sys
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 class Kmeans():
+    """
+    Streaming k-means over the task inference ids.
+    The ids are kept in a preallocated ring buffer of the last kmeans_buffer_size ids, the centers are seeded with
+    k-means++ and then refined with mini-batch updates (Sculley, 2010) on every add_point, so the cost of an update
+    does not grow with the number of tasks seen.
+    """
 
-    def __init__(self, args):
+    def __init__(self, args, batch_size=None, max_iters=None, tol=None):
         self.args = args
-        self.dataset = torch.zeros(size=(self.args.kmeans_buffer_size, 2*self.args.latent_dim), device=device)
+        if batch_size is None:
+            batch_size = self.args.kmeans_batch_size if hasattr(self.args, 'kmeans_batch_size') else 256
+        if max_iters is None:
+            max_iters = self.args.kmeans_max_iters if hasattr(self.args, 'kmeans_max_iters') else 20
+        if tol is None:
+            tol = self.args.kmeans_tol if hasattr(self.args, 'kmeans_tol') else 1e-4
+        self.buffer_size = self.args.kmeans_buffer_size
+        self.dataset = torch.zeros(size=(self.buffer_size, 2*self.args.latent_dim), device=device)
         self.num_centers = self.args.kmeans_num_cluster
         self.num_task = 0
-        self.centers = self.random_init()
+        # ring buffer bookkeeping: next slot to write and number of valid points
+        self.insert_idx = 0
+        self.size = 0
+        # mini-batch size, and stop once no center moves more than tol (or after max_iters mini-batches)
+        self.batch_size = batch_size
+        self.max_iters = max_iters
+        self.tol = tol
+        self.centers = None
+        # number of points assigned to each center, every point counted once when it is added and the total capped
+        # at the buffer size (points that left the buffer are forgotten): the weight of a center against a mini-batch
+        self.counts = torch.zeros(self.num_centers, device=device)
 
-    def random_init(self):
-        num_points = self.dataset.size(0)
-        dimension = self.dataset.size(1)
-        used = torch.zeros(num_points, dtype=torch.long, device=device)
-        indices = torch.zeros(self.num_centers, dtype=torch.long, device=device)
-        for i in range(self.num_centers):
-            while True:
-                cur_id = random.randint(0, num_points - 1)
-                if used[cur_id] > 0:
-                    continue
-                used[cur_id] = 1
-                indices[i] = cur_id
-                break
-        indices = indices.to(device)
-        centers = torch.gather(self.dataset, 0, indices.view(-1, 1).expand(-1, dimension))
+    def kmeans_pp_init(self):
+        """ k-means++ seeding on the points in the buffer """
+        dataset = self.dataset[:self.size]
+        centers = torch.zeros(self.num_centers, dataset.size(1), device=device)
+        centers[0] = dataset[torch.randint(0, self.size, size=(1,), device=device)]
+        min_distances = torch.sum((dataset - centers[0]) ** 2, dim=1)
+        for i in range(1, self.num_centers):
+            # sample proportionally to the squared distance to the closest center (uniformly if all points are covered)
+            cur_id = torch.multinomial(min_distances + 1e-12, 1)
+            centers[i] = dataset[cur_id]
+            min_distances = torch.min(min_distances, torch.sum((dataset - centers[i]) ** 2, dim=1))
         return centers
 
     def compute_codes(self, dataset):
         num_points = dataset.size(0)
-        dimension = dataset.size(1)
         num_centers = self.centers.size(0)
-        chunk_size = int(5e8 / num_centers)
+        chunk_size = max(1, int(5e8 / num_centers))
         codes = torch.zeros(num_points, dtype=torch.long, device=device)
         centers_t = torch.transpose(self.centers, 0, 1)
         centers_norms = torch.sum(self.centers ** 2, dim=1).view(1, -1)
@@ -52,39 +67,44 @@ class Kmeans():
             codes[begin:end] = min_ind
         return codes
 
-    def update_centers(self, codes):
-        num_points = self.dataset.size(0)
-        dimension = self.dataset.size(1)
-        centers = torch.zeros(self.num_centers, dimension, dtype=torch.float, device=device)
-        cnt = torch.zeros(self.num_centers, dtype=torch.float, device=device)
-        centers.scatter_add_(0, codes.view(-1, 1).expand(-1, dimension), self.dataset)
-        cnt.scatter_add_(0, codes, torch.ones(num_points, dtype=torch.float, device=device))
-        cnt = torch.where(cnt > 0.5, cnt, torch.ones(self.num_centers, dtype=torch.float, device=device))
-        centers /= cnt.view(-1, 1)
-        return centers
+    def update_centers(self, batch):
+        """ One mini-batch step, returns how far each center moved """
+        codes = self.compute_codes(batch)
+        batch_counts = torch.bincount(codes, minlength=self.num_centers).float()
+        sums = torch.zeros_like(self.centers).index_add_(0, codes, batch)
+        # weighted average of the center (with the weight of its points) and of its points in the batch; the
+        # resampled points are not counted again, so the centers keep following the points in the buffer
+        lr = batch_counts / (self.counts + batch_counts).clamp(min=1)
+        shift = lr.view(-1, 1) * (sums / batch_counts.clamp(min=1).view(-1, 1) - self.centers)
+        self.centers += shift
+        return shift.norm(dim=1)
 
     def cluster(self):
-        self.centers = self.random_init()
-        codes = self.compute_codes(self.dataset)
-        num_iterations = 0
-        while True:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            num_iterations += 1
-            self.centers = self.update_centers(codes)
-            new_codes = self.compute_codes(self.dataset)
-
-            if torch.equal(codes, new_codes):
+        for _ in range(self.max_iters):
+            batch_idx = torch.randint(0, self.size, size=(min(self.batch_size, self.size),), device=device)
+            shift = self.update_centers(self.dataset[batch_idx])
+            if shift.max() < self.tol:
                 break
-
-            codes = new_codes
-        return self.centers, codes
+        return self.centers
 
     def add_point(self, new_point):
-        self.dataset = torch.cat((self.dataset, new_point))
-        self.random_init()
-        self.cluster()
         self.num_task += new_point.shape[0]
+        new_point = new_point.detach()[-self.buffer_size:]
+        num_points = new_point.shape[0]
+        idx = (self.insert_idx + torch.arange(num_points, device=device)) % self.buffer_size
+        self.dataset[idx] = new_point.to(self.dataset.dtype)
+        self.insert_idx = (self.insert_idx + num_points) % self.buffer_size
+        self.size = min(self.size + num_points, self.buffer_size)
+        added = self.dataset[idx]
+        # re-seed until there are enough points for distinct centers, afterwards only refine
+        if self.centers is None or self.size <= self.num_centers:
+            self.centers = self.kmeans_pp_init()
+            self.counts.zero_()
+            added = self.dataset[:self.size]
+        self.counts += torch.bincount(self.compute_codes(added), minlength=self.num_centers).float()
+        if self.counts.sum() > self.buffer_size:
+            self.counts *= self.buffer_size / self.counts.sum()
+        self.cluster()
 
     def get_cluster(self, dataset):
         if self.num_task > 0:
@@ -93,5 +113,3 @@ class Kmeans():
             codes = None
 
         return codes
-
-
@@ -320,13 +320,17 @@ class RewardDecoder(nn.Module):
         #     h = latent_state.clone()
         # else:
 
-        hns = self.state_encoder(next_state)
+        if self.input_prev_state and self.state_encoder.output_size != 0:
+            # both states go through the same encoder, embed them in one call
+            hns, hps = self.state_encoder(torch.stack((next_state, prev_state))).unbind(0)
+        else:
+            hns = self.state_encoder(next_state)
+            hps = self.state_encoder(prev_state) if self.input_prev_state else None
         h = torch.cat((latent_state, hns), dim=-1)
         if self.input_action:
             ha = self.action_encoder(action)
             h = torch.cat((h, ha), dim=-1)
         if self.input_prev_state:
-            hps = self.state_encoder(prev_state)
             h = torch.cat((h, hps), dim=-1)
 
         for i in range(len(self.fc_layers)):
@@ -39,11 +39,6 @@ def evaluate(args,
     if num_episodes is None:
         num_episodes = args.max_rollouts_per_task
 
-    if args.bebold_intrinsic_reward:
-        episode_state_count_dict = list()
-        for i in range(args.num_processes):
-            episode_state_count_dict.append({})
-
     if policy_type == 'exploration':
         num_processes = int(args.num_processes * args.exploration_processes_portion)
 
@@ -69,11 +64,14 @@ def evaluate(args,
                          normalise_rew=args.norm_rew_for_policy, ret_rms=ret_rms)
     num_steps = envs._max_episode_steps
 
+    if args.bebold_intrinsic_reward:
+        episode_state_counts = utl.EpisodeStateCounts(num_processes, num_steps * num_episodes + 1)
+
     # reset environments
     state, belief, task = utl.reset_env(envs, args)
 
     if args.bebold_intrinsic_reward:
-        episode_state_count_dict = utl.episode_state_count_dict_management(state, episode_state_count_dict)
+        episode_state_counts = utl.count_episode_states(state, episode_state_counts)
 
     # this counts how often an agent has done the same task already
     task_count = torch.zeros(num_processes).long().to(device)
@@ -153,15 +151,15 @@ def evaluate(args,
                 done_mdp = torch.Tensor(done_mdp).float().to(device).unsqueeze(1)
 
                 if args.bebold_intrinsic_reward:
-                    episode_state_count_dict = utl.episode_state_count_dict_management(state, episode_state_count_dict)
+                    episode_state_counts = utl.count_episode_states(state, episode_state_counts)
 
-                    rew_raw, rew_normalised, episode_state_count_dict = utl.bebold_intrinsic_reward(
+                    rew_raw, rew_normalised, episode_state_counts = utl.bebold_intrinsic_reward(
                         rew_raw=rew_raw,
                         state=prev_state,
                         next_state=state,
                         random_target_network=random_target_network,
                         predictor_network=predictor_network,
-                        episode_state_count_dict=episode_state_count_dict,
+                        episode_state_counts=episode_state_counts,
                         done_episode=done_mdp,
                         args=args)
                 else:
@@ -193,7 +191,8 @@ def evaluate(args,
                                                                                        epi_reward_running_normalizer=epi_reward_running_normalizer,
                                                                                        exponential_temp_epi=args.exponential_temp_epi,
                                                                                        intrinsic_reward_running_normalizer=intrinsic_reward_running_normalizer,
-                                                                                       state_encoder=state_encoder)
+                                                                                       state_encoder=state_encoder,
+                                                                                       episodic_reward_num_neighbours=args.episodic_reward_num_neighbours)
 
 
             if brim_core is not None:
@@ -273,8 +272,6 @@ def evaluate_meta_policy(
     num_processes = args.num_processes
     returns_per_episode = torch.zeros((num_processes, exploration_num_episodes)).to(device)
 
-    if args.bebold_intrinsic_reward:
-        episode_state_count_dict = [dict()] * args.num_processes
     # --- initialise environments and latents ---
     for i in range(exploration_num_episodes):
         envs = make_vec_envs(env_name, seed=int(args.seed * 1e6 + iter_idx), num_processes=num_processes,
@@ -424,7 +421,8 @@ def evaluate_meta_policy(
                                                                                  epi_reward_running_normalizer=epi_reward_running_normalizer,
                                                                                        exponential_temp_epi=args.exponential_temp_epi,
                                                                                        intrinsic_reward_running_normalizer=intrinsic_reward_running_normalizer,
-                                                                                       state_encoder=state_encoder
+                                                                                       state_encoder=state_encoder,
+                                                                                       episodic_reward_num_neighbours=args.episodic_reward_num_neighbours
                                                                                  )
 
                 done_mdp = list()
@@ -491,16 +489,14 @@ def visualize_policy(
     num_steps = envs._max_episode_steps
 
     if args.bebold_intrinsic_reward:
-        episode_state_count_dict = list()
-        for i in range(args.num_processes):
-            episode_state_count_dict.append({})
+        episode_state_counts = utl.EpisodeStateCounts(1, num_steps * num_episodes + 1)
 
     state, belief, task = utl.reset_env(envs, args)
     if state.shape[-1] == 147:
         state = torch.cat((state, torch.zeros((1, 1), device=device)), dim=-1)
 
     if args.bebold_intrinsic_reward:
-        episode_state_count_dict = utl.episode_state_count_dict_management(state, episode_state_count_dict)
+        episode_state_counts = utl.count_episode_states(state, episode_state_counts)
 
     frames = []
 
@@ -583,15 +579,15 @@ def visualize_policy(
                 done_mdp = torch.Tensor(done_mdp).float().to(device).unsqueeze(1)
 
                 if args.bebold_intrinsic_reward:
-                    episode_state_count_dict = utl.episode_state_count_dict_management(state, episode_state_count_dict)
+                    episode_state_counts = utl.count_episode_states(state, episode_state_counts)
 
-                    rew_raw, rew_normalised, episode_state_count_dict = utl.bebold_intrinsic_reward(
+                    rew_raw, rew_normalised, episode_state_counts = utl.bebold_intrinsic_reward(
                         rew_raw=rew_raw,
                         state=prev_state,
                         next_state=state,
                         random_target_network=random_target_network,
                         predictor_network=predictor_network,
-                        episode_state_count_dict=episode_state_count_dict,
+                        episode_state_counts=episode_state_counts,
                         done_episode=done_mdp,
                         args=args)
                 else:
@@ -625,7 +621,8 @@ def visualize_policy(
                         epi_reward_running_normalizer=epi_reward_running_normalizer,
                         exponential_temp_epi=args.exponential_temp_epi,
                         intrinsic_reward_running_normalizer=intrinsic_reward_running_normalizer,
-                        state_encoder=state_encoder
+                        state_encoder=state_encoder,
+                        episodic_reward_num_neighbours=args.episodic_reward_num_neighbours
                     )
 
             if brim_core is not None:
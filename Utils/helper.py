@@ -34,8 +34,18 @@ def reset_env(env, args, indices=None, state=None):
 
 
 def env_step(env, action, args):
+    env_step_async(env, action)
+    return env_step_wait(env, args)
 
-    next_obs, reward, done, infos = env.step(action.detach())
+
+def env_step_async(env, action):
+    """ Sends the actions to the envs without waiting for the result (see env_step_wait). """
+    env.step_async(action.detach())
+
+
+def env_step_wait(env, args):
+    """ Waits for the step issued by env_step_async. """
+    next_obs, reward, done, infos = env.step_wait()
 
     if isinstance(next_obs, list):
         next_obs = [o.to(device) for o in next_obs]
@@ -103,7 +113,7 @@ def update_encoding(brim_core, policy, next_obs, action, reward, done, task_infe
             brim_output1, brim_output3, brim_output5, brim_hidden_state,\
             latent_sample, latent_mean, latent_logvar, task_inference_hidden_state, exploration_policy_embedded_state = brim_core.forward_exploration_branch(
                 actions=action.float(),
-                states=next_obs,
+                states=next_obs.float(),
                 rewards=reward,
                 task_inference_hidden_state=task_inference_hidden_state,
                 brim_hidden_state=brim_hidden_state,
@@ -117,7 +127,7 @@ def update_encoding(brim_core, policy, next_obs, action, reward, done, task_infe
             brim_output2, brim_output4, brim_output5, brim_hidden_state, \
             latent_sample, latent_mean, latent_logvar, task_inference_hidden_state, exploitation_policy_embedded_state = brim_core.forward_exploitation_branch(
                 actions=action.float(),
-                states=next_obs,
+                states=next_obs.float(),
                 rewards=reward,
                 task_inference_hidden_state=task_inference_hidden_state,
                 brim_hidden_state=brim_hidden_state,
@@ -129,16 +139,65 @@ def update_encoding(brim_core, policy, next_obs, action, reward, done, task_infe
             return brim_output2, brim_output4, brim_output5, brim_hidden_state, latent_sample, latent_mean, latent_logvar, task_inference_hidden_state, exploitation_policy_embedded_state
 
 
-def episode_state_count_dict_management(exploration_next_state, episode_state_count_dict):
-
-    for i in range(len(exploration_next_state)):
-        episode_state_key = exploration_next_state[i]
-        if tuple(episode_state_key.tolist()) in episode_state_count_dict[i]:
-            episode_state_count_dict[i][tuple(episode_state_key.tolist())] += 1
-        else:
-            episode_state_count_dict[i][tuple(episode_state_key.tolist())] = 1
+class EpisodeStateCounts(object):
+    """
+    Per-process visit counts of the states seen in the current episode, kept on the device.
+    States are identified by a 64-bit hash of their values (collisions are astronomically unlikely), so that looking up,
+    incrementing and resetting the counts of all processes takes a few batched ops and no copy to the host.
+    Each process has `capacity` slots (the number of distinct states it can see in an episode); should it see more,
+    the last slot is reused.
+    """
 
-    return episode_state_count_dict
+    def __init__(self, num_processes, capacity):
+        self.num_processes = num_processes
+        self.capacity = capacity
+        self.keys = torch.zeros((num_processes, capacity), dtype=torch.long, device=device)
+        self.counts = torch.zeros((num_processes, capacity), dtype=torch.long, device=device)
+        self.num_states = torch.zeros(num_processes, dtype=torch.long, device=device)
+        self.process = torch.arange(num_processes, device=device)
+        self.multipliers = None
+
+    def hash(self, states):
+        states = states.reshape(states.shape[0], -1)
+        if states.is_floating_point():
+            # fixed point with 20 fractional bits: values closer than ~1e-6 are the same state (and -0. is 0.)
+            states = torch.round(states.double() * 2 ** 20)
+        states = states.long()
+        if self.multipliers is None or self.multipliers.shape[0] != states.shape[1]:
+            generator = torch.Generator().manual_seed(0)
+            multipliers = torch.randint(-2 ** 62, 2 ** 62, size=(states.shape[1],), generator=generator) | 1
+            self.multipliers = multipliers.to(device)
+        # multiply-add hash (wrapping around in 64 bits) followed by a xor-shift to mix the high bits into the low ones
+        key = (states * self.multipliers).sum(-1)
+        return key ^ (key >> 31)
+
+    def lookup(self, keys):
+        """ Returns whether each process has seen its key in this episode, and in which slot """
+        match = (self.keys == keys.unsqueeze(-1)) & (torch.arange(self.capacity, device=device) < self.num_states.unsqueeze(-1))
+        return match.any(-1), match.long().argmax(-1)
+
+    def add(self, states):
+        """ Counts one visit of each process' state """
+        keys = self.hash(states)
+        found, slot = self.lookup(keys)
+        slot = torch.where(found, slot, self.num_states.clamp(max=self.capacity - 1))
+        self.counts[self.process, slot] = torch.where(found, self.counts[self.process, slot] + 1, torch.ones_like(slot))
+        self.keys[self.process, slot] = keys
+        self.num_states = (self.num_states + (~found).long()).clamp(max=self.capacity)
+
+    def count(self, states):
+        """ Visits of each process' state in this episode """
+        found, slot = self.lookup(self.hash(states))
+        return torch.where(found, self.counts[self.process, slot], torch.zeros_like(slot))
+
+    def reset(self, done_episode):
+        """ Forgets the states of the processes whose episode ended """
+        self.num_states = self.num_states * (done_episode.view(-1) == 0).long()
+
+
+def count_episode_states(exploration_next_state, episode_state_counts):
+    episode_state_counts.add(exploration_next_state)
+    return episode_state_counts
 
 
 def bebold_intrinsic_reward(
@@ -147,7 +206,7 @@ def bebold_intrinsic_reward(
         next_state,
         random_target_network,
         predictor_network,
-        episode_state_count_dict,
+        episode_state_counts,
         done_episode,
         args):
 
@@ -159,9 +218,8 @@ def bebold_intrinsic_reward(
     intrinsic_rewards_next = torch.norm(predicted_embedding_next.detach() - random_embedding_next.detach(), dim=-1, p=2)
     intrinsic_rewards = torch.norm(predicted_embedding.detach() - random_embedding.detach(), dim=-1, p=2)
     intrinsic_rewards = torch.clamp(intrinsic_rewards_next - args.scale_fac * intrinsic_rewards, min=0)
-    for i in range(len(next_state)):
-        if episode_state_count_dict[i][tuple(next_state[i].tolist())] > 1:
-            intrinsic_rewards[i] *= 0.0
+    # only the first visit of a state in an episode is rewarded
+    intrinsic_rewards = intrinsic_rewards.masked_fill(episode_state_counts.count(next_state) > 1, 0.)
 
     intrinsic_rewards *= args.intrinsic_reward_coef
 
@@ -169,12 +227,29 @@ def bebold_intrinsic_reward(
     intrinsic_rew_normalised = intrinsic_rewards.unsqueeze(-1) + rew_raw * args.extrinsic_reward_intrinsic_reward_coef
 
     if done_episode is not None:
-        ended_episode_idx = done_episode.view(len(done_episode)).nonzero(as_tuple=True)[0]
-        if sum(done_episode) > 0:
-            for i in range(len(ended_episode_idx)):
-                episode_state_count_dict[ended_episode_idx[i]] = {}
+        episode_state_counts.reset(done_episode)
+
+    return intrinsic_rew_raw, intrinsic_rew_normalised, episode_state_counts
+
+
+def decode_transition(latent, prev_state, next_state, action, state_decoder=None, action_decoder=None, reward_decoder=None):
+    """
+    One-step predictions of the state, action and reward decoders for a batch of transitions, all from the same
+    latent and without building a graph. A decoder that is None is skipped and its prediction is None.
+    """
+    state_pred = action_pred = reward_pred = None
+    with torch.no_grad():
+        if state_decoder is not None:
+            state_pred = state_decoder(latent_state=latent, state=prev_state, action=action, n_step_action=None,
+                                       n_step_state_prediction=False)[0]
+        if action_decoder is not None:
+            action_pred = action_decoder(latent_state=latent, state=prev_state, next_state=next_state,
+                                         n_step_next_state=None, n_step_action_prediction=False)[0]
+        if reward_decoder is not None:
+            reward_pred = reward_decoder(latent_state=latent, next_state=next_state, prev_state=prev_state,
+                                         action=action, n_step_reward_prediction=False)[0]
+    return state_pred, action_pred, reward_pred
 
-    return intrinsic_rew_raw, intrinsic_rew_normalised, episode_state_count_dict
 
 def compute_intrinsic_reward(rew_raw,
                              rew_normalised,
@@ -204,38 +279,48 @@ def compute_intrinsic_reward(rew_raw,
                              epi_reward_running_normalizer,
                              exponential_temp_epi,
                              intrinsic_reward_running_normalizer,
-                             state_encoder):
-    if decode_action and not action_prediction_intrinsic_reward_coef == 0.0:
-        action_pred = action_decoder(latent_state=latent, state=prev_state, next_state=next_state, n_step_next_state=None, n_step_action_prediction=False)[0].detach()
+                             state_encoder,
+                             episodic_reward_num_neighbours=1,
+                             return_reward_prediction=False):
+    """
+    If return_reward_prediction, the reward decoder is evaluated even if it does not contribute to the intrinsic
+    reward, and its one-step prediction is returned as well (e.g. for the RPE of the memory writes).
+    """
+    state_pred, action_pred, reward_pred = decode_transition(
+        latent, prev_state, next_state, action,
+        state_decoder=state_decoder if not state_prediction_intrinsic_reward_coef == 0.0 else None,
+        action_decoder=action_decoder if decode_action and not action_prediction_intrinsic_reward_coef == 0.0 else None,
+        reward_decoder=reward_decoder if decode_reward and (return_reward_prediction or not reward_prediction_intrinsic_reward_coef == 0.0) else None)
+
+    if action_pred is not None:
         action_error = F.nll_loss(action_pred, action.squeeze(-1).long(), reduction='none').unsqueeze(-1)
     else:
         action_error = 0.0
 
-    if decode_reward and not reward_prediction_intrinsic_reward_coef == 0.0:
-        reward_pred = reward_decoder(latent_state=latent, next_state=next_state, prev_state=prev_state, action=action, n_step_reward_prediction=False)[0].detach()
+    if reward_pred is not None and not reward_prediction_intrinsic_reward_coef == 0.0:
         if rew_pred_type == 'categorical':
-            reward_pred = F.softmax(reward_pred, dim=-1)
+            reward_prob = F.softmax(reward_pred, dim=-1)
         elif rew_pred_type == 'bernoulli':
-            reward_pred = torch.sigmoid(reward_pred)
+            reward_prob = torch.sigmoid(reward_pred)
+        else:
+            reward_prob = reward_pred
 
         rew_target = (rew_raw == 1).float()
         if rew_pred_type == 'deterministic':
-            reward_error = (reward_pred - rew_raw).pow(2)
+            reward_error = (reward_prob - rew_raw).pow(2)
         elif rew_pred_type in ['categorical', 'bernoulli']:
-            reward_error = F.binary_cross_entropy(reward_pred, rew_target, reduction='none')
+            reward_error = F.binary_cross_entropy(reward_prob, rew_target, reduction='none')
         else:
             raise NotImplementedError
     else:
         reward_error = 0
 
     if memory is not None and episodic_reward:
-        epi_reward = memory.compute_intrinsic_reward(next_state, task_inf_latent).detach()
+        epi_reward = memory.compute_intrinsic_reward(next_state, task_inf_latent, num_neighbours=episodic_reward_num_neighbours).detach()
     else:
         epi_reward = 0.0
 
-    if not state_prediction_intrinsic_reward_coef == 0.0:
-        state_pred = state_decoder(latent_state=latent, state=prev_state, action=action, n_step_action=None,
-                                   n_step_state_prediction=False)[0].detach()
+    if state_pred is not None:
         state_error = (state_pred - next_state).pow(2).mean(dim=-1).unsqueeze(-1)
     else:
         state_error = 0.0
@@ -271,6 +356,8 @@ def compute_intrinsic_reward(rew_raw,
     if isinstance(epi_reward, torch.Tensor):
         epi_reward = epi_reward.detach()
 
+    if return_reward_prediction:
+        return intrinsic_rew_raw, intrinsic_rew_normalised, state_error, action_error, reward_error, epi_reward, reward_pred
     return intrinsic_rew_raw, intrinsic_rew_normalised, state_error, action_error, reward_error, epi_reward
 
 
@@ -311,6 +398,22 @@ def update_linear_schedule(optimizer, epoch, total_num_epochs, initial_lr):
         param_group['lr'] = lr
 
 
+def sequence_chunks(done, done_episode, chunk_size):
+    """
+    Splits the steps 0..T-1 into (start, end) ranges of at most chunk_size steps, such that the hidden states
+    are only reset (done / done_episode of some process at that step) at the start of a range.
+    done, done_episode: T * num_processes * 1
+    """
+    num_steps = done.shape[0]
+    resets = ((done + done_episode).view(num_steps, -1) > 0).any(-1)
+    # a single host sync for all reset steps
+    starts = [0] + [i for i in resets.nonzero(as_tuple=True)[0].tolist() if i > 0] + [num_steps]
+    chunks = []
+    for start, end in zip(starts[:-1], starts[1:]):
+        chunks.extend((i, min(i + chunk_size, end)) for i in range(start, end, chunk_size))
+    return chunks
+
+
 def recompute_embeddings(
         policy,
         policy_storage,
@@ -319,7 +422,13 @@ def recompute_embeddings(
         update_idx,
         detach_every,
         activated_branch,
+        chunk_size=None,
 ):
+    """
+    Re-encodes the rollouts in the policy storage, building the computation graph through the encoder.
+    By default the brim core is stepped once per timestep. With a chunk_size, it runs over whole chunks of the
+    sequence (of at most chunk_size steps) at once, where chunks are cut wherever a process resets its hidden state.
+    """
     # get the prior
     latent_sample = [policy_storage.latent_samples[0].detach().clone()]
     latent_mean = [policy_storage.latent_mean[0].detach().clone()]
@@ -348,51 +457,46 @@ def recompute_embeddings(
     memory = brim_core.brim.model.memory
     if memory is not None:
         memory.prior(policy_storage.actions.shape[1], activated_branch)
-    for i in range(policy_storage.actions.shape[0]):
-        # reset hidden state of the GRU when we reset the task
-        task_inference_hidden_state, brim_hidden_state = brim_core.reset_hidden(policy, task_inference_hidden_state, brim_hidden_state, policy_storage.done[i + 1], done_episode=policy_storage.done_episode[i + 1], activated_branch=activated_branch)
-
-        if activated_branch == 'exploration':
-            brim_output1, brim_output3, brim_output5, brim_hidden_state, \
-            latent_sample_, latent_mean_, latent_logvar_, task_inference_hidden_state, exploration_policy_embedded_state = brim_core.forward_exploration_branch(
-                actions=policy_storage.actions.float()[i:i + 1],
-                states=policy_storage.next_state[i:i + 1],
-                rewards=policy_storage.rewards_raw[i:i + 1],
-                task_inference_hidden_state=task_inference_hidden_state,
-                brim_hidden_state=brim_hidden_state,
-                sample=sample,
-                return_prior=False,
-                detach_every=detach_every,
-                policy=policy)
-            latent_sample.append(latent_sample_)
-            latent_mean.append(latent_mean_)
-            latent_logvar.append(latent_logvar_)
-
-            brim_output_level1.append(brim_output1)
-            brim_output_level2.append(brim_output3)
-            brim_output_level3.append(brim_output5)
-            policy_embedded_state.append(exploration_policy_embedded_state)
-
-        if activated_branch == 'exploitation':
-            brim_output2, brim_output4, brim_output5, brim_hidden_state, \
-            latent_sample_, latent_mean_, latent_logvar_, task_inference_hidden_state, exploitation_policy_embedded_state = brim_core.forward_exploitation_branch(
-                actions=policy_storage.actions.float()[i:i + 1],
-                states=policy_storage.next_state[i:i + 1],
-                rewards=policy_storage.rewards_raw[i:i + 1],
-                task_inference_hidden_state=task_inference_hidden_state,
-                brim_hidden_state=brim_hidden_state,
-                sample=sample,
-                return_prior=False,
-                detach_every=detach_every,
-                policy=policy)
-            latent_sample.append(latent_sample_)
-            latent_mean.append(latent_mean_)
-            latent_logvar.append(latent_logvar_)
+    if activated_branch == 'exploration':
+        forward_branch = brim_core.forward_exploration_branch
+    elif activated_branch == 'exploitation':
+        forward_branch = brim_core.forward_exploitation_branch
+    else:
+        raise NotImplementedError
+    # outputs of every step: brim outputs (3), latent sample / mean / logvar, policy embedded state
+    step_outputs = (brim_output_level1, brim_output_level2, brim_output_level3, latent_sample, latent_mean, latent_logvar, policy_embedded_state)
 
-            brim_output_level1.append(brim_output2)
-            brim_output_level2.append(brim_output4)
-            brim_output_level3.append(brim_output5)
-            policy_embedded_state.append(exploitation_policy_embedded_state)
+    num_steps = policy_storage.actions.shape[0]
+    if chunk_size is None:
+        chunks = [(i, i + 1) for i in range(num_steps)]
+    else:
+        chunks = sequence_chunks(policy_storage.done[1:], policy_storage.done_episode[1:], chunk_size)
+    for start, end in chunks:
+        # reset hidden state of the GRU when we reset the task (a chunk only starts with resets)
+        task_inference_hidden_state, brim_hidden_state = brim_core.reset_hidden(policy, task_inference_hidden_state, brim_hidden_state, policy_storage.done[start + 1], done_episode=policy_storage.done_episode[start + 1], activated_branch=activated_branch)
+
+        brim_output_a, brim_output_b, brim_output5, brim_hidden_state, \
+        latent_sample_, latent_mean_, latent_logvar_, task_inference_hidden_state, policy_embedded_state_ = forward_branch(
+            actions=policy_storage.actions.float()[start:end],
+            states=policy_storage.next_state[start:end],
+            rewards=policy_storage.rewards_raw[start:end],
+            task_inference_hidden_state=task_inference_hidden_state,
+            brim_hidden_state=brim_hidden_state,
+            sample=sample,
+            return_prior=False,
+            detach_every=detach_every,
+            policy=policy)
+        outputs = (brim_output_a, brim_output_b, brim_output5, latent_sample_, latent_mean_, latent_logvar_, policy_embedded_state_)
+        if end - start == 1:
+            for storage, output in zip(step_outputs, outputs):
+                storage.append(output)
+        else:
+            # split the sequence into steps, shaped like the outputs of a single step
+            for storage, output in zip(step_outputs, outputs):
+                storage.extend(step.reshape(storage[0].shape) for step in output.unbind(0))
+            # continue from the hidden state after the last step
+            brim_hidden_state = brim_hidden_state[-1:]
+            task_inference_hidden_state = task_inference_hidden_state[-1:]
 
     if update_idx == 0 and activated_branch == 'exploration':
         try:
@@ -427,7 +531,8 @@ class FeatureExtractor(nn.Module):
 
     def forward(self, inputs):
         if self.output_size != 0:
-            return self.activation_function(self.fc(inputs))
+            # observations can be stored compactly (uint8); they are only cast to float here
+            return self.activation_function(self.fc(inputs.float()))
         else:
             return torch.zeros(0, ).to(device)
 
@@ -569,7 +674,7 @@ class MinigridMLPTargetEmbeddingNet(nn.Module):
         )
 
     def forward(self, inputs):
-        state_embedding = self.fc(inputs)
+        state_embedding = self.fc(inputs.float())
         return state_embedding
 
 
@@ -590,5 +695,5 @@ class MinigridMLPEmbeddingNet(nn.Module):
         )
 
     def forward(self, inputs):
-        state_embedding = self.fc(inputs)
+        state_embedding = self.fc(inputs.float())
         return state_embedding
\ No newline at end of file
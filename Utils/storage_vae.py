@@ -1,17 +1,45 @@
+import json
+import os
+import queue
+import threading
+
+import gym
 import numpy as np
 import torch
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
+def check_compact_spaces(action_space, observation_space):
+    """ Compact buffers keep actions as int8 and observations as uint8, which is lossless for MiniGrid-like envs only """
+    assert isinstance(action_space, gym.spaces.Discrete) and action_space.n <= 128, \
+        'compact buffers need a Discrete action space with at most 128 actions, got {}'.format(action_space)
+    obs_dtype = np.dtype(observation_space.dtype)
+    assert obs_dtype == np.uint8 or (np.issubdtype(obs_dtype, np.integer) and np.all(observation_space.low >= 0)
+                                     and np.all(observation_space.high <= 255)), \
+        'compact buffers need uint8 observations (or integers in [0, 255]), got {}'.format(observation_space)
+
+
 class RolloutStorageVAE(object):
     def __init__(self, num_processes, max_trajectory_len, zero_pad, max_num_rollouts,
-                 state_dim, action_dim, vae_buffer_add_thresh, task_dim, save_intrinsic_reward=False):
+                 state_dim, action_dim, vae_buffer_add_thresh, task_dim, save_intrinsic_reward=False,
+                 prefetch_batchsize=None, buffer_dir=None, compact=False, seed=None, action_space=None,
+                 observation_space=None):
         """
         Store everything that is needed for the VAE update
         :param num_processes:
+        :param prefetch_batchsize: if given, mini-batches of this size are sampled ahead of time on a background thread
+        :param seed: seed of the random state the background thread samples with
+        :param buffer_dir: if given, completed rollouts are kept in memory-mapped files in this directory
+                           (and the buffer is resumed from there if it already exists)
+        :param compact: store observations as uint8 and actions as int8 (MiniGrid), instead of float32
+                        (the running trajectories also keep their observations as uint8)
+        :param action_space, observation_space: spaces of the envs, checked to fit the compact dtypes if compact
         """
 
+        if compact:
+            check_compact_spaces(action_space, observation_space)
+
         self.obs_dim = state_dim
         self.action_dim = action_dim
         self.task_dim = task_dim
@@ -27,29 +55,48 @@ class RolloutStorageVAE(object):
         # whether to zero-pad to maximum length (zero's at the end!)
         self.zero_pad = zero_pad
 
-        # buffers for completed rollouts (stored on CPU)
+        # buffers for completed rollouts (stored on CPU, or on disk if buffer_dir is given)
+        self.buffer_dir = buffer_dir
+        self.memmaps = {}
+        self.resume = False
         if self.max_buffer_size > 0:
-            self.prev_state = torch.zeros((self.max_traj_len, self.max_buffer_size, state_dim))
-            self.next_state = torch.zeros((self.max_traj_len, self.max_buffer_size, state_dim))
-            self.actions = torch.zeros((self.max_traj_len, self.max_buffer_size, action_dim))
-            self.rewards = torch.zeros((self.max_traj_len, self.max_buffer_size, 1))
-            self.masks = torch.zeros((self.max_traj_len, self.max_buffer_size, 1))
-            self.bad_masks = torch.zeros((self.max_traj_len, self.max_buffer_size, 1))
-            self.done_task = torch.zeros((self.max_traj_len, self.max_buffer_size, 1))
-            self.done_episode = torch.zeros((self.max_traj_len, self.max_buffer_size, 1))
+            obs_dtype = np.uint8 if compact else np.float32
+            action_dtype = np.int8 if compact else np.float32
+            if self.buffer_dir is not None:
+                os.makedirs(self.buffer_dir, exist_ok=True)
+                self.resume = os.path.isfile(os.path.join(self.buffer_dir, 'meta.json'))
+            self.prev_state = self.allocate('prev_state', (self.max_traj_len, self.max_buffer_size, state_dim), obs_dtype)
+            self.next_state = self.allocate('next_state', (self.max_traj_len, self.max_buffer_size, state_dim), obs_dtype)
+            self.actions = self.allocate('actions', (self.max_traj_len, self.max_buffer_size, action_dim), action_dtype)
+            self.rewards = self.allocate('rewards', (self.max_traj_len, self.max_buffer_size, 1))
+            self.masks = self.allocate('masks', (self.max_traj_len, self.max_buffer_size, 1))
+            self.bad_masks = self.allocate('bad_masks', (self.max_traj_len, self.max_buffer_size, 1))
+            self.done_task = self.allocate('done_task', (self.max_traj_len, self.max_buffer_size, 1))
+            self.done_episode = self.allocate('done_episode', (self.max_traj_len, self.max_buffer_size, 1))
             if self.save_intrinsic_reward:
-                self.intrinsic_rewards = torch.zeros((self.max_traj_len, self.max_buffer_size, 1))
+                self.intrinsic_rewards = self.allocate('intrinsic_rewards', (self.max_traj_len, self.max_buffer_size, 1))
             if task_dim is not None:
-                self.tasks = torch.zeros((self.max_buffer_size, task_dim))
+                self.tasks = self.allocate('tasks', (self.max_buffer_size, task_dim))
             else:
                 self.tasks = None
-            self.trajectory_lens = [0] * self.max_buffer_size
+            self.trajectory_lens = self.allocate('trajectory_lens', (self.max_buffer_size,), np.int64).numpy()
+            if self.resume:
+                with open(os.path.join(self.buffer_dir, 'meta.json')) as f:
+                    meta = json.load(f)
+                self.insert_idx = meta['insert_idx']
+                self.buffer_len = meta['buffer_len']
+        # guards the completed rollouts against concurrent flushes and (background) sampling
+        self.lock = threading.Lock()
+        self.prefetch_batchsize = prefetch_batchsize
+        self.seed = seed
+        self.sampler = None
 
         # storage for each running process (stored on GPU)
         self.num_processes = num_processes
         self.curr_timestep = torch.zeros((num_processes)).long()  # count environment steps so we know where to insert
-        self.running_prev_state = torch.zeros((self.max_traj_len, num_processes, state_dim)).to(device)  # for each episode will have obs 0...N-1
-        self.running_next_state = torch.zeros((self.max_traj_len, num_processes, state_dim)).to(device)  # for each episode will have obs 1...N
+        running_obs_dtype = torch.uint8 if compact else torch.float32
+        self.running_prev_state = torch.zeros((self.max_traj_len, num_processes, state_dim), dtype=running_obs_dtype).to(device)  # for each episode will have obs 0...N-1
+        self.running_next_state = torch.zeros((self.max_traj_len, num_processes, state_dim), dtype=running_obs_dtype).to(device)  # for each episode will have obs 1...N
         self.running_rewards = torch.zeros((self.max_traj_len, num_processes, 1)).to(device)
         self.running_mask = torch.zeros((self.max_traj_len, num_processes, 1)).to(device)
         self.running_bad_masks = torch.zeros((self.max_traj_len, num_processes, 1)).to(device)
@@ -74,142 +121,116 @@ class RolloutStorageVAE(object):
 
     def insert(self, prev_state, actions, next_state, rewards, done, task, masks, bad_masks, intrinsic_rewards, done_task, done_episode):
 
-        # add to temporary buffer
+        # add to temporary buffer; processes can be out of sync, so each one is written at its own timestep
+        timestep = self.curr_timestep.to(device)
+        process = torch.arange(self.num_processes, device=device)
+        self.running_prev_state[timestep, process] = prev_state.to(self.running_prev_state.dtype)
+        self.running_next_state[timestep, process] = next_state.to(self.running_next_state.dtype)
+        self.running_rewards[timestep, process] = rewards
+        self.running_mask[timestep, process] = masks
+        self.running_bad_masks[timestep, process] = bad_masks
+        if self.save_intrinsic_reward:
+            self.running_intrinsic_rewards[timestep, process] = intrinsic_rewards
+        self.running_actions[timestep, process] = actions.float()
+        self.running_done_task[timestep, process] = done_task
+        self.running_done_episode[timestep, process] = done_episode
+        if task is not None:
+            self.running_tasks = task
+        self.curr_timestep += 1
 
-        already_inserted = False
-        if len(np.unique(self.curr_timestep)) == 1:
-            self.running_prev_state[self.curr_timestep[0]] = prev_state
-            self.running_next_state[self.curr_timestep[0]] = next_state
-            self.running_rewards[self.curr_timestep[0]] = rewards
-            self.running_mask[self.curr_timestep[0]] = masks
-            self.running_bad_masks[self.curr_timestep[0]] = bad_masks
-            if self.save_intrinsic_reward:
-                self.running_intrinsic_rewards[self.curr_timestep[0]] = intrinsic_rewards
-            self.running_actions[self.curr_timestep[0]] = actions
-            self.running_done_task[self.curr_timestep[0]] = done_task
-            self.running_done_episode[self.curr_timestep[0]] = done_episode
-            if task is not None:
-                self.running_tasks = task
-            self.curr_timestep += 1
-            already_inserted = True
-
-        already_reset = False
-        if done.sum() == self.num_processes:  # check if we can process the entire batch at once
-
-            # add to permanent (up to max_buffer_len) buffer
-            if self.max_buffer_size > 0:
-                if self.vae_buffer_add_thresh >= np.random.uniform(0, 1):
-                    # check where to insert data
-                    if self.insert_idx + self.num_processes > self.max_buffer_size:
-                        # keep track of how much we filled the buffer (for sampling from it)
-                        self.buffer_len = self.insert_idx
-                        # this will keep some entries at the end of the buffer without overwriting them,
-                        # but the buffer is large enough to make this negligible
-                        self.insert_idx = 0
-                    else:
-                        self.buffer_len = max(self.buffer_len, self.insert_idx)
-                    # add; note: num trajectories are along dim=1,
-                    # trajectory length along dim=0, to match pytorch RNN interface
-                    self.prev_state[:, self.insert_idx:self.insert_idx + self.num_processes] = self.running_prev_state
-                    self.next_state[:, self.insert_idx:self.insert_idx + self.num_processes] = self.running_next_state
-                    self.actions[:, self.insert_idx:self.insert_idx+self.num_processes] = self.running_actions
-                    self.done_task[:, self.insert_idx:self.insert_idx+self.num_processes] = self.running_done_task
-                    self.done_episode[:, self.insert_idx:self.insert_idx + self.num_processes] = self.running_done_episode
-                    self.rewards[:, self.insert_idx:self.insert_idx+self.num_processes] = self.running_rewards
-                    self.masks[:, self.insert_idx:self.insert_idx+self.num_processes] = self.running_mask
-                    self.bad_masks[:, self.insert_idx:self.insert_idx+self.num_processes] = self.running_bad_masks
-                    if self.save_intrinsic_reward:
-                        self.intrinsic_rewards[:, self.insert_idx:self.insert_idx+self.num_processes] = self.running_intrinsic_rewards
-                    if (self.tasks is not None) and (self.running_tasks is not None):
-                        insert_shape = self.tasks[self.insert_idx:self.insert_idx+self.num_processes].shape
-                        self.tasks[self.insert_idx:self.insert_idx+self.num_processes] = self.running_tasks.reshape(insert_shape)
-                    self.trajectory_lens[self.insert_idx:self.insert_idx+self.num_processes] = self.curr_timestep.clone()
-                    self.insert_idx += self.num_processes
-
-            # empty running buffer
-            self.running_prev_state *= 0
-            self.running_next_state *= 0
-            self.running_rewards *= 0
-            self.running_mask *= 0
-            self.running_bad_masks *= 0
-            if self.save_intrinsic_reward:
-                self.running_intrinsic_rewards *= 0
-            self.running_actions *= 0
-            self.running_done_task *= 0
-            self.running_done_episode *= 0
-            if self.running_tasks is not None:
-                self.running_tasks *= 0
-            self.curr_timestep *= 0
-
-            already_reset = True
-
-        if (not already_inserted) or (not already_reset):
-
-            for i in range(self.num_processes):
-
-                if not already_inserted:
-                    self.running_prev_state[self.curr_timestep[i], i] = prev_state[i]
-                    self.running_next_state[self.curr_timestep[i], i] = next_state[i]
-                    self.running_rewards[self.curr_timestep[i], i] = rewards[i]
-                    self.running_mask[self.curr_timestep[i], i] = masks[i]
-                    self.running_bad_masks[self.curr_timestep[i], i] = bad_masks[i]
-                    if self.save_intrinsic_reward:
-                        self.running_intrinsic_rewards[self.curr_timestep[i], i] = intrinsic_rewards[i]
-                    self.running_actions[self.curr_timestep[i], i] = actions[i]
-                    self.running_done_task[self.curr_timestep[i], i] = done_task[i]
-                    self.running_done_episode[self.curr_timestep[i], i] = done_task[i]
-
-                    if self.running_tasks[i] is None:
-                        self.running_tasks[i] = task[i]
-                    self.curr_timestep[i] += 1
-
-                if not already_reset:
-                    # if we are at the end of a task, dump the data into the larger buffer
-                    if done[i]:
-
-                        # add to permanent (up to max_buffer_len) buffer
-                        if self.max_buffer_size > 0:
-                            if self.vae_buffer_add_thresh >= np.random.uniform(0, 1):
-                                # check where to insert data
-                                if self.insert_idx + 1 > self.max_buffer_size:
-                                    # keep track of how much we filled the buffer (for sampling from it)
-                                    self.buffer_len = self.insert_idx
-                                    # this will keep some entries at the end of the buffer without overwriting them,
-                                    # but the buffer is large enough to make this negligible
-                                    self.insert_idx = 0
-                                else:
-                                    self.buffer_len = max(self.buffer_len, self.insert_idx)
-                                # add; note: num trajectories are along dim=1,
-                                # trajectory length along dim=0, to match pytorch RNN interface
-                                self.prev_state[:, self.insert_idx] = self.running_prev_state[:, i].to('cpu')
-                                self.next_state[:, self.insert_idx] = self.running_next_state[:, i].to('cpu')
-                                self.actions[:, self.insert_idx] = self.running_actions[:, i].to('cpu')
-                                self.done_task[:, self.insert_idx] = self.running_done_task[:, i].to('cpu')
-                                self.done_episode[:, self.insert_idx] = self.running_done_episode[:, i].to('cpu')
-                                self.rewards[:, self.insert_idx] = self.running_rewards[:, i].to('cpu')
-                                self.masks[:, self.insert_idx] = self.running_mask[:, i].to('cpu')
-                                self.bad_masks[:, self.insert_idx] = self.running_bad_masks[:, i].to('cpu')
-                                if self.save_intrinsic_reward:
-                                    self.intrinsic_rewards[:, self.insert_idx] = self.running_intrinsic_rewards[:, i].to('cpu')
-                                if self.tasks is not None:
-                                    self.tasks[self.insert_idx] = self.running_tasks[i].to('cpu')
-                                self.trajectory_lens[self.insert_idx] = self.curr_timestep[i].clone()
-                                self.insert_idx += 1
-
-                        # empty running buffer
-                        self.running_prev_state[:, i] *= 0
-                        self.running_next_state[:, i] *= 0
-                        self.running_rewards[:, i] *= 0
-                        self.running_mask[:, i] *= 0
-                        self.running_bad_masks[:, i] *= 0
-                        if self.save_intrinsic_reward:
-                            self.running_intrinsic_rewards[:, i] *= 0
-                        self.running_actions[:, i] *= 0
-                        self.running_done_task[:, i] *= 0
-                        self.running_done_episode[:, i] *= 0
-                        if self.running_tasks is not None:
-                            self.running_tasks[i] *= 0
-                        self.curr_timestep[i] = 0
+        # if we are at the end of a task, dump the data into the larger buffer
+        done_processes = done.view(-1).nonzero(as_tuple=True)[0]
+        if len(done_processes) == 0:
+            return
+        if self.max_buffer_size > 0:
+            self.flush(done_processes)
+
+        # empty running buffer of the finished processes
+        for running_buffer in self.get_running_buffers():
+            running_buffer[:, done_processes] = 0
+        if self.running_tasks is not None:
+            self.running_tasks[done_processes] = 0
+        self.curr_timestep[done_processes.cpu()] = 0
+
+    def allocate(self, name, shape, dtype=np.float32):
+        """
+        Allocates a zero-initialised buffer for completed rollouts.
+        With a buffer_dir this is a tensor view on a memory-mapped .npy file, so only the pages that are
+        touched when inserting / sampling are ever loaded into memory.
+        """
+        if self.buffer_dir is None:
+            return torch.from_numpy(np.zeros(shape, dtype=dtype))
+        filename = os.path.join(self.buffer_dir, name + '.npy')
+        if self.resume:
+            buffer = np.lib.format.open_memmap(filename, mode='r+')
+            if buffer.shape != shape or buffer.dtype != dtype:
+                raise ValueError('VAE buffer in {} does not match the current configuration '
+                                 '({} {} vs {} {})'.format(filename, buffer.shape, buffer.dtype, shape, np.dtype(dtype)))
+        else:
+            buffer = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+        self.memmaps[name] = buffer
+        return torch.from_numpy(buffer)
+
+    def save(self):
+        """
+        Writes the memory-mapped buffers to disk, together with the state needed to resume them.
+        """
+        if self.buffer_dir is None or self.max_buffer_size == 0:
+            return
+        with self.lock:
+            for buffer in self.memmaps.values():
+                buffer.flush()
+            with open(os.path.join(self.buffer_dir, 'meta.json'), 'w') as f:
+                json.dump({'insert_idx': self.insert_idx, 'buffer_len': self.buffer_len}, f)
+
+    def get_running_buffers(self):
+        running_buffers = [self.running_prev_state, self.running_next_state, self.running_actions, self.running_rewards,
+                           self.running_mask, self.running_bad_masks, self.running_done_task, self.running_done_episode]
+        if self.save_intrinsic_reward:
+            running_buffers.append(self.running_intrinsic_rewards)
+        return running_buffers
+
+    def get_buffers(self):
+        buffers = [self.prev_state, self.next_state, self.actions, self.rewards,
+                   self.masks, self.bad_masks, self.done_task, self.done_episode]
+        if self.save_intrinsic_reward:
+            buffers.append(self.intrinsic_rewards)
+        return buffers
+
+    def flush(self, processes):
+        """
+        Copies the running trajectories of the given processes into the (ring) buffer of completed rollouts.
+        """
+        # each finished trajectory is kept with probability vae_buffer_add_thresh
+        keep = torch.from_numpy(self.vae_buffer_add_thresh >= np.random.uniform(0, 1, len(processes)))
+        processes = processes[keep.to(processes.device)][-self.max_buffer_size:]
+        num_new = len(processes)
+        if num_new == 0:
+            return
+        # ring buffer: overwrite the oldest trajectories once the buffer is full
+        insert_indices = (self.insert_idx + torch.arange(num_new)) % self.max_buffer_size
+
+        # gather all fields of all finished trajectories and copy them to the CPU at once
+        running_buffers = self.get_running_buffers()
+        trajectories = torch.cat([running_buffer[:, processes].float() for running_buffer in running_buffers], dim=-1).to('cpu')
+        trajectories = torch.split(trajectories, [running_buffer.shape[-1] for running_buffer in running_buffers], dim=-1)
+        if (self.tasks is not None) and (self.running_tasks is not None):
+            tasks = self.running_tasks[processes].reshape((num_new, -1)).to('cpu')
+        else:
+            tasks = None
+
+        with self.lock:
+            # add; note: num trajectories are along dim=1,
+            # trajectory length along dim=0, to match pytorch RNN interface
+            for buffer, trajectory in zip(self.get_buffers(), trajectories):
+                buffer[:, insert_indices] = trajectory.to(buffer.dtype)
+            if tasks is not None:
+                self.tasks[insert_indices] = tasks
+            self.trajectory_lens[insert_indices.numpy()] = self.curr_timestep[processes.cpu()].numpy()
+
+            self.insert_idx = (self.insert_idx + num_new) % self.max_buffer_size
+            # keep track of how much we filled the buffer (for sampling from it)
+            self.buffer_len = min(self.buffer_len + num_new, self.max_buffer_size)
 
     def ready_for_update(self):
         return len(self) > 0
@@ -217,37 +238,127 @@ class RolloutStorageVAE(object):
     def __len__(self):
         return self.buffer_len
 
-    def get_batch(self, batchsize=5, replace=False, value_prediction=False, memory_batch=False):
+    def sample_batch(self, batchsize, replace=False, names=None, pin_memory=False, rng=None):
+        """
+        Gathers the given fields of `batchsize` randomly chosen rollouts (on the CPU).
+        :param names: which buffers to gather (None gathers everything that is stored)
+        :param pin_memory: gather into page-locked memory so the batch can be copied to the GPU asynchronously
+        :param rng: the np.random.RandomState to pick the rollouts with (default: the global numpy random state)
+        """
+        if rng is None:
+            rng = np.random
+        if names is None:
+            names = ['prev_state', 'next_state', 'actions', 'rewards', 'masks', 'bad_masks', 'done_task', 'done_episode']
+            if self.save_intrinsic_reward:
+                names.append('intrinsic_rewards')
+        with self.lock:
+            batchsize = min(self.buffer_len, batchsize)
+            # select the indices for the processes from which we pick
+            rollout_indices = rng.choice(range(self.buffer_len), batchsize, replace=replace)
+            indices = torch.from_numpy(rollout_indices)
+            # trajectory length of the individual rollouts we picked
+            batch = {'trajectory_lens': self.trajectory_lens[rollout_indices]}
+            # select the rollouts we want
+            for name in names:
+                buffer = getattr(self, name)
+                batch[name] = torch.index_select(buffer, 1, indices, out=torch.empty(
+                    (buffer.shape[0], batchsize, buffer.shape[2]), dtype=buffer.dtype, pin_memory=pin_memory))
+            if self.tasks is not None:
+                batch['tasks'] = torch.index_select(self.tasks, 0, indices, out=torch.empty(
+                    (batchsize, self.tasks.shape[1]), pin_memory=pin_memory))
+            else:
+                batch['tasks'] = None
+        return batch
 
-        batchsize = min(self.buffer_len, batchsize)
+    def get_batch(self, batchsize=5, replace=False, value_prediction=False, memory_batch=False):
 
-        # select the indices for the processes from which we pick
-        rollout_indices = np.random.choice(range(self.buffer_len), batchsize, replace=replace)
-        # trajectory length of the individual rollouts we picked
-        trajectory_lens = np.array(self.trajectory_lens)[rollout_indices]
+        if self.prefetch_batchsize is not None and self.prefetch_batchsize == batchsize and not replace \
+                and self.buffer_len > 0:
+            if self.sampler is None:
+                self.sampler = PrefetchSampler(self, batchsize, seed=self.seed)
+            batch = self.sampler.get()
+        else:
+            names = ['prev_state', 'next_state', 'actions', 'rewards']
+            if self.save_intrinsic_reward and value_prediction:
+                names.append('intrinsic_rewards')
+            if value_prediction:
+                names.extend(['masks', 'bad_masks'])
+            if memory_batch:
+                names.extend(['done_task', 'done_episode'])
+            batch = batch_to_device(self.sample_batch(batchsize, replace=replace, names=names))
 
-        # select the rollouts we want
-        prev_obs = self.prev_state[:, rollout_indices, :]
-        next_obs = self.next_state[:, rollout_indices, :]
-        actions = self.actions[:, rollout_indices, :]
-        rewards = self.rewards[:, rollout_indices, :]
+        prev_obs, next_obs, actions, rewards = batch['prev_state'], batch['next_state'], batch['actions'], batch['rewards']
+        tasks, trajectory_lens = batch['tasks'], batch['trajectory_lens']
+        batchsize = len(trajectory_lens)
         if self.save_intrinsic_reward and value_prediction:
-            rewards = self.intrinsic_rewards[:, rollout_indices, :]
-        if self.tasks is not None:
-            tasks = self.tasks[rollout_indices].to(device)
-        else:
-            tasks = None
+            rewards = batch['intrinsic_rewards']
         if value_prediction:
-            masks = self.masks[:, rollout_indices, :]
-            masks = torch.cat((torch.zeros(size=(1, batchsize, 1)), masks), dim=0)
-            bad_masks = self.bad_masks[:, rollout_indices, :]
-            bad_masks = torch.cat((torch.zeros(size=(1, batchsize, 1)), bad_masks), dim=0)
-            return prev_obs.to(device), next_obs.to(device), actions.to(device), \
-            rewards.to(device), tasks, masks.to(device), bad_masks.to(device), trajectory_lens
+            masks = torch.cat((torch.zeros(size=(1, batchsize, 1), device=device), batch['masks']), dim=0)
+            bad_masks = torch.cat((torch.zeros(size=(1, batchsize, 1), device=device), batch['bad_masks']), dim=0)
+            return prev_obs, next_obs, actions, rewards, tasks, masks, bad_masks, trajectory_lens
         if memory_batch:
-            done_tasks = self.done_task[:, rollout_indices, :]
-            done_episodes = self.done_episode[:, rollout_indices, :]
-            return prev_obs.to(device), next_obs.to(device), actions.to(device), rewards.to(device), tasks.to(device), done_tasks.to(device),\
-            done_episodes.to(device), trajectory_lens
-        return prev_obs.to(device), next_obs.to(device), actions.to(device), \
-               rewards.to(device), tasks, trajectory_lens
\ No newline at end of file
+            return prev_obs, next_obs, actions, rewards, tasks, batch['done_task'], batch['done_episode'], trajectory_lens
+        return prev_obs, next_obs, actions, rewards, tasks, trajectory_lens
+
+
+def batch_to_device(batch, non_blocking=False):
+    # compactly stored fields are only cast to float once they are on the device
+    return {name: value.to(device, non_blocking=non_blocking).float() if isinstance(value, torch.Tensor) else value
+            for name, value in batch.items()}
+
+
+class PrefetchSampler(object):
+    """
+    Samples mini-batches from a RolloutStorageVAE on a background thread.
+    Batches are gathered into pinned memory and copied to the GPU with non-blocking copies on a separate stream,
+    so the next batch is (usually) already on the device when it is asked for.
+    Batches can be sampled before the latest trajectories were flushed, which is fine for a replay buffer.
+    The thread samples with its own random state (the global numpy one is not thread-safe), and an exception raised
+    on it is passed on to the caller of get().
+    """
+    def __init__(self, rollout_storage, batchsize, seed=None, num_prefetch=2):
+        self.rollout_storage = rollout_storage
+        self.batchsize = batchsize
+        self.rng = np.random.RandomState(seed)
+        self.error = None
+        self.use_cuda = device.type == 'cuda'
+        self.stream = torch.cuda.Stream() if self.use_cuda else None
+        self.batches = queue.Queue(maxsize=num_prefetch)
+        self.thread = threading.Thread(target=self.prefetch, daemon=True)
+        self.thread.start()
+
+    def prefetch(self):
+        while True:
+            try:
+                batch = self.rollout_storage.sample_batch(self.batchsize, pin_memory=self.use_cuda, rng=self.rng)
+                if self.use_cuda:
+                    with torch.cuda.stream(self.stream):
+                        batch = batch_to_device(batch, non_blocking=True)
+                        copied = torch.cuda.Event()
+                        copied.record(self.stream)
+                else:
+                    # same dtypes as the batches sampled without prefetching
+                    batch = batch_to_device(batch)
+                    copied = None
+            except Exception as e:
+                # the thread stops here, the error is raised in get()
+                self.batches.put((e, None))
+                return
+            # blocks while num_prefetch batches are waiting
+            self.batches.put((batch, copied))
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        batch, copied = self.batches.get()
+        if isinstance(batch, Exception):
+            self.error = batch
+            raise batch
+        if copied is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_event(copied)
+            for value in batch.values():
+                if isinstance(value, torch.Tensor):
+                    # memory was allocated on the side stream but is used on the current one
+                    value.record_stream(current_stream)
+        return batch
@@ -1,3 +1,4 @@
+import os
 import gym
 import warnings
 import numpy as np
@@ -19,33 +20,70 @@ def compute_memory_loss():
     return
 
 
+def memory_visibility_mask(done_episode, episode_len, causal):
+    """
+    Which writes of a sequence every read sees, when write i (after resetting on done_episode[i]) goes into
+    an episodic memory with episode_len slots per process.
+    causal=False: every read sees the memory after the last write (as when reading after writing the whole sequence),
+    causal=True: the read at step t sees the memory right after write t.
+    done_episode: T * b * 1, returns T (read) * T (write) * b.
+    """
+    seq_len = done_episode.shape[0]
+    steps = torch.arange(seq_len, device=done_episode.device).view(-1, 1)
+    # start of the episode every step belongs to (the memory starts empty at step 0)
+    episode_start = torch.where(done_episode.view(seq_len, -1).bool(), steps, torch.zeros_like(steps))
+    episode_start = torch.cummax(episode_start, dim=0)[0]
+    # the slots are a ring buffer and a read only sees the slots below the write pointer, i.e. the last
+    # (number of writes in the episode % episode_len) writes
+    num_visible = (steps - episode_start + 1) % episode_len
+    if causal:
+        last_write = steps.expand_as(num_visible)
+    else:
+        last_write = torch.full_like(num_visible, seq_len - 1)
+        num_visible = num_visible[-1:].expand_as(num_visible)
+    write_steps = torch.arange(seq_len, device=done_episode.device).view(1, -1, 1)
+    return (write_steps <= last_write.unsqueeze(1)) & (write_steps > (last_write - num_visible).unsqueeze(1))
+
+
+def reverse_linear_scan(coefs, offsets):
+    """
+    Solves x[t] = coefs[t] * x[t + 1] + offsets[t] backwards in time for all t at once.
+    Pairs of steps are composed recursively (doubling the span each round), so this takes log2(T) vectorised
+    steps instead of T sequential ones.
+    Returns (x given x[T] = 0, product of the coefs from t to T - 1): the solution for a given x[T] is
+    x[0] + x[1] * x[T].
+    """
+    coefs, offsets = coefs.clone(), offsets.clone()
+    shift = 1
+    while shift < offsets.shape[0]:
+        offsets[:-shift] = offsets[:-shift] + coefs[:-shift] * offsets[shift:]
+        coefs[:-shift] = coefs[:-shift] * coefs[shift:]
+        shift *= 2
+    return offsets, coefs
+
+
 def compute_returns(next_value, rewards, value_preds, returns, gamma, tau, use_gae, masks, bad_masks, use_proper_time_limits):
-    if use_proper_time_limits:
-        if use_gae:
-            value_preds[-1] = next_value
-            gae = 0
-            for step in reversed(range(rewards.size(0))):
-                delta = rewards[step] + gamma * value_preds[step + 1] * masks[step + 1] - value_preds[step]
-                gae = delta + gamma * tau * masks[step + 1] * gae
-                gae = gae * bad_masks[step + 1]
-                returns[step] = gae + value_preds[step]
-        else:
-            returns[-1] = next_value
-            for step in reversed(range(rewards.size(0))):
-                returns[step] = (returns[step + 1] * gamma * masks[step + 1] + rewards[step]) * bad_masks[
-                    step + 1] + (1 - bad_masks[step + 1]) * value_preds[step]
+    num_steps = rewards.size(0)
+    if use_gae:
+        value_preds[-1] = next_value
+        # gae[t] = delta[t] + gamma * tau * masks[t + 1] * gae[t + 1]
+        deltas = rewards + gamma * value_preds[1:num_steps + 1] * masks[1:num_steps + 1] - value_preds[:num_steps]
+        coefs = gamma * tau * masks[1:num_steps + 1]
+        if use_proper_time_limits:
+            deltas = deltas * bad_masks[1:num_steps + 1]
+            coefs = coefs * bad_masks[1:num_steps + 1]
+        gae, _ = reverse_linear_scan(coefs, deltas)
+        returns[:num_steps] = gae + value_preds[:num_steps]
     else:
-        if use_gae:
-            value_preds[-1] = next_value
-            gae = 0
-            for step in reversed(range(rewards.size(0))):
-                delta = rewards[step] + gamma * value_preds[step + 1] * masks[step + 1] - value_preds[step]
-                gae = delta + gamma * tau * masks[step + 1] * gae
-                returns[step] = gae + value_preds[step]
-        else:
-            returns[-1] = next_value
-            for step in reversed(range(rewards.size(0))):
-                returns[step] = returns[step + 1] * gamma * masks[step + 1] + rewards[step]
+        returns[-1] = next_value
+        # returns[t] = rewards[t] + gamma * masks[t + 1] * returns[t + 1]
+        coefs = gamma * masks[1:num_steps + 1]
+        offsets = rewards
+        if use_proper_time_limits:
+            offsets = rewards * bad_masks[1:num_steps + 1] + (1 - bad_masks[1:num_steps + 1]) * value_preds[:num_steps]
+            coefs = coefs * bad_masks[1:num_steps + 1]
+        partial_returns, discounts = reverse_linear_scan(coefs, offsets)
+        returns[:num_steps] = partial_returns + discounts * returns[num_steps]
 
 
 def compute_loss_action(action_pred, action):
@@ -160,6 +198,10 @@ class Base2Final:
             self.args.hebb_learning_rate
 
         self.brim_core = self.initialise_brim_core(memory_params=memory_params)
+        if self.args.use_memory and self.args.use_hebb:
+            hebbian = self.brim_core.brim.model.memory.hebbian
+            hebbian.consolidation_iterations = self.args.hebb_consolidation_iterations
+            hebbian.consolidation_tol = self.args.hebb_consolidation_tol
 
         # initialise the decoders (returns None for unused decoders)
         self.state_decoder, self.reward_decoder, self.task_decoder, self.exploration_value_decoder, self.exploitation_value_decoder, self.action_decoder = self.initialise_decoder()
@@ -173,6 +215,12 @@ class Base2Final:
 
         # initialise rollout storage for the VAE update
         # (this differs from the data that the on-policy RL algorithm uses)
+        prefetch_batchsize = self.args.vae_batch_num_trajs if self.args.vae_prefetch_batches else None
+        if self.args.vae_buffer_dir is not None:
+            exploration_buffer_dir = os.path.join(self.args.vae_buffer_dir, 'exploration')
+            exploitation_buffer_dir = os.path.join(self.args.vae_buffer_dir, 'exploitation')
+        else:
+            exploration_buffer_dir = exploitation_buffer_dir = None
         self.exploration_rollout_storage = RolloutStorageVAE(num_processes=exploration_num_processes,
                                                              max_trajectory_len=self.args.max_trajectory_len,
                                                              zero_pad=True,
@@ -181,7 +229,13 @@ class Base2Final:
                                                              action_dim=self.args.action_dim,
                                                              vae_buffer_add_thresh=self.args.vae_buffer_add_thresh,
                                                              task_dim=self.task_dim,
-                                                             save_intrinsic_reward=True
+                                                             save_intrinsic_reward=True,
+                                                             prefetch_batchsize=prefetch_batchsize,
+                                                             buffer_dir=exploration_buffer_dir,
+                                                             compact=self.args.vae_buffer_compact or self.args.compact_obs,
+                                                             seed=self.args.seed,
+                                                             action_space=self.args.action_space,
+                                                             observation_space=self.args.observation_space
                                                              )
         self.exploitation_rollout_storage = RolloutStorageVAE(num_processes=exploitation_num_processes,
                                                               max_trajectory_len=self.args.max_trajectory_len,
@@ -191,6 +245,12 @@ class Base2Final:
                                                               action_dim=self.args.action_dim,
                                                               vae_buffer_add_thresh=self.args.vae_buffer_add_thresh,
                                                               task_dim=self.task_dim,
+                                                              prefetch_batchsize=prefetch_batchsize,
+                                                              buffer_dir=exploitation_buffer_dir,
+                                                              compact=self.args.vae_buffer_compact or self.args.compact_obs,
+                                                              seed=self.args.seed + 1,
+                                                              action_space=self.args.action_space,
+                                                              observation_space=self.args.observation_space
                                                               )
         # initalise optimiser for the brim_core and decoders
         decoder_params = []
@@ -1189,7 +1249,7 @@ class Base2Final:
                 batchsize=self.args.vae_batch_num_trajs, memory_batch=True)
             max_len = max(trajectory_lens)
 
-            brim_output_level1, brim_output_level2, brim_output_level3, _, \
+            brim_output_level1, brim_output_level2, brim_output_level3, brim_hidden_states, \
             latent_sample, latent_mean, latent_logvar, _, policy_embedded_state = self.brim_core.forward_exploration_branch(
                 actions=vae_actions,
                 states=vae_next_obs,
@@ -1240,20 +1300,31 @@ class Base2Final:
             latent_mean=latent_mean,
             latent_logvar=latent_logvar).detach().clone()
 
-        self.brim_core.brim.model.memory.prior(batch_size=state.shape[1], activated_branch=activated_branch)
-
-        for i in range(max_len):
-            self.brim_core.brim.model.memory.reset(done_task[i], done_episode[i], activated_branch)
-            self.brim_core.brim.model.memory.write(key=(state[i], latent[i]), value=rim_output[i], rpe=None, activated_branch=activated_branch)
-        res = []
-        idx = torch.randperm(state.shape[0])
-        target = rim_output[idx, :, :]
+        memory = self.brim_core.brim.model.memory
+        memory.prior(batch_size=state.shape[1], activated_branch=activated_branch)
         level = 0 if activated_branch == 'exploration' else 1
         brim_hidden_states = brim_hidden_states[1:max_len+1, :, level, :]
-        for i in range(len(idx)):
-            res.append(self.brim_core.brim.model.memory.read(query=(state[idx[i]], latent[idx[i]]), rim_hidden_state=brim_hidden_states[idx[i]], activated_branch=activated_branch))
-        res = torch.stack(res)
-        memory_loss = (res - target).pow(2).sum()
+
+        if self.args.memory_loss_mode != 'sequential' and not self.args.use_hebb:
+            # teacher forcing: encode all writes at once and do all reads in one masked attention call
+            visible = memory_visibility_mask(done_episode[:max_len], memory.episodic.episode_len,
+                                             causal=self.args.memory_loss_mode == 'causal')
+            res = memory.read_batch(query=(state, latent),
+                                    rim_hidden_state=brim_hidden_states,
+                                    memory=memory.encode(key=(state, latent), value=rim_output),
+                                    visible=visible)
+            memory_loss = (res - rim_output).pow(2).sum()
+        else:
+            for i in range(max_len):
+                memory.reset(done_task[i], done_episode[i], activated_branch)
+                memory.write(key=(state[i], latent[i]), value=rim_output[i], rpe=None, activated_branch=activated_branch)
+            res = []
+            idx = torch.randperm(state.shape[0])
+            target = rim_output[idx, :, :]
+            for i in range(len(idx)):
+                res.append(memory.read(query=(state[idx[i]], latent[idx[i]]), rim_hidden_state=brim_hidden_states[idx[i]], activated_branch=activated_branch))
+            res = torch.stack(res)
+            memory_loss = (res - target).pow(2).sum()
         self.log_memory_loss(memory_loss, activated_branch)
         return memory_loss
 
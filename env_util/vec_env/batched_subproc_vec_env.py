@@ -0,0 +1,168 @@
+"""
+Based on the SubprocVecEnv from https://github.com/openai/baselines
+"""
+from multiprocessing import Process, Pipe
+
+import numpy as np
+
+from . import VecEnv, CloudpickleWrapper
+
+
+def batched_worker(remote, parent_remote, env_fn_wrappers):
+    """
+    Owns several environments and steps them one after the other,
+    so that each command is answered with a single (batched) message.
+    """
+    parent_remote.close()
+    envs = [env_fn() for env_fn in env_fn_wrappers.x]
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                results = [env.step(action) for env, action in zip(envs, data)]
+                obs, rews, dones, infos = zip(*results)
+                remote.send((np.stack(obs), np.stack(rews), np.stack(dones), infos))
+            elif cmd == 'reset':
+                remote.send(np.stack([env.reset() for env in envs]))
+            elif cmd == 'reset_at':
+                remote.send(envs[data].reset())
+            elif cmd == 'reset_mdp':
+                remote.send(np.stack([env.reset_mdp() for env in envs]))
+            elif cmd == 'reset_mdp_at':
+                remote.send(envs[data].reset_mdp())
+            elif cmd == 'render':
+                remote.send([env.render(mode='rgb_array') for env in envs])
+            elif cmd == 'close':
+                remote.close()
+                break
+            elif cmd == 'get_spaces':
+                remote.send((envs[0].observation_space, envs[0].action_space))
+            elif cmd == 'get_task':
+                remote.send([env.get_task() for env in envs])
+            elif cmd == 'get_belief':
+                remote.send([env.get_belief() for env in envs])
+            elif cmd == 'reset_task':
+                for env in envs:
+                    env.unwrapped.reset_task()
+            else:
+                # try to get the attribute directly
+                remote.send(getattr(envs[0].unwrapped, cmd))
+    except KeyboardInterrupt:
+        print('BatchedSubprocVecEnv worker: got KeyboardInterrupt')
+    finally:
+        for env in envs:
+            env.close()
+
+
+class BatchedSubprocVecEnv(VecEnv):
+    """
+    VecEnv that runs the envs in `num_workers` subprocesses, each of which owns a contiguous block of envs.
+    For cheap environments (gridworlds, MiniGrid) this amortises the process / IPC overhead over many envs,
+    and decouples the number of processes from the number of envs.
+    """
+
+    def __init__(self, env_fns, num_workers):
+        """
+        Arguments:
+
+        env_fns: iterable of callables -  functions that create envs to run in subprocesses. Need to be cloud-pickleable
+        num_workers: number of subprocesses the envs are distributed over
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+        num_workers = min(num_workers, nenvs)
+        # env indices owned by each worker
+        self.env_blocks = np.array_split(np.arange(nenvs), num_workers)
+        # for each env: the worker that owns it, and its index within that worker
+        self.env_worker = np.concatenate([np.full(len(block), w) for w, block in enumerate(self.env_blocks)])
+        self.env_index_in_worker = np.concatenate([np.arange(len(block)) for block in self.env_blocks])
+
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(num_workers)])
+        self.ps = [Process(target=batched_worker,
+                           args=(work_remote, remote, CloudpickleWrapper([env_fns[i] for i in block])))
+                   for (work_remote, remote, block) in zip(self.work_remotes, self.remotes, self.env_blocks)]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, action_space = self.remotes[0].recv()
+        self.viewer = None
+        VecEnv.__init__(self, nenvs, observation_space, action_space)
+
+    def step_async(self, actions):
+        self._assert_not_closed()
+        for remote, block in zip(self.remotes, self.env_blocks):
+            remote.send(('step', actions[block]))
+        self.waiting = True
+
+    def step_wait(self):
+        self._assert_not_closed()
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, rews, dones, infos = zip(*results)
+        return np.concatenate(obs), np.concatenate(rews), np.concatenate(dones), sum(infos, ())
+
+    def reset(self, task=None):
+        self._assert_not_closed()
+        for remote in self.remotes:
+            remote.send(('reset', task))
+        return np.concatenate([remote.recv() for remote in self.remotes])
+
+    def reset_at(self, index):
+        """ Resets (the BAMDP of) a single env """
+        self._assert_not_closed()
+        remote = self.remotes[self.env_worker[index]]
+        remote.send(('reset_at', self.env_index_in_worker[index]))
+        return remote.recv()
+
+    def reset_mdp(self):
+        self._assert_not_closed()
+        for remote in self.remotes:
+            remote.send(('reset_mdp', None))
+        return np.concatenate([remote.recv() for remote in self.remotes])
+
+    def reset_mdp_at(self, index):
+        """ Resets the underlying MDP (*not* the task) of a single env """
+        self._assert_not_closed()
+        remote = self.remotes[self.env_worker[index]]
+        remote.send(('reset_mdp_at', self.env_index_in_worker[index]))
+        return remote.recv()
+
+    def close_extras(self):
+        self.closed = True
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+
+    def get_images(self):
+        self._assert_not_closed()
+        for pipe in self.remotes:
+            pipe.send(('render', None))
+        return sum([pipe.recv() for pipe in self.remotes], [])
+
+    def _assert_not_closed(self):
+        assert not self.closed, "Trying to operate on a BatchedSubprocVecEnv after calling close()"
+
+    def get_env_attr(self, attr):
+        self.remotes[0].send((attr, None))
+        return self.remotes[0].recv()
+
+    def get_task(self):
+        self._assert_not_closed()
+        for remote in self.remotes:
+            remote.send(('get_task', None))
+        return np.stack(sum([remote.recv() for remote in self.remotes], []))
+
+    def get_belief(self):
+        self._assert_not_closed()
+        for remote in self.remotes:
+            remote.send(('get_belief', None))
+        return np.stack(sum([remote.recv() for remote in self.remotes], []))
@@ -0,0 +1,120 @@
+"""
+Based on the ShmemVecEnv from https://github.com/openai/baselines
+"""
+from multiprocessing import Process, Pipe, RawArray
+
+import numpy as np
+
+from . import VecEnv, CloudpickleWrapper
+from .subproc_vec_env import SubprocVecEnv
+
+
+def shmem_worker(remote, parent_remote, env_fn_wrapper, index, obs_buf, rew_buf, done_buf, obs_shape, obs_dtype):
+    """
+    Same as the SubprocVecEnv worker, except that on a step the observation, reward and done flag are written
+    into the shared-memory buffers and only the info dict is sent back over the pipe.
+    """
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+    obs = np.frombuffer(obs_buf, dtype=obs_dtype).reshape((-1,) + obs_shape)
+    rews = np.frombuffer(rew_buf, dtype=np.float64)
+    dones = np.frombuffer(done_buf, dtype=np.bool_)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                ob, reward, done, info = env.step(data)
+                obs[index] = ob
+                rews[index] = reward
+                dones[index] = done
+                remote.send(info)
+            elif cmd == 'close':
+                remote.close()
+                break
+            else:
+                # everything else (resets, tasks, beliefs, attributes) is rare and goes over the pipe
+                remote.send(handle_command(env, cmd))
+    except KeyboardInterrupt:
+        print('ShmemVecEnv worker: got KeyboardInterrupt')
+    finally:
+        env.close()
+
+
+def handle_command(env, cmd):
+    if cmd == 'reset':
+        return env.reset()
+    elif cmd == 'reset_mdp':
+        return env.reset_mdp()
+    elif cmd == 'render':
+        return env.render(mode='rgb_array')
+    elif cmd == 'get_spaces':
+        return env.observation_space, env.action_space
+    elif cmd == 'get_task':
+        return env.get_task()
+    elif cmd == 'task_dim':
+        return env.task_dim
+    elif cmd == 'get_belief':
+        return env.get_belief()
+    elif cmd == 'belief_dim':
+        return env.belief_dim
+    elif cmd == 'reset_task':
+        env.unwrapped.reset_task()
+        return None
+    else:
+        # try to get the attribute directly
+        return getattr(env.unwrapped, cmd)
+
+
+class ShmemVecEnv(SubprocVecEnv):
+    """
+    SubprocVecEnv whose workers write observations, rewards and dones of a step directly into
+    preallocated shared memory, so that only the (small) info dicts are pickled and sent over the pipes.
+    The observations returned by step_wait are a view on the shared buffer and are overwritten by the next step.
+    Resets, tasks, beliefs and attributes work exactly as in the SubprocVecEnv.
+    """
+
+    def __init__(self, env_fns):
+        """
+        Arguments:
+
+        env_fns: iterable of callables -  functions that create envs to run in subprocesses. Need to be cloud-pickleable
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+
+        # we need the observation space to allocate the shared memory before starting the workers
+        dummy = env_fns[0]()
+        observation_space, action_space = dummy.observation_space, dummy.action_space
+        dummy.close()
+        del dummy
+
+        obs_shape = tuple(observation_space.shape)
+        obs_dtype = np.dtype(observation_space.dtype)
+        self.obs_buf = RawArray(np.ctypeslib.as_ctypes_type(obs_dtype), nenvs * int(np.prod(obs_shape)))
+        self.rew_buf = RawArray(np.ctypeslib.as_ctypes_type(np.float64), nenvs)
+        self.done_buf = RawArray(np.ctypeslib.as_ctypes_type(np.bool_), nenvs)
+        self.obs = np.frombuffer(self.obs_buf, dtype=obs_dtype).reshape((nenvs,) + obs_shape)
+        self.rews = np.frombuffer(self.rew_buf, dtype=np.float64)
+        self.dones = np.frombuffer(self.done_buf, dtype=np.bool_)
+
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
+        self.ps = [Process(target=shmem_worker,
+                           args=(work_remote, remote, CloudpickleWrapper(env_fn), index,
+                                 self.obs_buf, self.rew_buf, self.done_buf, obs_shape, obs_dtype))
+                   for index, (work_remote, remote, env_fn) in enumerate(zip(self.work_remotes, self.remotes, env_fns))]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+
+        self.viewer = None
+        VecEnv.__init__(self, nenvs, observation_space, action_space)
+
+    def step_wait(self):
+        self._assert_not_closed()
+        # once a worker has sent its info, its part of the shared buffers has been written
+        infos = tuple(remote.recv() for remote in self.remotes)
+        self.waiting = False
+        return self.obs, self.rews.copy(), self.dones.copy(), infos
@@ -67,6 +67,9 @@ class VecNormalize(VecEnvWrapper):
     def reset_mdp(self, index=None):
         if index is None:
             obs = self.venv.reset_mdp()
+        elif hasattr(self.venv, 'reset_mdp_at'):
+            # several envs per worker process
+            obs = self.venv.reset_mdp_at(index)
         else:
             self.venv.remotes[index].send(('reset_mdp', None))
             obs = self.venv.remotes[index].recv()
@@ -76,6 +79,9 @@ class VecNormalize(VecEnvWrapper):
         self.ret = np.zeros(self.num_envs)
         if index is None:
             obs = self.venv.reset(task=task)
+        elif hasattr(self.venv, 'reset_at'):
+            # several envs per worker process
+            obs = self.venv.reset_at(index)
         else:
             try:
                 self.venv.remotes[index].send(('reset', task))
@@ -1,6 +1,8 @@
 import math
 import hashlib
 import gym
+from collections import OrderedDict
+from copy import deepcopy
 from enum import IntEnum
 import numpy as np
 from gym import error, spaces, utils
@@ -343,6 +345,11 @@ class Grid:
 
         self.grid = [None] * width * height
 
+        # array copy of the grid: the encoding of every cell, and whether the agent can see behind it
+        self.encoding = np.zeros((width, height, 3), dtype='uint8')
+        self.encoding[:, :, 0] = OBJECT_TO_IDX['empty']
+        self.see_behind_mask = np.ones((width, height), dtype=bool)
+
     def __contains__(self, key):
         if isinstance(key, WorldObj):
             for e in self.grid:
@@ -374,6 +381,20 @@ class Grid:
         assert i >= 0 and i < self.width
         assert j >= 0 and j < self.height
         self.grid[j * self.width + i] = v
+        self.refresh(i, j)
+
+    def refresh(self, i, j):
+        """
+        Update the array copy of a cell, needed when its object changes in place (e.g. a door is toggled)
+        """
+
+        v = self.grid[j * self.width + i]
+        if v is None:
+            self.encoding[i, j] = (OBJECT_TO_IDX['empty'], 0, 0)
+            self.see_behind_mask[i, j] = True
+        else:
+            self.encoding[i, j] = v.encode()
+            self.see_behind_mask[i, j] = v.see_behind()
 
     def get(self, i, j):
         assert i >= 0 and i < self.width
@@ -615,6 +636,63 @@ class Grid:
 
         return mask
 
+    @staticmethod
+    def process_vis_array(see_behind_mask, agent_pos):
+        """
+        Same visibility mask as process_vis, computed from the see-behind mask of the grid
+        (which can have leading batch dimensions, to process several views at once).
+        Each row is swept left to right and then right to left like in process_vis, but a sweep is done at once:
+        a cell becomes visible if a visible cell on its left (resp. right) is followed by see-through cells only.
+        """
+
+        width, height = see_behind_mask.shape[-2:]
+        mask = np.zeros(shape=see_behind_mask.shape, dtype=bool)
+        mask[..., agent_pos[0], agent_pos[1]] = True
+        idx = np.arange(width)
+
+        def sweep(visible, see_behind):
+            # index of the last visible, and the last opaque, cell up to each position
+            last_visible = np.maximum.accumulate(np.where(visible, idx, -1), axis=-1)
+            last_opaque = np.maximum.accumulate(np.where(see_behind, -1, idx), axis=-1)
+            visible = visible.copy()
+            visible[..., 1:] |= last_visible[..., :-1] > last_opaque[..., :-1]
+            return visible
+
+        for j in reversed(range(0, height)):
+            see_behind = see_behind_mask[..., j]
+            left = sweep(mask[..., j], see_behind)
+            row = sweep(left[..., ::-1], see_behind[..., ::-1])[..., ::-1]
+            mask[..., j] = row
+
+            if j > 0:
+                # a visible see-through cell reveals the cells above it and above its neighbour in the sweep direction
+                up = (left[..., :-1] & see_behind[..., :-1]) | (row[..., 1:] & see_behind[..., 1:])
+                mask[..., :-1, j-1] |= up
+                mask[..., 1:, j-1] |= up
+
+        return mask
+
+class LayoutCache:
+    """
+    Bounded LRU cache of the layouts generated by _gen_grid, keyed by the seed of the RNG they were generated with
+    """
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.layouts = OrderedDict()
+
+    def get(self, seed):
+        if seed not in self.layouts:
+            return None
+        self.layouts.move_to_end(seed)
+        return self.layouts[seed]
+
+    def put(self, seed, layout):
+        self.layouts[seed] = layout
+        self.layouts.move_to_end(seed)
+        while len(self.layouts) > self.max_size:
+            self.layouts.popitem(last=False)
+
 class MiniGridEnv(gym.Env):
     """
     2D grid world game environment
@@ -625,6 +703,17 @@ class MiniGridEnv(gym.Env):
         'video.frames_per_second' : 10
     }
 
+    # If set, the layouts generated right after seeding are cached, and a reset after seeding with the same seed
+    # again restores the layout instead of generating it (see gen_layout)
+    layout_cache = None
+    # Seed of the RNG, as long as nothing was drawn from it since seeding
+    layout_seed = None
+    # Attributes that are not part of a layout: configuration, rendering, layout cache and episode state
+    layout_excluded_keys = frozenset([
+        'layout_cache', 'layout_seed', 'window', 'actions', 'action_space', 'observation_space', 'reward_range',
+        'width', 'height', 'max_steps', 'see_through_walls', 'agent_view_size', 'carrying', 'step_count', 'spec'
+    ])
+
     # Enumeration of possible actions
     class Actions(IntEnum):
         # Turn left, turn right, move forward
@@ -711,7 +800,7 @@ class MiniGridEnv(gym.Env):
         # Generate a new random grid at the start of each episode
         # To keep the same grid for each episode, call env.seed() with
         # the same seed before calling env.reset()
-        self._gen_grid(self.width, self.height)
+        self.gen_layout()
 
         # These fields should be defined by _gen_grid
         assert self.agent_pos is not None
@@ -734,8 +823,34 @@ class MiniGridEnv(gym.Env):
     def seed(self, seed=1337):
         # Seed the random number generator
         self.np_random, seed = seeding.np_random(seed)
+        self.layout_seed = seed
         return [seed]
 
+    def gen_layout(self):
+        """
+        Generate the grid with _gen_grid, or restore it from the layout cache.
+        The layout is everything _gen_grid sets on the env (the grid, the agent pose, the mission and the
+        env-specific attributes such as the target object) and the RNG state it leaves behind, so a restored
+        layout is the same as a regenerated one. It is copied as a whole to keep the references between its objects.
+        All the attributes but layout_excluded_keys are kept, not only the ones _gen_grid rebound: it can draw the
+        object that was already there (e.g. the same color string), which must still be restored for this seed.
+        """
+
+        seed, self.layout_seed = self.layout_seed, None
+        if self.layout_cache is None or seed is None:
+            self._gen_grid(self.width, self.height)
+            return
+
+        layout = self.layout_cache.get(seed)
+        if layout is not None:
+            self.__dict__.update(deepcopy(layout))
+            return
+
+        self._gen_grid(self.width, self.height)
+        # callables are set by wrappers (e.g. get_belief), and would copy whatever they are bound to
+        layout = {k: v for k, v in self.__dict__.items() if k not in self.layout_excluded_keys and not callable(v)}
+        self.layout_cache.put(seed, deepcopy(layout))
+
     def hash(self, size=16):
         """Compute a hash that uniquely identifies the current state of the environment.
         :param size: Size of the hashing
@@ -1147,6 +1262,7 @@ class MiniGridEnv(gym.Env):
         elif action == self.actions.toggle:
             if fwd_cell:
                 fwd_cell.toggle(self, fwd_pos)
+                self.grid.refresh(*fwd_pos)
 
         # Done action (not used by default)
         elif action == self.actions.done:
@@ -1194,15 +1310,53 @@ class MiniGridEnv(gym.Env):
 
         return grid, vis_mask
 
+    def gen_obs_image(self):
+        """
+        Generate the encoding of the agent's view from the array copy of the grid.
+        This is the same as gen_obs_grid followed by Grid.encode, without building and rotating a Grid.
+        """
+
+        topX, topY, botX, botY = self.get_view_exts()
+        view_size = self.agent_view_size
+
+        # cells outside of the grid are seen as walls
+        view = np.zeros((view_size, view_size, 3), dtype='uint8')
+        view[:, :] = Wall().encode()
+        see_behind = np.zeros((view_size, view_size), dtype=bool)
+        x0, y0 = max(topX, 0), max(topY, 0)
+        x1, y1 = min(botX, self.grid.width), min(botY, self.grid.height)
+        if x0 < x1 and y0 < y1:
+            view[x0 - topX:x1 - topX, y0 - topY:y1 - topY] = self.grid.encoding[x0:x1, y0:y1]
+            see_behind[x0 - topX:x1 - topX, y0 - topY:y1 - topY] = self.grid.see_behind_mask[x0:x1, y0:y1]
+
+        # rotate so that the agent faces up (rotate_left is a clockwise rotation of the [x, y] array)
+        view = np.rot90(view, k=-(self.agent_dir + 1))
+        see_behind = np.rot90(see_behind, k=-(self.agent_dir + 1))
+
+        agent_pos = view_size // 2, view_size - 1
+        if not self.see_through_walls:
+            vis_mask = Grid.process_vis_array(see_behind, agent_pos)
+        else:
+            vis_mask = np.ones(shape=(view_size, view_size), dtype=bool)
+
+        image = np.zeros((view_size, view_size, 3), dtype='uint8')
+        image[vis_mask] = view[vis_mask]
+
+        # the agent sees what it's carrying at its own position
+        if self.carrying:
+            image[agent_pos] = self.carrying.encode()
+        else:
+            image[agent_pos] = (OBJECT_TO_IDX['empty'], 0, 0)
+
+        return image
+
     def gen_obs(self):
         """
         Generate the agent's view (partially observable, low-resolution encoding)
         """
 
-        grid, vis_mask = self.gen_obs_grid()
-
         # Encode the partially observable view into a numpy array
-        image = grid.encode(vis_mask)
+        image = self.gen_obs_image()
 
         assert hasattr(self, 'mission'), "environments must define a textual mission string"
 
@@ -4,7 +4,7 @@ import random
 import numpy as np
 import gym
 from gym_minigrid.register import env_list
-from gym_minigrid.minigrid import Grid, OBJECT_TO_IDX
+from gym_minigrid.minigrid import Grid, LayoutCache, OBJECT_TO_IDX
 
 # Test specifically importing a specific environment
 from gym_minigrid.envs import DoorKeyEnv
@@ -14,6 +14,11 @@ from gym_minigrid.wrappers import *
 
 ##############################################################################
 
+def layout_attributes(env):
+    """ The mission and the env-specific attributes of the layout, such as the target type, color and position """
+    return {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in vars(env.unwrapped).items()
+            if isinstance(v, (str, int, float, tuple, np.ndarray, np.generic))}
+
 print('%d environments registered' % len(env_list))
 
 for env_idx, env_name in enumerate(env_list):
@@ -34,6 +39,27 @@ for env_idx, env_name in enumerate(env_list):
         grid2 = env.grid
         assert grid1 == grid2
 
+    # Verify that a layout restored from the cache is the one that would be generated
+    cached_env = gym.make(env_name)
+    cached_env.unwrapped.layout_cache = LayoutCache()
+    for seed in [1337, 1338, 1337]:
+        cached_env.seed(seed)
+        cached_obs = cached_env.reset()
+        for _ in range(10):
+            cached_env.step(random.randint(0, cached_env.action_space.n - 1))
+        cached_env.seed(seed)
+        cached_obs2 = cached_env.reset()
+        env.seed(seed)
+        obs = env.reset()
+        assert np.array_equal(obs['image'], cached_obs['image'])
+        assert np.array_equal(obs['image'], cached_obs2['image'])
+        assert env.grid == cached_env.grid
+        assert np.array_equal(env.agent_pos, cached_env.agent_pos) and env.agent_dir == cached_env.agent_dir
+        assert env.mission == cached_env.mission
+        assert layout_attributes(env) == layout_attributes(cached_env)
+        assert env.np_random.randint(1 << 30) == cached_env.np_random.randint(1 << 30)
+    cached_env.close()
+
     env.reset()
 
     # Run for a few episodes
@@ -48,6 +74,10 @@ for env_idx, env_name in enumerate(env_list):
         assert env.agent_pos[0] < env.width
         assert env.agent_pos[1] < env.height
 
+        # The array-backed observation matches the one built from the Grid objects
+        grid, vis_mask = env.gen_obs_grid()
+        assert np.array_equal(obs['image'], grid.encode(vis_mask))
+
         # Test observation encode/decode roundtrip
         img = obs['image']
         grid, vis_mask = Grid.decode(img)
@@ -47,11 +47,11 @@ class MetaLearner:
         if self.args.exploration_processes_portion == 1.0:
             train_exploitation = False
 
-        if self.args.bebold_intrinsic_reward:
-            self.episode_state_count_dict = list()
-            for i in range(self.exploration_num_processes):
-                self.episode_state_count_dict.append({})
-
+        # encoding of the current step of the running trajectories at the end of the last rollout (and the number of
+        # encoder / policy updates done before it was computed), see encode_running_trajectory
+        self.running_encoding_cache = {'exploration': None, 'exploitation': None}
+        self.num_encoder_updates = 0
+        self.running_encoding_shapes = {'exploration': None, 'exploitation': None}
         self.start_idx = 0
         if self.args.load_model and os.path.exists(os.path.join(self.logger.full_output_folder, 'models', 'general.pt')):
             save_path = os.path.join(self.logger.full_output_folder, 'models')
@@ -65,14 +65,22 @@ class MetaLearner:
                                                   num_processes=self.exploration_num_processes,
                                                   gamma=args.policy_gamma, device=device,
                                                   episodes_per_task=self.args.max_rollouts_per_task,
-                                                  normalise_rew=args.norm_rew_for_policy, ret_rms=None)
+                                                  normalise_rew=args.norm_rew_for_policy, ret_rms=None,
+                                                  compact_obs=args.compact_obs,
+                                                  shared_memory=args.vec_env_shared_memory,
+                                                  num_workers=args.num_env_workers,
+                                                  vectorized_env=args.vectorized_env)
         if train_exploitation:
             seed = args.seed + self.start_idx * 64 + self.exploitation_num_processes
             self.exploitation_envs = make_vec_envs(env_name=args.env_name, seed=seed,
                                                    num_processes=self.exploitation_num_processes,
                                                    gamma=args.policy_gamma, device=device,
                                                    episodes_per_task=self.args.max_rollouts_per_task,
-                                                   normalise_rew=args.norm_rew_for_policy, ret_rms=None)
+                                                   normalise_rew=args.norm_rew_for_policy, ret_rms=None,
+                                                   compact_obs=args.compact_obs,
+                                                   shared_memory=args.vec_env_shared_memory,
+                                                   num_workers=args.num_env_workers,
+                                                   vectorized_env=args.vectorized_env)
 
         envs = self.exploration_envs if self.exploration_envs is not None else self.exploitation_envs
         # calculate what the maximum length of the trajectories is
@@ -80,10 +88,16 @@ class MetaLearner:
         self.args.max_trajectory_len *= self.args.max_rollouts_per_task
         if self.args.policy_num_steps is None:
             self.args.policy_num_steps = self.args.max_trajectory_len
+
+        if self.args.bebold_intrinsic_reward:
+            # the counts are reset at the end of every episode, so a process never sees more distinct states than this
+            self.episode_state_counts = utl.EpisodeStateCounts(self.exploration_num_processes,
+                                                                   self.args.max_trajectory_len + 1)
         self.num_updates = int(args.num_frames) // args.policy_num_steps // args.num_processes
 
         # get policy input dimensions
         self.args.state_dim = envs.observation_space.shape[0]
+        self.args.observation_space = envs.observation_space
         self.args.task_dim = envs.task_dim
         self.args.belief_dim = envs.belief_dim
         self.args.num_states = envs.num_states
@@ -310,8 +324,8 @@ class MetaLearner:
             exploration_prev_state, exploration_belief, exploration_task = utl.reset_env(self.exploration_envs,
                                                                                          self.args)
             if self.args.bebold_intrinsic_reward:
-                self.episode_state_count_dict = utl.episode_state_count_dict_management(exploration_prev_state,
-                                                                                        self.episode_state_count_dict)
+                self.episode_state_counts = utl.count_episode_states(exploration_prev_state,
+                                                                                        self.episode_state_counts)
         if train_exploitation:
             exploitation_prev_state, exploitation_belief, exploitation_task = utl.reset_env(self.exploitation_envs,
                                                                                             self.args)
@@ -420,6 +434,9 @@ class MetaLearner:
                             brim_output_level1=brim_output1,
                             policy_embedded_state=exploration_policy_embedded_state
                         )
+                        if self.args.pipelined_rollouts:
+                            # the exploration envs simulate while we select the exploitation actions
+                            utl.env_step_async(self.exploration_envs, exploration_action)
                     if train_exploitation:
                         exploitation_value, exploitation_action, exploitation_action_log_prob = utl.select_action(
                             args=self.args,
@@ -433,12 +450,20 @@ class MetaLearner:
                             brim_output_level1=brim_output2,
                             policy_embedded_state=exploitation_policy_embedded_state,
                         )
+                        if self.args.pipelined_rollouts:
+                            # the exploitation envs simulate while we process the exploration step
+                            utl.env_step_async(self.exploitation_envs, exploitation_action)
 
                 # take step in the environment
                 if train_exploration:
-                    [exploration_next_state, exploration_belief, exploration_task], \
-                    (exploration_rew_raw, exploration_rew_normalised), \
-                    exploration_done, exploration_infos = utl.env_step(self.exploration_envs, exploration_action, self.args)
+                    if self.args.pipelined_rollouts:
+                        [exploration_next_state, exploration_belief, exploration_task], \
+                        (exploration_rew_raw, exploration_rew_normalised), \
+                        exploration_done, exploration_infos = utl.env_step_wait(self.exploration_envs, self.args)
+                    else:
+                        [exploration_next_state, exploration_belief, exploration_task], \
+                        (exploration_rew_raw, exploration_rew_normalised), \
+                        exploration_done, exploration_infos = utl.env_step(self.exploration_envs, exploration_action, self.args)
 
                     latent = utl.get_latent_for_policy(sample_embeddings=True,
                                                        add_nonlinearity_to_latent=self.args.add_nonlinearity_to_latent,
@@ -462,20 +487,21 @@ class MetaLearner:
                     exploration_done_episode = torch.Tensor(exploration_done_episode).float().to(device).unsqueeze(1)
 
                     if self.args.bebold_intrinsic_reward:
-                        self.episode_state_count_dict = utl.episode_state_count_dict_management(exploration_next_state, self.episode_state_count_dict)
+                        self.episode_state_counts = utl.count_episode_states(exploration_next_state, self.episode_state_counts)
 
-                        exploration_intrinsic_rew_raw, exploration_intrinsic_rew_normalised, self.episode_state_count_dict = utl.bebold_intrinsic_reward(
+                        exploration_intrinsic_rew_raw, exploration_intrinsic_rew_normalised, self.episode_state_counts = utl.bebold_intrinsic_reward(
                             rew_raw=exploration_rew_raw,
                             state=exploration_prev_state,
                             next_state=exploration_next_state,
                             random_target_network=self.base2final.random_target_network,
                             predictor_network=self.base2final.predictor_network,
-                            episode_state_count_dict=self.episode_state_count_dict,
+                            episode_state_counts=self.episode_state_counts,
                             done_episode=exploration_done_episode,
                             args=self.args)
                     else:
                         exploration_intrinsic_rew_raw, \
-                        exploration_intrinsic_rew_normalised, state_error, action_error, reward_error, epi_reward = utl.compute_intrinsic_reward(
+                        exploration_intrinsic_rew_normalised, state_error, action_error, reward_error, epi_reward, \
+                        exploration_reward_pred = utl.compute_intrinsic_reward(
                             exploration_rew_raw,
                             exploration_rew_normalised,
                             latent=latent,
@@ -504,7 +530,10 @@ class MetaLearner:
                             epi_reward_running_normalizer=self.epi_reward_running_normalizer,
                             exponential_temp_epi=self.args.exponential_temp_epi,
                             intrinsic_reward_running_normalizer=self.intrinsic_reward_running_normalizer,
-                            state_encoder=self.base2final.action_decoder.state_t_encoder if self.base2final.action_decoder is not None else None
+                            state_encoder=self.base2final.action_decoder.state_t_encoder if self.base2final.action_decoder is not None else None,
+                            episodic_reward_num_neighbours=self.args.episodic_reward_num_neighbours,
+                            # the reward prediction is reused for the RPE below
+                            return_reward_prediction=True
                             )
                         state_errors.append(state_error)
                         action_errors.append(action_error)
@@ -520,45 +549,20 @@ class MetaLearner:
                     exploration_bad_masks = torch.FloatTensor(
                         [[0.0] if 'bad_transition' in info.keys() else [1.0] for info in exploration_infos]).to(device)
 
-                if train_exploitation:
-                    [exploitation_next_state, exploitation_belief, exploitation_task], \
-                    (exploitation_rew_raw, exploitation_rew_normalised), \
-                    exploitation_done, exploitation_infos = utl.env_step(self.exploitation_envs, exploitation_action, self.args)
-
-                    exploitation_done_episode = list()
-                    for i in range(self.exploitation_num_processes):
-                        exploitation_done_episode.append(1.0 if exploitation_infos[i]['done_mdp'] else 0.0)
-                    exploitation_done_episode = torch.Tensor(exploitation_done_episode).float().to(device).unsqueeze(1)
-
-                    exploitation_done = torch.from_numpy(np.array(exploitation_done, dtype=int)).to(device).float().view((-1, 1))
-                    # create mask for episode ends
-                    exploitation_masks_done = torch.FloatTensor(
-                        [[0.0] if done_ else [1.0] for done_ in exploitation_done]).to(device)
-                    # bad_mask is true if episode ended because time limit was reached
-                    exploitation_bad_masks = torch.FloatTensor(
-                        [[0.0] if 'bad_transition' in info.keys() else [1.0] for info in exploitation_infos]).to(device)
-
                 with torch.no_grad():
                     # compute next embedding (for next loop and/or value prediction bootstrap)
                     if train_exploration:
                         # compute RPE
                         if self.args.use_memory and self.args.use_rpe and self.args.decode_reward:
-                            reward_decoder = self.base2final.reward_decoder()
-                            latent = utl.get_latent_for_policy(sample_embeddings=True,
-                                                               add_nonlinearity_to_latent=self.args.add_nonlinearity_to_latent,
-                                                               latent_sample=exploration_latent_sample,
-                                                               latent_mean=exploration_latent_mean,
-                                                               latent_logvar=exploration_latent_logvar)
-                            if self.args.use_rim_level3:
-                                if self.args.residual_task_inference_latent:
-                                    latent = torch.cat((exploration_brim_output5.squeeze(0), latent), dim=-1)
-                                else:
-                                    latent = exploration_brim_output5
-
-                            rpe = exploration_rew_raw - reward_decoder(reward_decoder, latent, exploration_next_state, prev_state=exploration_prev_state, action=exploration_action, n_step_reward_prediction=False)
+                            if self.args.bebold_intrinsic_reward:
+                                exploration_reward_pred = utl.decode_transition(
+                                    latent, exploration_prev_state, exploration_next_state, exploration_action.float(),
+                                    reward_decoder=self.base2final.reward_decoder)[2]
+                            # otherwise the reward decoder was already evaluated on this latent for the intrinsic reward
+                            rpe = exploration_rew_raw - exploration_reward_pred
                         else:
                             rpe = 0.1 * torch.ones(size=(self.exploration_num_processes, 1))
-                        brim_output1, brim_output3, brim_output5, exploration_brim_hidden_state, exploration_latent_sample, exploration_latent_mean, exploration_latent_logvar, \
+                        brim_output1, brim_output3, exploration_brim_output5, exploration_brim_hidden_state, exploration_latent_sample, exploration_latent_mean, exploration_latent_logvar, \
                         exploration_task_inference_hidden_state, exploration_policy_embedded_state = utl.update_encoding(
                             policy=self.exploration_policy.actor_critic,
                             brim_core=self.base2final.brim_core,
@@ -571,10 +575,36 @@ class MetaLearner:
                             activated_branch='exploration',
                             done_episode=exploration_done_episode,
                             rpe=rpe)
+
+                # with --pipelined_rollouts, the exploitation envs simulate until here, while the exploration step is
+                # processed and its encoding updated (which does not depend on the exploitation step)
+                if train_exploitation:
+                    if self.args.pipelined_rollouts:
+                        [exploitation_next_state, exploitation_belief, exploitation_task], \
+                        (exploitation_rew_raw, exploitation_rew_normalised), \
+                        exploitation_done, exploitation_infos = utl.env_step_wait(self.exploitation_envs, self.args)
+                    else:
+                        [exploitation_next_state, exploitation_belief, exploitation_task], \
+                        (exploitation_rew_raw, exploitation_rew_normalised), \
+                        exploitation_done, exploitation_infos = utl.env_step(self.exploitation_envs, exploitation_action, self.args)
+
+                    exploitation_done_episode = list()
+                    for i in range(self.exploitation_num_processes):
+                        exploitation_done_episode.append(1.0 if exploitation_infos[i]['done_mdp'] else 0.0)
+                    exploitation_done_episode = torch.Tensor(exploitation_done_episode).float().to(device).unsqueeze(1)
+
+                    exploitation_done = torch.from_numpy(np.array(exploitation_done, dtype=int)).to(device).float().view((-1, 1))
+                    # create mask for episode ends
+                    exploitation_masks_done = torch.FloatTensor(
+                        [[0.0] if done_ else [1.0] for done_ in exploitation_done]).to(device)
+                    # bad_mask is true if episode ended because time limit was reached
+                    exploitation_bad_masks = torch.FloatTensor(
+                        [[0.0] if 'bad_transition' in info.keys() else [1.0] for info in exploitation_infos]).to(device)
+
+                with torch.no_grad():
                     if train_exploitation:
                         # compute RPE
                         if self.args.use_memory and self.args.use_rpe and self.args.decode_reward:
-                            reward_decoder = self.base2final.reward_decoder()
                             latent = utl.get_latent_for_policy(sample_embeddings=True,
                                                                add_nonlinearity_to_latent=self.args.add_nonlinearity_to_latent,
                                                                latent_sample=exploitation_latent_sample,
@@ -586,13 +616,12 @@ class MetaLearner:
                                 else:
                                     latent = exploitation_brim_output5
 
-                            rpe = exploitation_rew_raw - reward_decoder(reward_decoder, latent, exploitation_next_state,
-                                                                       prev_state=exploitation_prev_state,
-                                                                       action=exploitation_action,
-                                                                       n_step_reward_prediction=False)
+                            rpe = exploitation_rew_raw - utl.decode_transition(
+                                latent, exploitation_prev_state, exploitation_next_state, exploitation_action.float(),
+                                reward_decoder=self.base2final.reward_decoder)[2]
                         else:
                             rpe = 0.1 * torch.ones(size=(self.exploitation_num_processes, 1))
-                        brim_output2, brim_output4, brim_output5, exploitation_brim_hidden_state, exploitation_latent_sample, exploitation_latent_mean, exploitation_latent_logvar, \
+                        brim_output2, brim_output4, exploitation_brim_output5, exploitation_brim_hidden_state, exploitation_latent_sample, exploitation_latent_mean, exploitation_latent_logvar, \
                         exploitation_task_inference_hidden_state, exploitation_policy_embedded_state = utl.update_encoding(
                             brim_core=self.base2final.brim_core,
                             policy=self.exploitation_policy.actor_critic,
@@ -716,6 +745,18 @@ class MetaLearner:
                 self.total_frames += self.args.num_processes
                 self.in_this_run_frames += self.args.num_processes
 
+            if self.args.cache_running_encoding:
+                if train_exploration:
+                    self.cache_running_encoding((brim_output1, brim_output3, exploration_brim_output5, exploration_brim_hidden_state,
+                                                 exploration_latent_sample, exploration_latent_mean, exploration_latent_logvar,
+                                                 exploration_task_inference_hidden_state, exploration_policy_embedded_state),
+                                                activated_branch='exploration')
+                if train_exploitation:
+                    self.cache_running_encoding((brim_output2, brim_output4, exploitation_brim_output5, exploitation_brim_hidden_state,
+                                                 exploitation_latent_sample, exploitation_latent_mean, exploitation_latent_logvar,
+                                                 exploitation_task_inference_hidden_state, exploitation_policy_embedded_state),
+                                                activated_branch='exploitation')
+
             # --- UPDATE ---
 
             if self.args.precollect_len <= self.in_this_run_frames:
@@ -724,6 +765,7 @@ class MetaLearner:
                 if self.args.pretrain_len > 0 and not vae_is_pretrained:
                     for _ in range(self.args.pretrain_len):
                         self.base2final.compute_vae_loss(update=True)
+                    self.num_encoder_updates += 1
                     vae_is_pretrained = True
 
                 # otherwise do the normal update (policy + vae)
@@ -807,65 +849,51 @@ class MetaLearner:
         """
         (Re-)Encodes (for each process) the entire current trajectory.
         Returns sample/mean/logvar and hidden state (if applicable) for the current timestep.
+        With --cache_running_encoding, the encoding cached at the end of the last rollout is returned instead,
+        unless the brim core or the policy have changed since.
         :return:
         """
+        policy = self.exploration_policy if activated_branch == 'exploration' else self.exploitation_policy
+        if self.args.cache_running_encoding:
+            cached = self.running_encoding_cache[activated_branch]
+            if cached is not None and cached[0] == self.num_encoder_updates:
+                return cached[1]
 
         # for each process, get the current batch (zero-padded obs/act/rew + length indicators)
         prev_obs, next_obs, act, rew, lens = rollout_storage.get_running_batch()
 
         # get embedding - will return (1+sequence_len) * batch * input_size -- includes the prior!
         if activated_branch == 'exploration':
-            all_brim_output1, all_brim_output3, all_brim_output5, all_brim_hidden_states, \
-            all_latent_samples, all_latent_means, all_latent_logvars, all_hidden_states, all_exploration_policy_embedded_state = self.base2final.brim_core.forward_exploration_branch(
-                actions=act,
-                states=next_obs,
-                rewards=rew,
-                brim_hidden_state=None,
-                task_inference_hidden_state=None,
-                return_prior=True,
-                sample=True,
-                detach_every=None,
-                policy=self.exploration_policy.actor_critic,
-                prev_state=prev_obs[0, :, :])
-            # get the embedding / hidden state of the current time step (need to do this since we zero-padded)
-            latent_sample = (torch.stack([all_latent_samples[lens[i]][i] for i in range(len(lens))])).to(device)
-            latent_mean = (torch.stack([all_latent_means[lens[i]][i] for i in range(len(lens))])).to(device)
-            latent_logvar = (torch.stack([all_latent_logvars[lens[i]][i] for i in range(len(lens))])).to(device)
-            task_inference_hidden_state = (torch.stack([all_hidden_states[lens[i]][i] for i in range(len(lens))])).to(
-                device)
-            brim_output1 = (torch.stack([all_brim_output1[lens[i]][i] for i in range(len(lens))])).to(device)
-            exploration_policy_embedded_state = (torch.stack([all_exploration_policy_embedded_state[lens[i]][i] for i in range(len(lens))])).to(device)
-            brim_output3 = (torch.stack([all_brim_output3[lens[i]][i] for i in range(len(lens))])).to(device)
-            brim_output5 = (torch.stack([all_brim_output5[lens[i]][i] for i in range(len(lens))])).to(device)
-            brim_hidden_state = (torch.stack([all_brim_hidden_states[lens[i]][i] for i in range(len(lens))])).to(device)
-            return brim_output1, brim_output3, brim_output5, brim_hidden_state, latent_sample, latent_mean, latent_logvar, task_inference_hidden_state, exploration_policy_embedded_state
+            forward_branch = self.base2final.brim_core.forward_exploration_branch
         elif activated_branch == 'exploitation':
-            all_brim_output2, all_brim_output4, all_brim_output5, all_brim_hidden_states, \
-            all_latent_samples, all_latent_means, all_latent_logvars, all_hidden_states, all_exploitation_policy_embedded_state = self.base2final.brim_core.forward_exploitation_branch(
-                actions=act,
-                states=next_obs,
-                rewards=rew,
-                brim_hidden_state=None,
-                task_inference_hidden_state=None,
-                return_prior=True,
-                sample=True,
-                detach_every=None,
-                policy=self.exploitation_policy.actor_critic,
-                prev_state=prev_obs[0, :, :])
-            latent_sample = (torch.stack([all_latent_samples[lens[i]][i] for i in range(len(lens))])).to(device)
-            latent_mean = (torch.stack([all_latent_means[lens[i]][i] for i in range(len(lens))])).to(device)
-            latent_logvar = (torch.stack([all_latent_logvars[lens[i]][i] for i in range(len(lens))])).to(device)
-            task_inference_hidden_state = (torch.stack([all_hidden_states[lens[i]][i] for i in range(len(lens))])).to(
-                device)
-            brim_output2 = (torch.stack([all_brim_output2[lens[i]][i] for i in range(len(lens))])).to(device)
-            brim_output4 = (torch.stack([all_brim_output4[lens[i]][i] for i in range(len(lens))])).to(device)
-            brim_output5 = (torch.stack([all_brim_output5[lens[i]][i] for i in range(len(lens))])).to(device)
-            exploitation_policy_embedded_state = (
-                torch.stack([all_exploitation_policy_embedded_state[lens[i]][i] for i in range(len(lens))])).to(device)
-            brim_hidden_state = (torch.stack([all_brim_hidden_states[lens[i]][i] for i in range(len(lens))])).to(device)
-            return brim_output2, brim_output4, brim_output5, brim_hidden_state, latent_sample, latent_mean, latent_logvar, task_inference_hidden_state, exploitation_policy_embedded_state
+            forward_branch = self.base2final.brim_core.forward_exploitation_branch
         else:
             raise NotImplementedError
+        all_outputs = forward_branch(
+            actions=act,
+            states=next_obs.float(),
+            rewards=rew,
+            brim_hidden_state=None,
+            task_inference_hidden_state=None,
+            return_prior=True,
+            sample=True,
+            detach_every=None,
+            policy=policy.actor_critic,
+            prev_state=prev_obs[0, :, :].float())
+        # get the embedding / hidden state of the current time step (need to do this since we zero-padded)
+        # brim outputs (3), brim hidden state, latent sample / mean / logvar, task inference hidden state, policy embedded state
+        lens = torch.as_tensor(lens, dtype=torch.long, device=device).view(-1)
+        process = torch.arange(len(lens), device=device)
+        encoding = tuple(x[lens, process].to(device) for x in all_outputs)
+        self.running_encoding_shapes[activated_branch] = [x.shape for x in encoding]
+        return encoding
+
+    def cache_running_encoding(self, encoding, activated_branch):
+        """ Remembers the encoding of the current step of the running trajectories (see encode_running_trajectory) """
+        shapes = self.running_encoding_shapes[activated_branch]
+        if shapes is not None:
+            encoding = tuple(x.reshape(shape) for x, shape in zip(encoding, shapes))
+            self.running_encoding_cache[activated_branch] = (self.num_encoder_updates, encoding)
 
     def get_value(self, embedded_state, belief, task, latent_sample, latent_mean, latent_logvar, brim_output_level1, policy):
         latent = utl.get_latent_for_policy(sample_embeddings=self.args.sample_embeddings,
@@ -909,6 +937,9 @@ class MetaLearner:
             activated_branch=activated_branch,
             predictor_network=self.base2final.predictor_network,
             random_target_network=self.base2final.random_target_network)
+        # the optimisers update the parameters through .data, which does not show in their versions: the cached
+        # running encodings are invalidated here instead
+        self.num_encoder_updates += 1
 
         return policy_train_stats
 
@@ -1128,6 +1159,10 @@ class MetaLearner:
                     torch.save(policy.lr_scheduler_encoder, filename,
                                _use_new_zipfile_serialization=False)
 
+            # write the on-disk VAE buffer (if any) so that it can be resumed after a restart
+            self.base2final.exploration_rollout_storage.save()
+            self.base2final.exploitation_rollout_storage.save()
+
         # --- log some other things ---
 
         if (self.iter_idx % self.args.log_interval == 0) and (train_stats is not None):
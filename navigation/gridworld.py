@@ -9,6 +9,7 @@ import numpy as np
 import torch
 from gym import spaces
 
+from environments.env_utils.vec_env import VecEnv
 from utils import helpers as utl
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -406,6 +407,158 @@ class GridNavi(gym.Env):
                episode_returns
 
 
+class GridNaviVecEnv(VecEnv):
+    """
+    Batched version of GridNavi (wrapped in a VariBadWrapper), stepping all environments in one vectorised call.
+    Positions, goals, beliefs and step counters of all [num_envs] environments are kept in arrays.
+    Exposes the same interface as a SubprocVecEnv around the wrapped GridNavi
+    (reset / reset_mdp, get_task, get_belief, and the 'done_mdp' / 'start_state' infos).
+    """
+
+    def __init__(self, num_envs, episodes_per_task, seed=None, num_cells=5, num_steps=15):
+        # a single (unbatched) env for the spaces, helper methods (task_to_id, ...) and attributes
+        self.env = GridNavi(num_cells=num_cells, num_steps=num_steps)
+        self.num_cells = num_cells
+        self._max_episode_steps = num_steps
+        self.episodes_per_task = episodes_per_task
+        self.add_done_info = episodes_per_task > 1
+        self.np_random = np.random.RandomState(seed)
+
+        observation_space = self.env.observation_space
+        if self.add_done_info:
+            observation_space = spaces.Box(low=np.array([*observation_space.low, 0]),
+                                           high=np.array([*observation_space.high, 1]))
+        VecEnv.__init__(self, num_envs, observation_space, self.env.action_space)
+
+        self.possible_goals = np.array(self.env.possible_goals)
+        # the belief of each env starts uniform over the possible goals
+        self.prior_belief = np.zeros(num_cells ** 2)
+        self.prior_belief[self.cell_id(self.possible_goals)] = 1.0 / len(self.possible_goals)
+
+        self.env_states = np.zeros((num_envs, 2))
+        self.goals = np.zeros((num_envs, 2))
+        self.beliefs = np.zeros((num_envs, num_cells ** 2))
+        self.step_counts = np.zeros(num_envs, dtype=np.int64)
+        self.episode_counts = np.zeros(num_envs, dtype=np.int64)
+        self.actions = None
+
+    def cell_id(self, pos):
+        # same as GridNavi.task_to_id, for numpy arrays of positions
+        pos = pos.astype(np.int64)
+        return pos[..., 0] * self.num_cells + pos[..., 1]
+
+    def obs(self, index, done_mdp):
+        state = self.env_states[index].copy()
+        if self.add_done_info:
+            state = np.concatenate((state, done_mdp.astype(np.float64).reshape(-1, 1)), axis=-1)
+        return state
+
+    def reset_tasks(self, index, task=None):
+        if task is None:
+            self.goals[index] = self.possible_goals[self.np_random.randint(len(self.possible_goals), size=len(index))]
+        else:
+            self.goals[index] = np.array(task)
+        self.beliefs[index] = self.prior_belief
+
+    def reset_mdps(self, index):
+        self.env_states[index] = self.env.starting_state
+        self.step_counts[index] = 0
+
+    def reset(self, task=None):
+        index = np.arange(self.num_envs)
+        self.reset_tasks(index, task)
+        self.reset_mdps(index)
+        self.episode_counts[index] = 0
+        return self.obs(index, np.zeros(self.num_envs, dtype=bool))
+
+    def reset_at(self, index, task=None):
+        """ Resets (the BAMDP of) a single env """
+        index = np.array([index])
+        self.reset_tasks(index, task)
+        self.reset_mdps(index)
+        self.episode_counts[index] = 0
+        return self.obs(index, np.zeros(1, dtype=bool))[0]
+
+    def reset_mdp(self):
+        index = np.arange(self.num_envs)
+        self.reset_mdps(index)
+        return self.obs(index, np.zeros(self.num_envs, dtype=bool))
+
+    def reset_mdp_at(self, index):
+        """ Resets the underlying MDP (*not* the task) of a single env """
+        index = np.array([index])
+        self.reset_mdps(index)
+        return self.obs(index, np.zeros(1, dtype=bool))[0]
+
+    def step_async(self, actions):
+        self.actions = np.asarray(actions).reshape(self.num_envs).astype(np.int64)
+
+    def step_wait(self):
+        index = np.arange(self.num_envs)
+        actions = self.actions
+
+        # state transition: noop, up, right, down, left
+        self.env_states[:, 1] = np.where(actions == 1, np.minimum(self.env_states[:, 1] + 1, self.num_cells - 1), self.env_states[:, 1])
+        self.env_states[:, 0] = np.where(actions == 2, np.minimum(self.env_states[:, 0] + 1, self.num_cells - 1), self.env_states[:, 0])
+        self.env_states[:, 1] = np.where(actions == 3, np.maximum(self.env_states[:, 1] - 1, 0), self.env_states[:, 1])
+        self.env_states[:, 0] = np.where(actions == 4, np.maximum(self.env_states[:, 0] - 1, 0), self.env_states[:, 0])
+
+        # check if maximum step limit is reached
+        self.step_counts += 1
+        done_mdp = self.step_counts >= self._max_episode_steps
+
+        # compute reward
+        on_goal = np.all(self.env_states == self.goals, axis=-1)
+        rewards = np.where(on_goal, 1.0, -0.1)
+
+        # update ground-truth belief
+        goal_ids = self.cell_id(self.goals)
+        if on_goal.any():
+            # hint: the true goal and a random wrong one
+            hinted = on_goal.nonzero()[0]
+            wrong_goals = self.np_random.randint(len(self.possible_goals) - 1, size=len(hinted))
+            wrong_ids = self.cell_id(self.possible_goals)[None, :].repeat(len(hinted), axis=0)
+            # drop the true goal from the candidates of each env, then pick one of the remaining ones
+            wrong_ids = wrong_ids[wrong_ids != goal_ids[hinted, None]].reshape(len(hinted), -1)
+            self.beliefs[hinted] = 0
+            self.beliefs[hinted, goal_ids[hinted]] = 0.5
+            self.beliefs[hinted, wrong_ids[np.arange(len(hinted)), wrong_goals]] = 0.5
+        searching = (~on_goal).nonzero()[0]
+        self.beliefs[searching, self.cell_id(self.env_states[searching])] = 0
+        self.beliefs[searching] = np.ceil(self.beliefs[searching])
+        self.beliefs[searching] /= self.beliefs[searching].sum(axis=-1, keepdims=True)
+
+        obs = self.obs(index, done_mdp)
+
+        # multi-episode (BAMDP) logic of the VariBadWrapper
+        self.episode_counts += done_mdp
+        done_bamdp = done_mdp & (self.episode_counts == self.episodes_per_task)
+        reset_mdp = (done_mdp & ~done_bamdp).nonzero()[0]
+        infos = [{'task': self.goals[i].copy(),
+                  'task_id': goal_ids[i],
+                  'belief': self.beliefs[i].copy(),
+                  'done_mdp': bool(done_mdp[i])} for i in index]
+        if len(reset_mdp) > 0:
+            self.reset_mdps(reset_mdp)
+            start_states = self.obs(reset_mdp, np.zeros(len(reset_mdp), dtype=bool))
+            for i, start_state in zip(reset_mdp, start_states):
+                infos[i]['start_state'] = start_state
+
+        return obs, rewards, done_bamdp, infos
+
+    def get_task(self):
+        return self.goals.copy()
+
+    def get_belief(self):
+        return self.beliefs.copy()
+
+    def get_env_attr(self, attr):
+        return getattr(self.env, attr)
+
+    def get_images(self):
+        raise NotImplementedError
+
+
 def plot_rew_reconstruction(env,
                             rew_pred_means,
                             rew_pred_vars,
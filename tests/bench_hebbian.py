@@ -0,0 +1,84 @@
+"""
+Benchmarks the Hebbian consolidation in Hebbian.write against the previous implementation
+(which gathered and cloned the association matrices of the finished processes in every iteration).
+
+    python tests/bench_hebbian.py --num_processes 16 --key_size 40 --value_size 16
+"""
+import argparse
+import time
+
+import torch
+
+from memory.hebbian import Hebbian, device
+
+
+def legacy_consolidation(hebbian, done_process_mdp, correlation, regularization, A, B):
+    for i in range(4):
+        a1 = torch.bmm(A, (hebbian.w_max - hebbian.exploration_w_assoc[done_process_mdp].clone()).permute(0, 2, 1))
+        a2 = torch.bmm(a1, correlation)
+        a3 = torch.bmm(B, hebbian.exploration_w_assoc[done_process_mdp].clone().permute(0, 2, 1))
+        a4 = torch.bmm(a3, regularization).permute(0, 2, 1)
+        delta_w = a2 - a4
+        hebbian.exploration_w_assoc[done_process_mdp] = hebbian.exploration_w_assoc[done_process_mdp].clone() + hebbian.learning_rate * delta_w
+
+
+def batched_consolidation(hebbian, done_process_mdp, correlation, regularization, A, B):
+    w_assoc = hebbian.consolidate(hebbian.exploration_w_assoc[done_process_mdp], correlation, regularization, A, B)
+    hebbian.exploration_w_assoc[done_process_mdp] = w_assoc
+
+
+def timeit(fn, repeats):
+    fn()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_processes', type=int, default=16)
+    parser.add_argument('--episode_len', type=int, default=60)
+    parser.add_argument('--key_size', type=int, default=40)
+    parser.add_argument('--value_size', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    hebbian = Hebbian(num_head=1, w_max=0.1, key_size=args.key_size, value_size=args.value_size,
+                      key_encoder_layer=[32], value_encoder_layer=[32], hebb_learning_rate=1e-4,
+                      rim_query_size=16, general_query_encoder_layer=[32], state_dim=8, memory_state_embedding=8,
+                      read_memory_to_key_layer=[32], read_memory_to_value_layer=[32]).to(device)
+    hebbian.prior(args.num_processes, 'exploration')
+
+    done_process_mdp = torch.arange(0, args.num_processes, 2, device=device)
+    batch_size = len(done_process_mdp)
+    key = torch.randn(batch_size, args.episode_len, args.key_size, device=device)
+    value = torch.randn(batch_size, args.episode_len, args.value_size, device=device)
+    correlation = torch.bmm(key.permute(0, 2, 1), value)
+    regularization = torch.bmm(key.permute(0, 2, 1), key)
+    A = torch.randn(1, args.key_size, args.value_size, device=device).expand(batch_size, -1, -1)
+    B = torch.randn(1, args.value_size, args.value_size, device=device).expand(batch_size, -1, -1)
+
+    with torch.no_grad():
+        hebbian.exploration_w_assoc.zero_()
+        legacy_consolidation(hebbian, done_process_mdp, correlation, regularization, A, B)
+        expected = hebbian.exploration_w_assoc.clone()
+        hebbian.exploration_w_assoc.zero_()
+        batched_consolidation(hebbian, done_process_mdp, correlation, regularization, A, B)
+        assert torch.allclose(hebbian.exploration_w_assoc, expected, rtol=1e-5, atol=1e-6)
+
+        legacy = timeit(lambda: legacy_consolidation(hebbian, done_process_mdp, correlation, regularization, A, B), args.repeats)
+        batched = timeit(lambda: batched_consolidation(hebbian, done_process_mdp, correlation, regularization, A, B), args.repeats)
+
+    print(f'device: {device}, finished processes: {batch_size}/{args.num_processes}')
+    print(f'legacy:  {legacy * 1e6:9.1f} us / write')
+    print(f'batched: {batched * 1e6:9.1f} us / write')
+    print(f'speedup: {legacy / batched:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
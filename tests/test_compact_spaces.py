@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from gym import spaces
+
+from utils.storage_vae import check_compact_spaces
+
+
+def test_minigrid_spaces_fit_the_compact_dtypes():
+    check_compact_spaces(spaces.Discrete(7), spaces.Box(low=0, high=255, shape=(147,), dtype='uint8'))
+    check_compact_spaces(spaces.Discrete(7), spaces.Box(low=0, high=10, shape=(4,), dtype=np.int64))
+
+
+@pytest.mark.parametrize('action_space, observation_space', [
+    (spaces.Box(low=-1., high=1., shape=(2,), dtype=np.float32), spaces.Box(low=0, high=255, shape=(4,), dtype='uint8')),
+    (spaces.Discrete(4), spaces.Box(low=-1., high=1., shape=(4,), dtype=np.float32)),
+    (spaces.Discrete(4), spaces.Box(low=0, high=1000, shape=(4,), dtype=np.int64)),
+])
+def test_other_spaces_are_rejected(action_space, observation_space):
+    with pytest.raises(AssertionError):
+        check_compact_spaces(action_space, observation_space)
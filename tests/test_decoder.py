@@ -0,0 +1,20 @@
+import torch
+from torch.nn import functional as F
+
+from models.decoder import RewardDecoder, device
+
+
+def test_reward_decoder_embeds_both_states_with_the_shared_encoder():
+    torch.manual_seed(0)
+    decoder = RewardDecoder(layers=[16], latent_dim=5, action_dim=1, action_embed_dim=3, state_dim=7,
+                            state_embed_dim=4, reward_simulator_hidden_size=8, num_states=1,
+                            n_step_reward_prediction=False).to(device)
+    latent, action = torch.randn(6, 5, device=device), torch.randn(6, 1, device=device)
+    prev_state, next_state = torch.randn(6, 7, device=device), torch.randn(6, 7, device=device)
+
+    h = torch.cat((latent, decoder.state_encoder(next_state), decoder.action_encoder(action),
+                   decoder.state_encoder(prev_state)), dim=-1)
+    expected = decoder.one_step_fc_out(F.relu(decoder.fc_layers[0](h)))
+
+    prediction = decoder(latent, next_state, prev_state=prev_state, action=action)
+    assert torch.allclose(prediction[0], expected, atol=1e-6)
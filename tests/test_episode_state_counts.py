@@ -0,0 +1,34 @@
+import torch
+
+from utils.helpers import EpisodeStateCounts, device
+
+
+def test_counts_match_per_process_dicts():
+    torch.manual_seed(0)
+    num_processes, num_steps = 6, 40
+    # few distinct states, so that they are revisited often
+    states = torch.randint(0, 3, size=(num_steps, num_processes, 5), device=device).float()
+    done = (torch.rand(num_steps, num_processes, 1, device=device) < 0.15).float()
+
+    table = EpisodeStateCounts(num_processes, capacity=num_steps + 1)
+    expected = [dict() for _ in range(num_processes)]
+    for t in range(num_steps):
+        table.add(states[t])
+        for i in range(num_processes):
+            key = tuple(states[t, i].tolist())
+            expected[i][key] = expected[i].get(key, 0) + 1
+        assert table.count(states[t]).tolist() == [expected[i][tuple(states[t, i].tolist())] for i in range(num_processes)]
+        table.reset(done[t])
+        for i in range(num_processes):
+            if done[t, i] == 1:
+                expected[i] = dict()
+        assert table.num_states.tolist() == [len(d) for d in expected]
+
+
+def test_unseen_states_have_no_visits():
+    table = EpisodeStateCounts(2, capacity=4)
+    seen = torch.tensor([[1., 0., -0.], [2., 2., 2.]], device=device)
+    table.add(seen)
+    table.add(seen)
+    # -0. and 0. are the same state
+    assert table.count(torch.tensor([[1., 0., 0.], [2., 2., 3.]], device=device)).tolist() == [2, 0]
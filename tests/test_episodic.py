@@ -0,0 +1,169 @@
+import math
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from base2final import memory_visibility_mask
+from memory.episodic import DND, device
+
+
+def make_dnd(num_head=4, key_size=24, value_size=16, episode_len=10, state_dim=12, memory_state_embedding=8):
+    return DND(num_head=num_head,
+               key_size=key_size,
+               value_size=value_size,
+               key_encoder_layer=[32],
+               value_encoder_layer=[32],
+               episode_len=episode_len,
+               general_key_encoder_layer=[32],
+               general_value_encoder_layer=[32],
+               general_query_encoder_layer=[32, 32],
+               read_memory_to_key_layer=[32],
+               read_memory_to_value_layer=[32],
+               rim_query_size=16,
+               rim_level1_hidden_size=64,
+               memory_state_embedding=memory_state_embedding,
+               state_dim=state_dim,
+               use_hebb=False).to(device)
+
+
+def fill_memory(dnd, batch_size, steps):
+    dnd.prior(batch_size, 'exploration')
+    dnd.exploration_keys.normal_()
+    dnd.exploration_vals.normal_()
+    dnd.exploration_RPE_read_modulation.uniform_(0.5, 1.5)
+    dnd.exploration_step = torch.tensor(steps, dtype=torch.long, device=device).unsqueeze(-1)
+
+
+def reference_read(dnd, state, task_inference_latent):
+    """ Per-process read as it was implemented before batching. """
+    state = dnd.state_encoder(state)
+    query = dnd.concat_query_encoder(torch.cat((state, task_inference_latent), dim=-1))
+    query = dnd.query_encoder(query).reshape(-1, dnd.num_head, dnd.key_size)
+    keys = dnd.exploration_keys
+    vals = dnd.exploration_vals
+    step = dnd.exploration_step
+    referenced_times = dnd.exploration_referenced_times.clone()
+    results = []
+    for i in range(dnd.exploration_batch_size):
+        key_ = keys[:step[i], i, :].clone() * dnd.exploration_RPE_read_modulation[:step[i], i, :]
+        query_ = query[i].permute(1, 0).unsqueeze(0)
+        score = torch.bmm(key_.unsqueeze(0), query_) / math.sqrt(dnd.key_size)
+        prob = F.softmax(score, dim=1)
+        referenced_times[:step[i], i, :] += prob.mean(-1).squeeze(0).unsqueeze(-1)
+        vals_ = vals[:step[i], i, :].clone().unsqueeze(0)
+        result = torch.bmm(prob.permute(0, 2, 1), vals_)
+        results.append(dnd.value_aggregator(result.reshape(-1, dnd.num_head * dnd.value_size)))
+    results = torch.cat(results, dim=0).unsqueeze(1)
+    return dnd.read_memory_to_key(results), dnd.read_memory_to_value(results), referenced_times
+
+
+def test_batched_read_matches_per_process_read():
+    torch.manual_seed(0)
+    dnd = make_dnd()
+    batch_size = 6
+    fill_memory(dnd, batch_size, steps=[1, 3, 9, 5, 2, 7])
+    state = torch.randn(batch_size, 12, device=device)
+    latent = torch.randn(batch_size, 16, device=device)
+
+    with torch.no_grad():
+        ref_k, ref_v, ref_referenced_times = reference_read(dnd, state, latent)
+        k, v = dnd.read(state, latent, 'exploration')
+
+    assert k.shape == ref_k.shape and v.shape == ref_v.shape
+    assert torch.allclose(k, ref_k, atol=1e-5)
+    assert torch.allclose(v, ref_v, atol=1e-5)
+    assert torch.allclose(dnd.exploration_referenced_times, ref_referenced_times, atol=1e-6)
+
+
+def test_read_is_zero_until_every_process_has_written():
+    dnd = make_dnd()
+    fill_memory(dnd, 3, steps=[0, 2, 4])
+    state = torch.randn(3, 12, device=device)
+    latent = torch.randn(3, 16, device=device)
+
+    with torch.no_grad():
+        k, v = dnd.read(state, latent, 'exploration')
+        zeros = torch.zeros((3, 1, dnd.value_size), device=device)
+
+    assert torch.equal(k, dnd.read_memory_to_key(zeros))
+    assert torch.equal(v, dnd.read_memory_to_value(zeros))
+    assert dnd.exploration_referenced_times.sum() == 0
+
+
+def test_batched_intrinsic_reward_matches_per_process_minimum():
+    torch.manual_seed(1)
+    dnd = make_dnd()
+    steps = [1, 4, 9, 6]
+    fill_memory(dnd, len(steps), steps=steps)
+    state = torch.randn(len(steps), 12, device=device)
+    latent = torch.randn(len(steps), 16, device=device)
+
+    with torch.no_grad():
+        reward = dnd.compute_intrinsic_reward(state, latent)
+        knn_reward = dnd.compute_intrinsic_reward(state, latent, num_neighbours=3)
+        query = dnd.key_encoder(dnd.concat_key_encoder(torch.cat((dnd.state_encoder(state), latent), dim=-1)))
+
+    for i, step in enumerate(steps):
+        distance = torch.sqrt(torch.sum((query[i] - dnd.exploration_keys[:step, i]) ** 2, dim=-1))
+        nearest = torch.sort(distance)[0][:3]
+        assert torch.allclose(reward[i, 0], distance.min(), atol=1e-5)
+        assert torch.allclose(knn_reward[i, 0], nearest.mean(), atol=1e-5)
+
+
+@pytest.mark.parametrize('causal', [False, True])
+def test_teacher_forced_read_matches_sequential_writes(causal):
+    torch.manual_seed(2)
+    episode_len, batch_size, seq_len = 5, 3, 13
+    dnd = make_dnd(episode_len=episode_len)
+    state = torch.randn(seq_len, batch_size, 12, device=device)
+    latent = torch.randn(seq_len, batch_size, 16, device=device)
+    value = torch.randn(seq_len, batch_size, 16, device=device)
+    # episodes shorter and longer than the memory, so that the ring buffer wraps around
+    done_episode = torch.rand(seq_len, batch_size, 1, device=device) < 0.2
+
+    ref_k, ref_v = [], []
+    with torch.no_grad():
+        dnd.prior(batch_size, 'exploration')
+        for i in range(seq_len):
+            dnd.reset(None, done_episode[i], 'exploration')
+            dnd.write(state[i], latent[i], value[i], rpe=None, activated_branch='exploration')
+            if causal:
+                k, v = dnd.read(state[i], latent[i], 'exploration')
+                ref_k.append(k)
+                ref_v.append(v)
+        if not causal:
+            for i in range(seq_len):
+                k, v = dnd.read(state[i], latent[i], 'exploration')
+                ref_k.append(k)
+                ref_v.append(v)
+
+        keys, vals = dnd.encode(state, latent, value)
+        visible = memory_visibility_mask(done_episode, episode_len, causal=causal)
+        k, v = dnd.read_batch(state, latent, keys, vals, visible)
+
+    assert torch.allclose(k, torch.stack(ref_k), atol=1e-5)
+    assert torch.allclose(v, torch.stack(ref_v), atol=1e-5)
+
+
+def test_done_process_selects_most_referenced_slots():
+    torch.manual_seed(3)
+    episode_len, batch_size = 10, 5
+    dnd = make_dnd(episode_len=episode_len)
+    dnd.use_hebb = True
+    dnd.prior(batch_size, 'exploration')
+    dnd.exploration_referenced_times.uniform_()
+    dnd.saved_keys.normal_()
+    dnd.saved_values.normal_()
+    dnd.exploration_RPE_read_modulation.uniform_(0.5, 1.5)
+    done = torch.tensor([True, False, True, True, False], device=device).unsqueeze(-1)
+
+    state, latent, values, rpe = dnd.get_done_process(done, 'exploration')
+
+    times = torch.arange(episode_len, 0, -1, device=device).float()
+    for i, process in enumerate([0, 2, 3]):
+        idx = torch.topk(dnd.exploration_referenced_times[:, process, 0] / times, k=episode_len // 2)[1]
+        assert torch.equal(state[i], dnd.saved_keys[idx, process, :dnd.state_dim])
+        assert torch.equal(latent[i], dnd.saved_keys[idx, process, dnd.state_dim:])
+        assert torch.equal(values[i], dnd.saved_values[idx, process])
+        assert torch.equal(rpe[i], dnd.exploration_RPE_read_modulation[idx, process])
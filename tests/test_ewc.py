@@ -0,0 +1,55 @@
+import pytest
+import torch
+from torch import nn
+
+from memory.ewc import OnlineEWC, device
+
+# online EWC needs torch.func
+pytest.importorskip('torch.func')
+
+
+class DeterministicModel(nn.Module):
+    """ Same interface as the cVAE, without the sampling """
+
+    def __init__(self, brim_hidden_dim=6, obs_dim=4):
+        super(DeterministicModel, self).__init__()
+        self.encoder = nn.Linear(brim_hidden_dim + obs_dim, 3)
+        self.decoder = nn.Linear(3 + obs_dim, brim_hidden_dim)
+
+    def forward(self, brim_hidden_state, obs):
+        mean = self.encoder(torch.cat((brim_hidden_state, obs), dim=-1))
+        return self.decoder(torch.cat((mean, obs), dim=-1)), mean, torch.zeros_like(mean)
+
+    def loss(self, X, X_hat, mean, logvar):
+        return (X_hat - X).pow(2).mean() + 0.5 * torch.sum(mean ** 2)
+
+
+def per_sample_fisher(model, brim_hidden, state):
+    fisher = {n: torch.zeros_like(p) for n, p in model.named_parameters()}
+    for i in range(brim_hidden.shape[0]):
+        model.zero_grad()
+        output = model(brim_hidden[i:i + 1], state[i:i + 1])
+        model.loss(brim_hidden[i:i + 1], *output).backward()
+        for n, p in model.named_parameters():
+            fisher[n] += p.grad ** 2 / brim_hidden.shape[0]
+    return fisher
+
+
+def test_online_fisher_matches_per_sample_gradients():
+    torch.manual_seed(0)
+    model = DeterministicModel().to(device)
+    ewc = OnlineEWC(model, gamma=0.5)
+    brim_hidden, state = torch.randn(2, 16, 6, device=device), torch.randn(2, 16, 4, device=device)
+
+    ewc.update(brim_hidden[0], state[0])
+    first = per_sample_fisher(model, brim_hidden[0], state[0])
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(0.1 * torch.randn_like(p))
+    ewc.update(brim_hidden[1], state[1])
+    second = per_sample_fisher(model, brim_hidden[1], state[1])
+
+    for n, p in model.named_parameters():
+        assert torch.allclose(ewc._precision_matrices[n], 0.5 * first[n] + second[n], atol=1e-6)
+        assert torch.equal(ewc._means[n], p.detach())
+    assert ewc.penalty(model) == 0
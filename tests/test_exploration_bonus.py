@@ -0,0 +1,32 @@
+import types
+
+import pytest
+import torch
+
+from exploration.exploration_bonus import ExplorationBonus, device
+from utils.helpers import RunningMeanStd
+
+
+@pytest.mark.parametrize('num_steps', [1, 5, 64])
+def test_return_normalisation_matches_step_by_step_updates(num_steps):
+    torch.manual_seed(num_steps)
+    num_processes, gamma = 8, 0.95
+    bonus = types.SimpleNamespace(gamma=gamma)
+    intrinsic_rew = torch.rand(num_steps, num_processes, 1, device=device)
+    done = (torch.rand(num_steps, num_processes, 1, device=device) < 0.1).float()
+    initial_ret = torch.rand(num_processes, 1, device=device)
+
+    expected_rms = RunningMeanStd(shape=())
+    expected_ret = initial_ret.clone()
+    for i in range(num_steps):
+        expected_ret = expected_ret * gamma + intrinsic_rew[i]
+        expected_rms.update(expected_ret)
+        expected_ret[done[i] == 1] = 0.
+
+    rms = RunningMeanStd(shape=())
+    ret = ExplorationBonus.update_return_normalisation(bonus, initial_ret.clone(), rms, intrinsic_rew, done)
+
+    assert torch.allclose(ret, expected_ret, atol=1e-5)
+    assert rms.count == pytest.approx(expected_rms.count)
+    assert torch.allclose(rms.mean, expected_rms.mean, atol=1e-5)
+    assert torch.allclose(rms.var, expected_rms.var, atol=1e-5)
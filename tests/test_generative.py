@@ -0,0 +1,46 @@
+import types
+
+import torch
+from torch import optim
+
+from memory.cvae import cVAE
+from memory.generative import Generative, ReplayBuffer, device
+
+
+def test_replay_buffer_wraps_around():
+    buffer = ReplayBuffer(capacity=5)
+    states = torch.arange(8, dtype=torch.float, device=device).view(-1, 1)
+    buffer.add(states[:3], -states[:3])
+    buffer.add(states[3:7], -states[3:7])
+    assert len(buffer) == 5 and buffer.insert_idx == 2
+    # the two oldest samples are overwritten in place
+    assert buffer.states.view(-1).tolist() == [5., 6., 2., 3., 4.]
+    assert torch.equal(buffer.brim_hidden, -buffer.states)
+
+    # a write larger than the buffer keeps its last `capacity` samples
+    buffer.add(states, -states)
+    assert len(buffer) == 5 and buffer.insert_idx == 2
+    assert buffer.states.view(-1).tolist() == [6., 7., 3., 4., 5.]
+
+    sampled_states, sampled_brim_hidden = buffer.sample(16)
+    assert torch.equal(sampled_brim_hidden, -sampled_states)
+    assert all(3. <= s <= 7. for s in sampled_states.view(-1).tolist())
+
+
+def test_train_epoch_only_steps_models_with_a_batch():
+    torch.manual_seed(0)
+    gen = types.SimpleNamespace(batch_size=4, importance=0.5)
+    models = [cVAE(obs_dim=3, brim_hidden_dim=6).to(device) for _ in range(2)]
+    optimizers = [optim.Adam(model.parameters(), lr=0.01) for model in models]
+    data = [(torch.randn(8, 3, device=device), torch.randn(8, 6, device=device)),
+            (torch.randn(4, 3, device=device), torch.randn(4, 6, device=device))]
+
+    Generative.train_epoch(gen, data, models, optimizers, [None, None])
+    # two batches for the first model, one for the second one
+    assert [int(optimizer.state[next(model.parameters())]['step']) for model, optimizer in zip(models, optimizers)] == [2, 1]
+
+    # the second model has Adam momentum now, but gets no data in this write
+    before = [p.clone() for p in models[1].parameters()]
+    Generative.train_epoch(gen, data[:1], models[:1], optimizers[:1], [None])
+    assert all(torch.equal(p, q) for p, q in zip(models[1].parameters(), before))
+    assert int(optimizers[0].state[next(models[0].parameters())]['step']) == 4
@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+from memory.hebbian import Hebbian, device
+
+
+def make_hebbian(consolidation_tol=None, key_size=6, value_size=4):
+    return Hebbian(num_head=1, w_max=0.1, key_size=key_size, value_size=value_size, key_encoder_layer=[8],
+                   value_encoder_layer=[8], hebb_learning_rate=1e-2, rim_query_size=4, general_query_encoder_layer=[8],
+                   state_dim=3, memory_state_embedding=4, read_memory_to_key_layer=[8], read_memory_to_value_layer=[8],
+                   consolidation_tol=consolidation_tol).to(device)
+
+
+def baseline_consolidation(hebbian, w_assoc, correlation, regularization, A, B):
+    """ The Hebbian updates one after the other, without any in-place op """
+    for _ in range(hebbian.consolidation_iterations):
+        a1 = torch.bmm(A, (hebbian.w_max - w_assoc).permute(0, 2, 1))
+        a3 = torch.bmm(B, w_assoc.permute(0, 2, 1))
+        delta_w = hebbian.learning_rate * (torch.bmm(a1, correlation) - torch.bmm(a3, regularization).permute(0, 2, 1))
+        w_assoc = w_assoc + delta_w
+        if hebbian.consolidation_tol is not None and delta_w.abs().max() < hebbian.consolidation_tol:
+            break
+    return w_assoc
+
+
+def inputs(batch_size=3, key_size=6, value_size=4, episode_len=5):
+    key = torch.randn(batch_size, episode_len, key_size, device=device)
+    value = torch.randn(batch_size, episode_len, value_size, device=device)
+    correlation = torch.bmm(key.permute(0, 2, 1), value)
+    regularization = torch.bmm(key.permute(0, 2, 1), key)
+    A = torch.randn(batch_size, key_size, value_size, device=device)
+    B = torch.randn(batch_size, value_size, value_size, device=device)
+    w_assoc = 0.01 * torch.randn(batch_size, key_size, value_size, device=device)
+    return w_assoc, correlation, regularization, A, B
+
+
+@pytest.mark.parametrize('consolidation_tol', [None, 0., 1e-2, float('inf')])
+def test_consolidate_matches_the_baseline(consolidation_tol):
+    torch.manual_seed(0)
+    hebbian = make_hebbian(consolidation_tol)
+    w_assoc, correlation, regularization, A, B = inputs()
+    expected = baseline_consolidation(hebbian, w_assoc, correlation, regularization, A, B)
+    with torch.no_grad():
+        block = w_assoc.clone()
+        w = hebbian.consolidate(block, correlation, regularization, A, B)
+    assert w is block
+    assert torch.allclose(w, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_consolidate_backpropagates_to_the_encoders_with_frozen_meta_parameters():
+    torch.manual_seed(0)
+    hebbian = make_hebbian()
+    w_assoc, correlation, regularization, A, B = inputs()
+    # correlation / regularization come from the encoders, A and B are frozen
+    correlation.requires_grad_(True)
+    regularization.requires_grad_(True)
+
+    hebbian.consolidate(w_assoc.clone(), correlation, regularization, A, B).sum().backward()
+    grads = correlation.grad.clone(), regularization.grad.clone()
+    correlation.grad, regularization.grad = None, None
+    baseline_consolidation(hebbian, w_assoc, correlation, regularization, A, B).sum().backward()
+    assert torch.allclose(grads[0], correlation.grad, rtol=1e-5, atol=1e-6)
+    assert torch.allclose(grads[1], regularization.grad, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,66 @@
+import argparse
+
+import torch
+
+from memory.sequentional_kmeans import Kmeans, device
+
+
+def make_kmeans(buffer_size=64, num_cluster=3, latent_dim=2):
+    args = argparse.Namespace(kmeans_buffer_size=buffer_size, kmeans_num_cluster=num_cluster, latent_dim=latent_dim)
+    return Kmeans(args)
+
+
+def blobs(num_points, centers):
+    codes = torch.randint(0, len(centers), size=(num_points,), device=device)
+    return centers[codes] + 0.05 * torch.randn(num_points, centers.shape[1], device=device), codes
+
+
+def test_no_cluster_before_the_first_point():
+    kmeans = make_kmeans()
+    assert kmeans.get_cluster(torch.zeros(2, 4, device=device)) is None
+
+
+def test_ring_buffer_keeps_the_latest_points():
+    kmeans = make_kmeans(buffer_size=8)
+    points = torch.arange(13 * 4, dtype=torch.float, device=device).view(13, 4)
+    kmeans.add_point(points[:5])
+    kmeans.add_point(points[5:])
+
+    assert kmeans.num_task == 13
+    assert kmeans.size == 8
+    assert kmeans.insert_idx == 13 % 8
+    # slot i holds the latest point written to it
+    assert torch.equal(kmeans.dataset, torch.cat((points[8:], points[5:8])))
+
+
+def test_streaming_clusters_separate_blobs():
+    torch.manual_seed(0)
+    centers = torch.tensor([[5., 5., 0., 0.], [-5., 5., 0., 0.], [0., -5., 0., 0.]], device=device)
+    kmeans = make_kmeans(buffer_size=256)
+    for _ in range(10):
+        kmeans.add_point(blobs(32, centers)[0])
+
+    points, true_codes = blobs(100, centers)
+    codes = kmeans.get_cluster(points)
+    # every blob is mapped to its own cluster
+    mapping = {}
+    for code, true_code in zip(codes.tolist(), true_codes.tolist()):
+        assert mapping.setdefault(true_code, code) == code
+    assert len(set(mapping.values())) == len(centers)
+
+
+def test_centers_follow_moving_blobs():
+    torch.manual_seed(0)
+    centers = torch.tensor([[5., 5., 0., 0.], [-5., 5., 0., 0.], [0., -5., 0., 0.]], device=device)
+    kmeans = make_kmeans(buffer_size=128)
+    for _ in range(20):
+        kmeans.add_point(blobs(32, centers)[0])
+    # resampled points are not counted again
+    assert kmeans.counts.sum() <= 128 + 1e-3
+
+    # the tasks drift away, the buffer only holds the new ones after a few writes
+    moved = centers + torch.tensor([1., 1., 0., 0.], device=device)
+    for _ in range(20):
+        kmeans.add_point(blobs(32, moved)[0])
+    distances = torch.cdist(moved, kmeans.centers).min(dim=1)[0]
+    assert distances.max() < 0.1
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from environments.minigrid_vec_env import MiniGridVecEnv
+from environments.parallel_envs import make_env
+
+
+@pytest.mark.parametrize('env_name', ['MiniGrid-KeyCorridorS3R2-v0', 'MiniGrid-MultiRoom-N2-S4-v0'])
+def test_matches_the_wrapped_envs(env_name):
+    num_envs, episodes_per_task, seed = 4, 2, 73
+    envs = [make_env(env_name, seed=seed, rank=i, episodes_per_task=episodes_per_task)() for i in range(num_envs)]
+    vec_env = MiniGridVecEnv(env_name, num_envs=num_envs, episodes_per_task=episodes_per_task, seed=seed)
+    rng = np.random.RandomState(0)
+
+    for _ in range(2):
+        obs = vec_env.reset()
+        assert np.array_equal(obs, np.stack([env.reset() for env in envs]))
+        for _ in range(2 * vec_env._max_episode_steps):
+            actions = rng.randint(vec_env.action_space.n, size=num_envs)
+            obs, rewards, dones, infos = vec_env.step(actions)
+            for i, env in enumerate(envs):
+                expected_obs, expected_reward, expected_done, expected_info = env.step(actions[i])
+                assert np.array_equal(obs[i], expected_obs)
+                assert rewards[i] == pytest.approx(expected_reward)
+                assert dones[i] == expected_done
+                assert infos[i]['done_mdp'] == expected_info['done_mdp']
+                assert np.array_equal(infos[i].get('start_state'), expected_info.get('start_state'))
+            if dones.any():
+                break
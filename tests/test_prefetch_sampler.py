@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import torch
+from gym import spaces
+
+from utils.storage_vae import PrefetchSampler, RolloutStorageVAE
+
+
+class Storage(object):
+    """ Samples rollout indices like the VAE buffer, and fails after `num_batches` batches """
+
+    def __init__(self, num_batches=None):
+        self.num_batches = num_batches
+
+    def sample_batch(self, batchsize, pin_memory=False, rng=None):
+        if self.num_batches is not None:
+            if self.num_batches == 0:
+                raise ValueError('buffer is gone')
+            self.num_batches -= 1
+        return {'indices': torch.from_numpy(rng.choice(range(100), batchsize, replace=False))}
+
+
+def test_batches_depend_on_the_seed_only():
+    batches = []
+    for seed in (3, 3, 4):
+        sampler = PrefetchSampler(Storage(), 8, seed=seed)
+        batches.append([sampler.get()['indices'] for _ in range(3)])
+    # the same sequence of batches for the same seed
+    assert all(torch.equal(x, y) for x, y in zip(batches[0], batches[1]))
+    assert not torch.equal(batches[0][0], batches[0][1])
+    assert not any(torch.equal(x, y) for x, y in zip(batches[0], batches[2]))
+
+
+def test_errors_of_the_thread_are_raised_in_get():
+    sampler = PrefetchSampler(Storage(num_batches=2), 8, seed=0)
+    sampler.get()
+    sampler.get()
+    for _ in range(2):
+        with pytest.raises(ValueError, match='buffer is gone'):
+            sampler.get()
+
+
+def test_compact_batches_have_the_same_dtypes_with_and_without_prefetching():
+    storage = RolloutStorageVAE(num_processes=2, max_trajectory_len=3, zero_pad=True, max_num_rollouts=4, state_dim=5,
+                                action_dim=1, vae_buffer_add_thresh=1., task_dim=None, prefetch_batchsize=2,
+                                compact=True, seed=0, action_space=spaces.Discrete(3),
+                                observation_space=spaces.Box(low=0, high=255, shape=(5,), dtype='uint8'))
+    storage.prev_state.random_(0, 256)
+    storage.next_state.random_(0, 256)
+    storage.actions.random_(0, 3)
+    storage.trajectory_lens[:] = 3
+    storage.buffer_len = 4
+
+    prefetched = storage.get_batch(batchsize=2)
+    assert storage.sampler is not None
+    sampled = storage.get_batch(batchsize=3)
+    assert len(prefetched) == len(sampled)
+    for x, y in zip(prefetched, sampled):
+        assert type(x) == type(y)
+        if isinstance(x, (torch.Tensor, np.ndarray)):
+            assert x.dtype == y.dtype
+            if isinstance(x, torch.Tensor):
+                assert x.device == y.device
@@ -0,0 +1,64 @@
+import itertools
+
+import pytest
+import torch
+
+from base2final import compute_returns
+
+
+def reference_compute_returns(next_value, rewards, value_preds, returns, gamma, tau, use_gae, masks, bad_masks, use_proper_time_limits):
+    # the original step-by-step implementation
+    if use_proper_time_limits:
+        if use_gae:
+            value_preds[-1] = next_value
+            gae = 0
+            for step in reversed(range(rewards.size(0))):
+                delta = rewards[step] + gamma * value_preds[step + 1] * masks[step + 1] - value_preds[step]
+                gae = delta + gamma * tau * masks[step + 1] * gae
+                gae = gae * bad_masks[step + 1]
+                returns[step] = gae + value_preds[step]
+        else:
+            returns[-1] = next_value
+            for step in reversed(range(rewards.size(0))):
+                returns[step] = (returns[step + 1] * gamma * masks[step + 1] + rewards[step]) * bad_masks[
+                    step + 1] + (1 - bad_masks[step + 1]) * value_preds[step]
+    else:
+        if use_gae:
+            value_preds[-1] = next_value
+            gae = 0
+            for step in reversed(range(rewards.size(0))):
+                delta = rewards[step] + gamma * value_preds[step + 1] * masks[step + 1] - value_preds[step]
+                gae = delta + gamma * tau * masks[step + 1] * gae
+                returns[step] = gae + value_preds[step]
+        else:
+            returns[-1] = next_value
+            for step in reversed(range(rewards.size(0))):
+                returns[step] = returns[step + 1] * gamma * masks[step + 1] + rewards[step]
+
+
+@pytest.mark.parametrize('use_gae, use_proper_time_limits, num_steps',
+                         [(g, p, n) for (g, p), n in itertools.product(itertools.product([True, False], repeat=2),
+                                                                        [1, 7, 64, 601])])
+def test_scan_returns_match_loop(use_gae, use_proper_time_limits, num_steps):
+    torch.manual_seed(num_steps)
+    batch_size = 5
+    rewards = torch.randn(num_steps, batch_size, 1, dtype=torch.float64)
+    value_preds = torch.randn(num_steps + 1, batch_size, 1, dtype=torch.float64)
+    next_value = torch.randn(batch_size, 1, dtype=torch.float64)
+    # episode ends and time-limit ends at random steps
+    masks = (torch.rand(num_steps + 1, batch_size, 1) > 0.1).double()
+    bad_masks = (torch.rand(num_steps + 1, batch_size, 1) > 0.1).double()
+
+    expected_returns = torch.zeros(num_steps + 1, batch_size, 1, dtype=torch.float64)
+    expected_value_preds = value_preds.clone()
+    reference_compute_returns(next_value, rewards, expected_value_preds, expected_returns, gamma=0.95, tau=0.9,
+                              use_gae=use_gae, masks=masks, bad_masks=bad_masks,
+                              use_proper_time_limits=use_proper_time_limits)
+
+    returns = torch.zeros(num_steps + 1, batch_size, 1, dtype=torch.float64)
+    compute_returns(next_value, rewards, value_preds, returns, gamma=0.95, tau=0.9,
+                    use_gae=use_gae, masks=masks, bad_masks=bad_masks,
+                    use_proper_time_limits=use_proper_time_limits)
+
+    assert torch.allclose(returns, expected_returns, atol=1e-10)
+    assert torch.equal(value_preds, expected_value_preds)
@@ -0,0 +1,108 @@
+import argparse
+import types
+
+import torch
+from torch import nn
+
+from metallearner import MetaLearner, device
+
+
+class StubCore(nn.Module):
+    """ Encodes a trajectory with running sums, returns (1 + sequence_len) x batch x dim outputs including the prior """
+
+    output_dims = (3, 3, 2, 5, 4, 4, 4, 5, 6)
+
+    def __init__(self, input_dim):
+        super(StubCore, self).__init__()
+        self.heads = nn.ModuleList([nn.Linear(input_dim, dim) for dim in self.output_dims])
+
+    def forward_exploration_branch(self, actions, states, rewards, prev_state, **kwargs):
+        inputs = torch.cat((actions, states, rewards), dim=-1).cumsum(dim=0)
+        inputs = torch.cat((torch.zeros_like(inputs[:1]), inputs))
+        return tuple(head(inputs) for head in self.heads)
+
+
+class RunningStorage(object):
+    def __init__(self, num_steps, num_processes, obs_dim):
+        self.prev_obs = torch.randn(num_steps, num_processes, obs_dim, device=device)
+        self.next_obs = torch.randn(num_steps, num_processes, obs_dim, device=device)
+        self.act = torch.randn(num_steps, num_processes, 1, device=device)
+        self.rew = torch.randn(num_steps, num_processes, 1, device=device)
+        self.lens = torch.zeros(num_processes, dtype=torch.long)
+
+    def get_running_batch(self):
+        # zero-padded after the current step of each process
+        steps = torch.arange(self.act.shape[0]).view(-1, 1, 1)
+        mask = (steps < self.lens.view(1, -1, 1)).float().to(device)
+        return self.prev_obs * mask, self.next_obs * mask, self.act * mask, self.rew * mask, self.lens.tolist()
+
+
+class Policy(object):
+    """ Updates the brim core with a real optimiser step, like PPO / A2C do through the VAE loss """
+
+    def __init__(self, actor_critic, core):
+        self.actor_critic = actor_critic
+        self.optimiser = torch.optim.Adam(core.parameters(), lr=0.1)
+
+    def update(self, encoder, **kwargs):
+        self.optimiser.zero_grad()
+        actions, states, rewards = torch.randn(5, 3, 1), torch.randn(5, 3, 4), torch.randn(5, 3, 1)
+        outputs = encoder.forward_exploration_branch(actions.to(device), states.to(device), rewards.to(device), None)
+        sum(x.pow(2).mean() for x in outputs).backward()
+        self.optimiser.step()
+        return {}
+
+
+class Learner(object):
+    encode_running_trajectory = MetaLearner.encode_running_trajectory
+    cache_running_encoding = MetaLearner.cache_running_encoding
+    update = MetaLearner.update
+
+    def __init__(self, cache_running_encoding, core, policy):
+        self.args = argparse.Namespace(cache_running_encoding=cache_running_encoding, policy_use_gae=True,
+                                       policy_gamma=0.99, policy_tau=0.95, use_proper_time_limits=False,
+                                       rlloss_through_encoder=False)
+        self.base2final = types.SimpleNamespace(brim_core=core, compute_vae_loss=None,
+                                                compute_n_step_value_prediction_loss=None, compute_memory_loss=None,
+                                                predictor_network=None, random_target_network=None)
+        self.exploration_policy = Policy(policy, core)
+        self.running_encoding_cache = {'exploration': None, 'exploitation': None}
+        self.running_encoding_shapes = {'exploration': None, 'exploitation': None}
+        self.num_encoder_updates = 0
+
+    def get_value(self, **kwargs):
+        return None
+
+
+def test_cache_hit_equals_fresh_encoding():
+    torch.manual_seed(0)
+    obs_dim, num_processes = 4, 3
+    core, policy = StubCore(obs_dim + 2).to(device), nn.Linear(2, 2).to(device)
+    storage = RunningStorage(num_steps=6, num_processes=num_processes, obs_dim=obs_dim)
+    storage.lens = torch.tensor([0, 2, 1])
+    learner = Learner(True, core, policy)
+    reference = Learner(False, core, policy)
+
+    with torch.no_grad():
+        learner.encode_running_trajectory(storage, 'exploration')
+        # the rollout moves every process on by a few steps, the encoding of the last one is cached
+        storage.lens += 3
+        learner.cache_running_encoding(reference.encode_running_trajectory(storage, 'exploration'), 'exploration')
+
+        cached = learner.encode_running_trajectory(storage, 'exploration')
+        fresh = reference.encode_running_trajectory(storage, 'exploration')
+        assert learner.running_encoding_cache['exploration'] is not None
+        for x, y in zip(cached, fresh):
+            assert x.shape == y.shape
+            assert torch.equal(x, y)
+
+    # an update of the encoder invalidates the cache
+    policy_storage = types.SimpleNamespace(compute_returns=lambda *args, **kwargs: None)
+    learner.update(policy_embedded_state=None, belief=None, task=None, latent_sample=None, latent_mean=None,
+                   latent_logvar=None, brim_output_level1=None, policy=learner.exploration_policy,
+                   policy_storage=policy_storage, activated_branch='exploration')
+    with torch.no_grad():
+        updated = learner.encode_running_trajectory(storage, 'exploration')
+        for x, y in zip(updated, reference.encode_running_trajectory(storage, 'exploration')):
+            assert torch.equal(x, y)
+        assert not torch.equal(updated[0], cached[0])
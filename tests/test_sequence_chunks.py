@@ -0,0 +1,117 @@
+import types
+
+import pytest
+import torch
+from torch import nn
+
+from utils.helpers import device, recompute_embeddings, sequence_chunks
+
+
+def resets(num_steps, num_processes=3, done=(), done_episode=()):
+    """ done / done_episode flags with the given (step, process) pairs set """
+    flags = []
+    for pairs in (done, done_episode):
+        x = torch.zeros(num_steps, num_processes, 1, device=device)
+        for step, process in pairs:
+            x[step, process] = 1.
+        flags.append(x)
+    return flags
+
+
+@pytest.mark.parametrize('num_steps, chunk_size, done, done_episode, expected', [
+    # no resets, chunk_size divides T
+    (6, 3, (), (), [(0, 3), (3, 6)]),
+    # chunk_size does not divide T
+    (7, 3, (), (), [(0, 3), (3, 6), (6, 7)]),
+    # a reset at step 0 does not cut anything
+    (5, 2, [(0, 0), (0, 2)], [(0, 1)], [(0, 2), (2, 4), (4, 5)]),
+    # consecutive resets, in different processes and through done_episode
+    (6, 4, [(2, 1)], [(3, 0)], [(0, 2), (2, 3), (3, 6)]),
+    # a reset in the middle, the chunks after it do not divide the rest either
+    (9, 3, [(4, 2)], (), [(0, 3), (3, 4), (4, 7), (7, 9)]),
+    # chunks of a single step
+    (3, 1, [(1, 0)], (), [(0, 1), (1, 2), (2, 3)]),
+])
+def test_sequence_chunks(num_steps, chunk_size, done, done_episode, expected):
+    chunks = sequence_chunks(*resets(num_steps, done=done, done_episode=done_episode), chunk_size=chunk_size)
+    assert chunks == expected
+
+
+class StubCore(nn.Module):
+    """ A recurrent core with the interface of the brim core, that runs over any number of steps at once """
+
+    output_dims = (3, 2, 4, 5, 5, 5, 6)
+
+    def __init__(self, input_dim, hidden_dim=8):
+        super(StubCore, self).__init__()
+        self.input = nn.Linear(input_dim, hidden_dim)
+        self.recurrent = nn.Linear(hidden_dim, hidden_dim)
+        self.task_inference = nn.Linear(hidden_dim, hidden_dim)
+        self.heads = nn.ModuleList([nn.Linear(hidden_dim, dim) for dim in self.output_dims])
+        self.brim = types.SimpleNamespace(model=types.SimpleNamespace(memory=None))
+
+    def reset_hidden(self, policy, task_inference_hidden_state, brim_hidden_state, done, done_episode, activated_branch):
+        mask = 1. - ((done + done_episode) > 0).float()
+        return task_inference_hidden_state * mask, brim_hidden_state * mask
+
+    def forward_exploration_branch(self, actions, states, rewards, task_inference_hidden_state, brim_hidden_state,
+                                   **kwargs):
+        inputs = self.input(torch.cat((actions, states, rewards), dim=-1))
+        brim_hidden, task_inference_hidden = [], []
+        h, g = brim_hidden_state[-1], task_inference_hidden_state[-1]
+        for x in inputs.unbind(0):
+            h = torch.tanh(x + self.recurrent(h))
+            g = torch.tanh(self.task_inference(h) + g)
+            brim_hidden.append(h)
+            task_inference_hidden.append(g)
+        brim_hidden, task_inference_hidden = torch.stack(brim_hidden), torch.stack(task_inference_hidden)
+        outputs = [head(brim_hidden) for head in self.heads]
+        return tuple(outputs[:3]) + (brim_hidden,) + tuple(outputs[3:6]) + (task_inference_hidden, outputs[6])
+
+
+def make_policy_storage(core, done, done_episode, num_steps, num_processes, state_dim=4, hidden_dim=8):
+    torch.manual_seed(1)
+    priors = [torch.randn(num_processes, dim, device=device) for dim in core.output_dims]
+    return types.SimpleNamespace(
+        brim_output_level1=[priors[0]], brim_output_level2=[priors[1]], brim_output_level3=[priors[2]],
+        latent_samples=[priors[3]], latent_mean=[priors[4]], latent_logvar=[priors[5]],
+        policy_embedded_state=[priors[6]],
+        task_inference_hidden_states=torch.randn(num_steps + 1, num_processes, hidden_dim, device=device),
+        brim_hidden_states=torch.randn(num_steps + 1, num_processes, hidden_dim, device=device),
+        actions=torch.randint(0, 3, size=(num_steps, num_processes, 1), device=device),
+        next_state=torch.randn(num_steps, num_processes, state_dim, device=device),
+        rewards_raw=torch.randn(num_steps, num_processes, 1, device=device),
+        # done[t + 1] resets the hidden state before step t
+        done=torch.cat((torch.zeros_like(done[:1]), done)),
+        done_episode=torch.cat((torch.zeros_like(done_episode[:1]), done_episode)))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 16])
+def test_chunked_recompute_embeddings_matches_per_step(chunk_size):
+    torch.manual_seed(0)
+    num_steps, num_processes = 10, 3
+    core = StubCore(input_dim=6).to(device)
+    state_encoder = types.SimpleNamespace(prior=lambda batch_size: None, detach_hidden_state=lambda: None)
+    policy = types.SimpleNamespace(state_encoder=state_encoder)
+    done, done_episode = resets(num_steps, num_processes, done=[(0, 1), (4, 0), (5, 2)], done_episode=[(8, 1)])
+
+    recomputed = []
+    for chunks in (None, chunk_size):
+        storage = make_policy_storage(core, done, done_episode, num_steps, num_processes)
+        recompute_embeddings(policy, storage, core, sample=True, update_idx=1, detach_every=None,
+                             activated_branch='exploration', chunk_size=chunks)
+        recomputed.append(storage)
+
+    per_step, chunked = recomputed
+    for name in ('brim_output_level1', 'brim_output_level2', 'brim_output_level3', 'latent_samples', 'latent_mean',
+                 'latent_logvar', 'policy_embedded_state'):
+        expected, actual = getattr(per_step, name), getattr(chunked, name)
+        assert len(expected) == len(actual) == num_steps + 1
+        expected = torch.stack([x.reshape(expected[0].shape) for x in expected])
+        actual = torch.stack([x.reshape(actual[0].shape) for x in actual])
+        assert torch.allclose(expected, actual, atol=1e-6)
+
+    # the graph goes through the encoder in both cases
+    loss = torch.stack(chunked.latent_mean[1:]).sum()
+    loss.backward()
+    assert core.input.weight.grad is not None